@@ -21,29 +21,22 @@ def send_command(con, command):
 
 
 
-def capture_until_eol(con, wait=True, timeout_s=1):
-    dout = bytes()
-    cr_flag = False
-    lf_flag = False
-        
-    over = False
-    while not over:
-        if con.in_waiting >= 1:
-            data = con.read(1)
-            if data == bytes('\r', encoding="utf-8"):
-                over = True
-            else:
-                dout = dout + data
-        else:
-            wait_start = time.time()
-            waiting = True
-            while waiting:
-                if con.in_waiting >= 1:
-                    waiting = False
-                if time.time() - wait_start >= timeout_s:
-                    waiting = False
-                    over = True
-
+def capture_until_eol(con):
+    # Reads in chunks and blocks on the port timeout instead of spinning on in_waiting
+    dout = bytearray()
+    scan = 0
+    while True:
+        idx = dout.find(b'\r', scan)
+        if idx >= 0:
+            dout = dout[:idx]
+            break
+        scan = len(dout)
+        data = con.read(max(1, con.in_waiting))
+        if len(data) == 0:  # Timed out
+            break
+        dout += data
+
+    dout = bytes(dout)
     if DEBUG:
         print(dout)
 
@@ -0,0 +1,234 @@
+# acquisition.py
+#
+# Runs the SRS830Handler in its own process, so serial parsing does not compete with the GUI for the GIL.
+#
+# Captures cross the process boundary through a ring of fixed-size slots in shared memory. The acquisition process
+# takes a free slot, copies the timebase, R and theta arrays into it, marks it ready and sends a small descriptor
+# (slot number, sample count, start time, info dict) through a multiprocessing queue. On this side a bridge thread
+# turns each descriptor into NumPy views of the slot and puts them on the usual data queue, so the arrays are never
+# pickled. Whoever consumes the capture calls the release function in its info dict to hand the slot back.
+#
+# A slot is only described once it has been completely written, so a capture cut off by shutdown is never seen.
+# Commands (SRS830_COMMAND_*) are passed through a multiprocessing queue to the handler unchanged.
+#
+# Nothing relies on the process being forked. With spawn (Windows, and macOS by default) the child imports common
+# afresh, so the settings are passed to it explicitly, and it attaches to the ring without taking ownership of it.
+#
+# David Lister
+# July 2023
+#
+
+import logging
+import multiprocessing
+import queue
+import sys
+import threading
+from multiprocessing import resource_tracker, shared_memory
+import numpy as np
+import common
+import metrics
+
+logger = logging.getLogger("RTLR.acquisition")
+
+SLOT_FREE = 0
+SLOT_WRITING = 1
+SLOT_READY = 2
+HEADER_WORDS = 4  # state, samples, sequence number, spare
+N_CHANNELS = 3  # timebase, R, theta
+
+
+def settings():
+    # Everything in common, including anything changed at run time, for handing to a spawned process
+    return {key: value for key, value in vars(common).items() if key.isupper()}
+
+
+def attach_untracked(name):
+    # Attaches to existing shared memory without registering it with this process's resource tracker. Before
+    # Python 3.13 attaching registers it, and a tracker of the attaching process's own unlinks it when that process
+    # exits, under the owner. Registration is skipped rather than undone, since undoing it would also remove the
+    # owner's registration when the tracker is shared with the owner (fork, and spawn on POSIX).
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    register = resource_tracker.register
+
+    def register_except_shared_memory(resource, rtype):
+        if rtype != "shared_memory":
+            register(resource, rtype)
+
+    resource_tracker.register = register_except_shared_memory  # Only called while the process is starting up
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+
+class SharedCaptureRing:
+    def __init__(self, n_slots, slot_samples, name=None):
+        # Creates the shared memory if name is None, otherwise attaches to an existing ring
+        self.n_slots = n_slots
+        self.slot_samples = slot_samples
+        self.slot_words = HEADER_WORDS + N_CHANNELS * slot_samples
+        size = n_slots * self.slot_words * 8
+        self.owner = name is None
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.shm = attach_untracked(name)
+        self.name = self.shm.name
+        self.words = np.ndarray((n_slots, self.slot_words), dtype=np.float64, buffer=self.shm.buf)
+        self.headers = self.words[:, :HEADER_WORDS]
+        if self.owner:
+            self.headers[:] = 0
+
+    def data(self, slot, n):
+        # Views of the timebase, R and theta arrays in a slot
+        channels = self.words[slot, HEADER_WORDS:].reshape(N_CHANNELS, self.slot_samples)
+        return channels[0, :n], channels[1, :n], channels[2, :n]
+
+    def write(self, slot, sequence, timebase, r, theta):
+        n = min(len(timebase), len(r), len(theta))
+        self.headers[slot, 0] = SLOT_WRITING
+        channels = self.data(slot, n)
+        channels[0][:] = timebase[:n]
+        channels[1][:] = r[:n]
+        channels[2][:] = theta[:n]
+        self.headers[slot, 1] = n
+        self.headers[slot, 2] = sequence
+        self.headers[slot, 0] = SLOT_READY
+        return n
+
+    def is_ready(self, slot, sequence):
+        return self.headers[slot, 0] == SLOT_READY and self.headers[slot, 2] == sequence
+
+    def release(self, slot):
+        self.headers[slot, 0] = SLOT_FREE
+
+    def close(self):
+        self.headers = None
+        self.words = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class RingWriter:
+    # Stands in for the data queue inside the acquisition process, SRS830Handler calls put() as usual
+    def __init__(self, ring, descriptor_queue, free_slots):
+        self.ring = ring
+        self.descriptors = descriptor_queue
+        self.free_slots = free_slots
+        self.sequence = 0
+
+    def put(self, item):
+        start_time, capture, info = item
+        if not isinstance(capture[1], np.ndarray) or len(capture[1]) > self.ring.slot_samples:
+            # Fake captures, and anything too big for a slot, go through the queue as they are
+            self.descriptors.put((None, 0, 0, start_time, capture, info))
+            return
+
+        slot = self.free_slots.get()  # Blocks when every slot is in use, which is the backpressure
+        self.sequence += 1
+        n = self.ring.write(slot, self.sequence, *capture)
+        self.descriptors.put((slot, self.sequence, n, start_time, None, info))
+
+    def empty(self):
+        return True
+
+    def qsize(self):
+        return 0
+
+
+def release_capture(item):
+    # Hands a capture's slot back to the ring, for consumers that discard captures without processing them
+    release = item[2].pop("release", None)
+    if release is not None:
+        release()
+
+
+def acquisition_main(ring_name, n_slots, slot_samples, descriptor_queue, free_slots, command_queue, run_name,
+                     run_dir, serial_port, replay_args, name, profile, config):
+    # Entry point of the acquisition process. config is settings() from the parent, applied before the handler
+    # modules are imported so their defaults pick it up.
+    vars(common).update(config)
+    metrics.enabled = common.METRICS_ENABLED
+    import srs830
+    import srs830_async
+    import replay
+    ring = SharedCaptureRing(n_slots, slot_samples, name=ring_name)
+    exporter = metrics.Exporter(run_dir, filename=f"metrics_acquisition_{name}.json")
+    source = replay.ReplaySource(*replay_args) if replay_args is not None else None
+    writer = RingWriter(ring, descriptor_queue, free_slots)
+    if common.SRS830_USE_ASYNC and source is None and not common.SRS830_FAKE_SERIAL:
+        handler = srs830_async.AsyncSRS830Handler(writer, command_queue, run_name, run_dir, serial_port=serial_port,
+                                                  name=name, profile=profile)
+    else:
+        handler = srs830.SRS830Handler(writer, command_queue, run_name, run_dir, serial_port=serial_port,
+                                       replay_source=source, name=name, profile=profile)
+    handler.join()
+    descriptor_queue.put(None)  # Tells the bridge the handler has finished
+    exporter.join()
+    ring.close()
+
+
+class ProcessAcquisition:
+    def __init__(self, data_queue, command_queue, run_name, run_dir, serial_port=None, replay_args=None,
+                 name="srs830", profile=None, n_slots=common.SHM_SLOTS, slot_samples=common.SHM_SLOT_SAMPLES):
+        # Drop-in for SRS830Handler. command_queue must be a multiprocessing.Queue. replay_args is (path, speed, loop)
+        # for replay.ReplaySource, which is built in the acquisition process.
+        self.logger = logging.getLogger("RTLR.acquisition.ProcessAcquisition")
+        self.queue_data_out = data_queue
+        self.ring = SharedCaptureRing(n_slots, slot_samples)
+        self.descriptors = multiprocessing.Queue()
+        self.free_slots = multiprocessing.Queue()
+        for slot in range(n_slots):
+            self.free_slots.put(slot)
+
+        self.p = multiprocessing.Process(target=acquisition_main,
+                                         args=(self.ring.name, n_slots, slot_samples, self.descriptors,
+                                               self.free_slots, command_queue, run_name, run_dir,
+                                               serial_port, replay_args, name, profile, settings()))
+        self.p.start()
+        self.bridge = threading.Thread(target=self.run, daemon=True)
+        self.bridge.start()
+
+    def run(self):
+        while True:
+            try:
+                descriptor = self.descriptors.get(timeout=0.5)
+            except queue.Empty:
+                if not self.p.is_alive():
+                    break
+                continue
+            if descriptor is None:
+                break
+
+            slot, sequence, n, start_time, capture, info = descriptor
+            if slot is not None:
+                if not self.ring.is_ready(slot, sequence):
+                    self.logger.error(f"Slot {slot} was described but is not ready, dropping it")
+                    self.release(slot)
+                    continue
+                capture = self.ring.data(slot, n)
+                info["release"] = lambda slot=slot: self.release(slot)
+            self.queue_data_out.put([start_time, capture, info])
+        self.logger.info("Acquisition process finished")
+
+    def release(self, slot):
+        if self.ring.words is None:
+            return
+        self.ring.release(slot)
+        self.free_slots.put(slot)
+
+    def join(self, timeout=common.SHM_JOIN_TIMEOUT_S):
+        # Call after SRS830_COMMAND_RAISE_END_FLAG. The process is stopped if it does not finish in time, a slot it
+        # was part way through writing has not been described yet, so it is never read.
+        self.p.join(timeout)
+        if self.p.is_alive():
+            self.logger.warning("Acquisition process did not finish, terminating it")
+            self.p.terminate()
+            self.p.join()
+        self.bridge.join()
+
+    def close(self):
+        # Call once the consumers have released their slots
+        self.ring.close()
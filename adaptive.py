@@ -0,0 +1,100 @@
+# adaptive.py
+#
+# Chooses the capture length and sample rate for the next burst from the capture just taken.
+#
+# Two things limit the capture length. Noise: the reflectance is a difference of medians, whose standard error
+# shrinks as one over the square root of the number of samples. The noise is estimated from the differences between
+# consecutive samples, which ignores both the chopper steps (few and large) and the slow change of reflectance during
+# the capture, and from it the number of samples that brings the error down to ADAPTIVE_TARGET_ERROR of the
+# reflectance. Growth: the reflectance should change by no more than ADAPTIVE_MAX_CHANGE of itself within one capture,
+# which bounds the length by how fast it changed between the last two captures.
+#
+# The capture is long enough for the noise target at the fastest rate. If the reflectance is changing, it is also
+# kept short enough for the growth limit, and otherwise it stays at SRS830_CAPTURE_TIME_S. A noisy capture is
+# lengthened even when the growth limit would shorten it, because a shorter one would not give a usable point. The
+# sample rate is then the slowest SRAT rate that still collects the samples needed, which shortens the transfer.
+# Changes are limited to a factor of ADAPTIVE_MAX_STEP per capture, so one odd capture cannot swing the settings.
+#
+# David Lister
+# July 2023
+#
+
+import math
+import numpy as np
+import common
+import profiles
+import reflectance
+
+MAD_TO_SIGMA = 1.4826  # Median absolute deviation to standard deviation for Gaussian noise
+MEDIAN_EFFICIENCY = 1.2533  # Standard error of a median relative to a mean, sqrt(pi / 2)
+
+
+def noise_sigma(data_r):
+    # Gaussian noise on each sample, from the median size of the steps between samples (each step has sqrt(2) sigma)
+    return MAD_TO_SIGMA * np.median(np.abs(np.diff(data_r))) / math.sqrt(2)
+
+
+def reflectance_error(data_r):
+    # Standard error of the upper median minus the lower median, each taken over half the samples
+    return math.sqrt(2) * MEDIAN_EFFICIENCY * noise_sigma(data_r) / math.sqrt(len(data_r) / 2)
+
+
+class CaptureController:
+    def __init__(self, capture_time_s=common.SRS830_CAPTURE_TIME_S, min_time_s=common.ADAPTIVE_MIN_TIME_S,
+                 max_time_s=common.ADAPTIVE_MAX_TIME_S, min_rate_index=common.ADAPTIVE_MIN_RATE_INDEX,
+                 max_rate_index=common.ADAPTIVE_MAX_RATE_INDEX, target_error=common.ADAPTIVE_TARGET_ERROR,
+                 max_change=common.ADAPTIVE_MAX_CHANGE, max_step=common.ADAPTIVE_MAX_STEP):
+        self.nominal_time_s = capture_time_s
+        self.min_time_s = min_time_s
+        self.max_time_s = max_time_s
+        self.min_rate_index = min_rate_index
+        self.max_rate_index = max_rate_index
+        self.target_error = target_error
+        self.max_change = max_change
+        self.max_step = max_step
+
+        self.capture_time_s = capture_time_s
+        self.rate_index = max_rate_index
+        self.last = None  # (mid time, reflectance) of the previous capture
+        self.error = math.nan  # Relative error of the last capture's reflectance
+        self.change_rate = math.nan  # Relative change of reflectance per second
+
+    def update(self, start_time, data_r, rate_hz):
+        # Takes the capture just taken, returns (capture time, SRAT index) for the next one
+        data_r = np.asarray(data_r, dtype=np.float64)
+        n = len(data_r)
+        if n < 4:
+            return self.capture_time_s, self.rate_index
+
+        upper, lower = reflectance.split_medians(data_r)
+        value = upper[0] - lower[0]
+        if not value > 0:
+            # No chopped signal, e.g. a flat capture has no medians and gives NaN
+            return self.capture_time_s, self.rate_index
+
+        self.error = reflectance_error(data_r) / value
+        samples_needed = max(n * (self.error / self.target_error) ** 2, common.ADAPTIVE_MIN_SAMPLES)
+        max_rate_hz = profiles.rate_hz(self.max_rate_index)
+        noise_time_s = samples_needed / max_rate_hz
+
+        # Growth, from the change since the previous capture
+        mid_time = start_time + n / rate_hz / 2
+        growth_time_s = math.inf
+        if self.last is not None and mid_time > self.last[0]:
+            self.change_rate = abs(value - self.last[1]) / value / (mid_time - self.last[0])
+            if self.change_rate > 0:
+                growth_time_s = self.max_change / self.change_rate
+        self.last = (mid_time, value)
+
+        wanted = max(noise_time_s, min(growth_time_s, self.nominal_time_s))
+        wanted = min(max(wanted, self.capture_time_s / self.max_step), self.capture_time_s * self.max_step)
+        self.capture_time_s = min(max(wanted, self.min_time_s), self.max_time_s)
+
+        # Slowest rate that still collects the samples needed in that time
+        rate_needed = samples_needed / self.capture_time_s
+        self.rate_index = self.max_rate_index
+        for index in range(self.min_rate_index, self.max_rate_index + 1):
+            if profiles.rate_hz(index) >= rate_needed:
+                self.rate_index = index
+                break
+        return self.capture_time_s, self.rate_index
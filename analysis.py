@@ -0,0 +1,298 @@
+# analysis.py
+#
+# Analysis stage between the SRS830Handler and the GUI.
+#
+# Runs in its own thread. Each pass drains every capture waiting in the data queue, calculates reflectance for the
+# whole batch, saves the results, and publishes one ready-to-draw result to the GUI queue. Queue depth and the lag
+# between capture and analysis are tracked and reported with each result.
+#
+# Captures are grouped by the instrument that took them. Each instrument has its own results files, thickness
+# tracker and series in the GUI result. With more than one instrument the series are also merged onto a common
+# timebase and saved to Reflectance_merged.csv. With a publisher the reflectance and raw captures are also streamed
+# to other processes, see publisher.py.
+#
+# David Lister
+# July 2023
+#
+
+import logging
+import os
+import threading
+import time
+import numpy as np
+import acquisition
+import common
+import demodulation
+import merge
+import metrics
+import reflectance
+import thickness
+import writer
+
+logger = logging.getLogger("RTLR.analysis")
+
+
+def merge_results(older, newer):
+    # Used by the GUI queue to coalesce results when the GUI falls behind, keeps every point and the newest capture
+    merged = dict(newer)
+    merged["series"] = dict(older["series"])
+    for name, series in newer["series"].items():
+        if name in merged["series"]:
+            series = dict(series)
+            series["time"] = np.concatenate((older["series"][name]["time"], series["time"]))
+            series["reflectance"] = np.concatenate((older["series"][name]["reflectance"], series["reflectance"]))
+        merged["series"][name] = series
+    return merged
+
+
+def sample_rate_hz(item):
+    return item[2].get("sample_rate_hz", common.SRS830_CAPTURE_RATE_HZ)
+
+
+class InstrumentStream:
+    # Results files and thickness tracker for one instrument. suffix is added to the file names. draw is False when
+    # nothing shows the raw signal, which then is not copied and its medians are not calculated.
+    def __init__(self, run_dir, settings, suffix="", draw=True, append=False):
+        # append continues existing results files, as when a run is resumed
+        self.name = settings["name"]
+        self.draw = draw
+        self.demodulator = None
+        if common.CALC_TYPE == common.CALC_DEMODULATION:
+            self.demodulator = demodulation.Demodulator()
+        self.writers = []
+        if common.SAVE_CALCULATED_REFLECTANCE:
+            self.writers.append(writer.ResultWriter(os.path.join(run_dir, f"Reflectance{suffix}.csv"),
+                                                    ("time", "reflectance"), header="Time (s),Reflectance (v)",
+                                                    append=append))
+        if common.SAVE_BINARY_REFLECTANCE:
+            self.writers.append(writer.ResultWriter(os.path.join(run_dir, f"Reflectance{suffix}.bin"),
+                                                    ("time", "reflectance"), fmt=common.WRITER_FORMAT_BINARY,
+                                                    append=append))
+
+        self.tracker = None
+        self.film = None  # Latest thickness tracker state
+        self.thickness_writers = []
+        if common.TRACK_THICKNESS:
+            self.tracker = thickness.ThicknessTracker(
+                wavelength_nm=settings.get("wavelength_nm", common.THICKNESS_WAVELENGTH_NM),
+                refractive_index=settings.get("refractive_index", common.THICKNESS_REFRACTIVE_INDEX),
+                angle_deg=settings.get("angle_deg", common.THICKNESS_ANGLE_DEG))
+            if common.SAVE_THICKNESS:
+                self.thickness_writers.append(writer.ResultWriter(
+                    os.path.join(run_dir, f"Thickness{suffix}.csv"), ("time", "thickness", "growth_rate", "roughness"),
+                    header="Time (s),Thickness (nm),Growth Rate (nm/s),Roughness (nm)", append=append))
+
+    def process(self, times, items):
+        # Reflectance, thickness and saving for a batch of this instrument's captures, returns its GUI series
+        t0 = metrics.start()
+        upper = lower = None
+        if self.demodulator is not None:
+            times, values = self.demodulate(times, items)
+        else:
+            rates = [sample_rate_hz(item) for item in items]
+            values, upper, lower = reflectance.calculate_batch_medians([item[1][1] for item in items], rates_hz=rates)
+        t0 = metrics.lap("reflectance", t0)
+
+        # Demodulation gives no points until a full window is in, the film estimate then stays as it was
+        if len(values):
+            if self.tracker is not None:
+                states = [self.tracker.update(t, v) for t, v in zip(times.tolist(), values.tolist())]
+                self.film = states[-1]
+                t0 = metrics.lap("thickness", t0)
+
+            for w in self.writers:
+                w.write(times, values)
+            if self.tracker is not None:
+                for w in self.thickness_writers:
+                    w.write(times, *([state[k] for state in states]
+                                     for k in ("thickness_nm", "growth_rate_nm_s", "roughness_nm")))
+            metrics.stop("write", t0)
+
+        timebase, data_r, _ = items[-1][1]
+        upper_median = lower_median = np.nan
+        if not self.draw:
+            timebase, data_r = np.zeros(0), np.zeros(0)
+        else:
+            if "release" in items[-1][2]:
+                # Shared memory slot is about to be reused, the GUI gets its own copy
+                timebase, data_r = np.array(timebase), np.array(data_r)
+            if upper is None:
+                upper, lower = reflectance.split_medians(data_r)
+            upper_median, lower_median = upper[-1], lower[-1]
+        return {"time": times,
+                "reflectance": values,
+                "film": self.film,
+                "raw_time": timebase,
+                "raw_voltage": data_r,
+                "upper_median": upper_median,
+                "lower_median": lower_median}
+
+    def demodulate(self, times, items):
+        # Every window completed by the batch, times are window centres
+        points = [self.demodulator.process(t, sample_rate_hz(item), item[1][1])
+                  for t, item in zip(times.tolist(), items)]
+        return np.concatenate([p[0] for p in points]), np.concatenate([p[1] for p in points])
+
+    def poll(self):
+        for w in self.writers + self.thickness_writers:
+            w.poll()
+
+    def close(self):
+        for w in self.writers + self.thickness_writers:
+            w.close()
+
+
+class AnalysisHandler:
+    def __init__(self, data_queue, gui_queue, command_queue, run_name, run_dir, init_time=None,
+                 instruments=common.SRS830_INSTRUMENTS, startup_time=None, publisher=None, append=False):
+        # gui_queue may be None when nothing is drawing. startup_time is when the program started, to report the time
+        # until the first capture is analysed. publisher, if given, streams the results to other processes. append
+        # continues the results files of a resumed run.
+        self.p = threading.Thread(target=self.run)
+        self.logger = logging.getLogger("RTLR.analysis.AnalysisHandler")
+        self.run_name = run_name
+        self.run_dir = run_dir
+        self.queue_data_in = data_queue
+        self.queue_gui_out = gui_queue
+        self.queue_commands_in = command_queue
+        self.publisher = publisher
+        self.init_time = init_time if init_time is not None else time.time()
+        self.append = append
+
+        # A single instrument keeps the original file names
+        self.instruments = list(instruments)
+        self.multi = len(self.instruments) > 1
+        self.streams = {}
+        for settings in self.instruments:
+            self.add_stream(settings)
+
+        self.merger = None
+        self.merged_writer = None
+        if self.multi:
+            names = [settings["name"] for settings in self.instruments]
+            self.merger = merge.Merger(names)
+            if common.SAVE_MERGED_REFLECTANCE:
+                self.merged_writer = writer.ResultWriter(
+                    os.path.join(self.run_dir, "Reflectance_merged.csv"), ["time"] + names,
+                    header="Time (s)," + ",".join(f"{name} Reflectance (v)" for name in names), append=append)
+
+        # Statistics
+        self.captures_processed = 0
+        self.startup_time = startup_time
+        self.first_capture_s = None
+        self.lag_s = 0.0
+        self.last_report_time = time.time()
+
+        # Flags
+        self.flagEnd = False
+
+        # Start the thread!
+        self.p.start()
+
+    def add_stream(self, settings):
+        suffix = f"_{settings['name']}" if self.multi else ""
+        self.streams[settings["name"]] = InstrumentStream(self.run_dir, settings, suffix,
+                                                          draw=self.queue_gui_out is not None, append=self.append)
+        return self.streams[settings["name"]]
+
+    def run(self):
+        self.logger.info("Starting AnalysisHandler")
+        while not self.flagEnd:
+            items = self.queue_data_in.drain(common.ANALYSIS_MAX_BATCH, timeout=0.2)
+            if common.SRS830_FAKE_SERIAL:
+                items = []  # Fake captures have no data, the GUI makes its own
+            if items:
+                self.process(items)
+            for stream in self.streams.values():
+                stream.poll()
+            if self.merged_writer is not None:
+                self.merged_writer.poll()
+
+            while not self.queue_commands_in.empty():
+                command = self.queue_commands_in.get()
+                match command:
+                    case common.ANALYSIS_COMMAND_RAISE_END_FLAG:
+                        self.logger.info("Raising the end flag")
+                        self.flagEnd = True
+
+                    case _:
+                        self.logger.error(f"Error - Command not handled properly {command}")
+
+        # Finish anything still queued so no captures are lost on shutdown
+        if not common.SRS830_FAKE_SERIAL:
+            while True:
+                items = self.queue_data_in.drain(common.ANALYSIS_MAX_BATCH, timeout=0)
+                if not items:
+                    break
+                self.process(items)
+        for stream in self.streams.values():
+            stream.close()
+        if self.merged_writer is not None:
+            self.merged_writer.close()
+        self.logger.info("Ending AnalysisHandler")
+
+    def process(self, items):
+        # Captures without an instrument name come from the first instrument
+        default_name = self.instruments[0]["name"] if self.instruments else "srs830"
+        groups = {}
+        for item in items:
+            name = item[2].get("instrument", default_name)
+            groups.setdefault(name, []).append(item)
+
+        series = {}
+        for name, group in groups.items():
+            stream = self.streams.get(name)
+            if stream is None:
+                self.logger.warning(f"Captures from unknown instrument {name}, saving them separately")
+                stream = self.add_stream({"name": name})
+            times = np.array([item[0] for item in group]) - self.init_time
+            series[name] = stream.process(times, group)
+            if self.merger is not None and name in self.merger.names and len(series[name]["time"]):
+                self.merger.add(name, series[name]["time"], series[name]["reflectance"])
+            if self.publisher is not None:
+                self.publish(name, times, group, series[name])
+
+        if self.merged_writer is not None:
+            grid, merged = self.merger.pop()
+            if len(grid):
+                self.merged_writer.write(grid, *(merged[name] for name in self.merger.names))
+
+        # Lag is how long after the end of the newest capture it was analysed
+        newest = max(items, key=lambda item: item[0])
+        duration = len(newest[1][1]) / sample_rate_hz(newest)
+        self.lag_s = time.time() - (newest[0] + duration)
+        self.captures_processed += len(items)
+        if self.first_capture_s is None and self.startup_time is not None:
+            self.first_capture_s = time.time() - self.startup_time
+            metrics.gauge("startup_to_first_capture_s", self.first_capture_s)
+            self.logger.info(f"First capture analysed {self.first_capture_s:.3f} s after startup")
+
+        result = {"series": series,
+                  "queue_depth": self.queue_data_in.qsize(),
+                  "lag_s": self.lag_s,
+                  "dropped": getattr(self.queue_data_in, "dropped", 0)}
+        if self.queue_gui_out is not None:
+            self.queue_gui_out.put(result)
+            metrics.gauge("gui_queue_depth", self.queue_gui_out.qsize())
+        for item in items:
+            acquisition.release_capture(item)
+        metrics.gauge("analysis_queue_depth", result["queue_depth"])
+        metrics.gauge("analysis_queue_dropped", result["dropped"])
+        metrics.gauge("analysis_lag_s", self.lag_s)
+        metrics.gauge("analysis_batch", len(items))
+
+        if time.time() - self.last_report_time >= common.ANALYSIS_REPORT_INTERVAL_S:
+            self.last_report_time = time.time()
+            self.logger.info(f"Processed {self.captures_processed} captures, batch of {len(items)}, "
+                             f"queue depth {result['queue_depth']}, lag {self.lag_s:.2f} s, "
+                             f"dropped {result['dropped']}")
+
+    def publish(self, name, times, items, series):
+        # Before the captures are released, the raw frames are copies of the samples
+        if len(series["time"]):
+            self.publisher.publish_reflectance(name, series["time"], series["reflectance"])
+        for t, item in zip(times.tolist(), items):
+            self.publisher.publish_raw(name, t, sample_rate_hz(item), item[1][1])
+
+    def join(self, timeout=None):
+        self.p.join(timeout)
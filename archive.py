@@ -0,0 +1,191 @@
+# archive.py
+#
+# Append-only archive of raw captures for a run.
+#
+# Each run directory holds two files. captures.rtlr is a sequence of blocks, one per capture, each a fixed header
+# (capture index, start time, sample rate, sample count, length of a JSON settings string), the settings, then the
+# timebase, R and theta arrays as little-endian float64. Blocks are padded to 8 bytes so the arrays can be memory
+# mapped in place. captures.idx has one fixed-size record per capture pointing at its block, so any capture can be
+# found by number in O(1), or by time with a binary search.
+#
+# Blocks are written before their index record, so after a crash the index only ever points at complete blocks.
+# Should the data not have reached the disk, index records past the end of the data are ignored. Reopening an
+# archive for writing cuts off a partial block or index record left by a crash, and carries on from the last
+# complete capture. Writing happens on a background thread so the acquisition thread only pays for a queue put.
+#
+# David Lister
+# July 2023
+#
+
+import json
+import logging
+import os
+import queue
+import struct
+import threading
+import numpy as np
+
+logger = logging.getLogger("RTLR.archive")
+
+DATA_FILE = "captures.rtlr"
+INDEX_FILE = "captures.idx"
+BLOCK_MAGIC = b"CAPT"
+BLOCK_HEADER = struct.Struct("<4sQddII")  # magic, capture index, start time, sample rate, samples, settings length
+INDEX_DTYPE = np.dtype([("capture_index", "<u8"), ("start_time", "<f8"), ("sample_rate_hz", "<f8"),
+                        ("offset", "<u8"), ("n_samples", "<u4"), ("settings_length", "<u4")])
+CHANNELS = ("timebase", "r", "theta")
+
+
+def _padded(n):
+    return (n + 7) // 8 * 8
+
+
+def _block_ends(index):
+    # Offset just past each indexed block
+    header = (BLOCK_HEADER.size + index["settings_length"].astype(np.uint64) + 7) // 8 * 8
+    return index["offset"] + header + len(CHANNELS) * 8 * index["n_samples"].astype(np.uint64)
+
+
+def _complete(index, data_size):
+    # Number of leading index records whose blocks are wholly in a data file of data_size bytes
+    return int(np.searchsorted(_block_ends(index) > data_size, True))
+
+
+def count(run_dir):
+    # Captures indexed in a run's archive, 0 if it has none
+    path = os.path.join(run_dir, INDEX_FILE)
+    return os.path.getsize(path) // INDEX_DTYPE.itemsize if os.path.exists(path) else 0
+
+
+class ArchiveWriter:
+    def __init__(self, run_dir, max_pending=64):
+        self.data_path = os.path.join(run_dir, DATA_FILE)
+        self.index_path = os.path.join(run_dir, INDEX_FILE)
+        self._recover()
+        self.f_data = open(self.data_path, 'ab')
+        self.f_index = open(self.index_path, 'ab')
+        self.offset = self.f_data.tell()
+        self.queue = queue.Queue(max_pending)
+        self.captures_written = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def _recover(self):
+        # Cuts the files back to the last complete capture
+        if not os.path.exists(self.data_path):
+            return
+        data_size = os.path.getsize(self.data_path)
+        index_size = os.path.getsize(self.index_path) if os.path.exists(self.index_path) else 0
+        index = np.zeros(0, dtype=INDEX_DTYPE)
+        if index_size >= INDEX_DTYPE.itemsize:
+            index = np.fromfile(self.index_path, dtype=INDEX_DTYPE, count=index_size // INDEX_DTYPE.itemsize)
+        n = _complete(index, data_size)
+        end = int(_block_ends(index[:n])[-1]) if n else 0
+        if end < data_size or n * INDEX_DTYPE.itemsize < index_size:
+            logger.warning(f"Archive in {os.path.dirname(self.data_path)} ends in a partial capture, cutting it off")
+            os.truncate(self.data_path, end)
+            if index_size:
+                os.truncate(self.index_path, n * INDEX_DTYPE.itemsize)
+
+    def write(self, capture_index, start_time, sample_rate_hz, timebase, r, theta, settings=None):
+        # Hands the capture to the writer thread. Blocks only if max_pending captures are already waiting.
+        self.queue.put((capture_index, start_time, sample_rate_hz, timebase, r, theta, settings))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            try:
+                self._write_block(*item)
+            except OSError as e:
+                logger.error(f"Could not archive capture {item[0]}: {e}")
+
+    def _write_block(self, capture_index, start_time, sample_rate_hz, timebase, r, theta, settings):
+        n = min(len(timebase), len(r), len(theta))
+        settings = bytes(json.dumps(settings if settings is not None else {}), encoding="utf-8")
+        header = BLOCK_HEADER.pack(BLOCK_MAGIC, capture_index, start_time, sample_rate_hz, n, len(settings))
+        header = header + settings
+        header = header + bytes(_padded(len(header)) - len(header))
+        data = np.empty((len(CHANNELS), n), dtype='<f8')
+        data[0] = timebase[:n]
+        data[1] = r[:n]
+        data[2] = theta[:n]
+
+        self.f_data.write(header)
+        self.f_data.write(data.tobytes())
+        self.f_data.flush()
+
+        record = np.array([(capture_index, start_time, sample_rate_hz, self.offset, n, len(settings))],
+                          dtype=INDEX_DTYPE)
+        self.f_index.write(record.tobytes())
+        self.f_index.flush()
+        self.offset += len(header) + data.nbytes
+        self.captures_written += 1
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.f_data.close()
+        self.f_index.close()
+
+
+class ArchiveReader:
+    def __init__(self, run_dir):
+        self.data_path = os.path.join(run_dir, DATA_FILE)
+        self.index_path = os.path.join(run_dir, INDEX_FILE)
+        self.refresh()
+
+    def refresh(self):
+        # Maps whatever has been written so far, a partial trailing index record is ignored
+        n = os.path.getsize(self.index_path) // INDEX_DTYPE.itemsize if os.path.exists(self.index_path) else 0
+        if n == 0:
+            self.index = np.zeros(0, dtype=INDEX_DTYPE)
+            self.data = np.zeros(0, dtype=np.uint8)
+            return
+        self.index = np.memmap(self.index_path, dtype=INDEX_DTYPE, mode='r', shape=(n,))
+        self.data = np.memmap(self.data_path, dtype=np.uint8, mode='r')
+        self.index = self.index[:_complete(self.index, len(self.data))]
+
+    def __len__(self):
+        return len(self.index)
+
+    def header(self, i):
+        record = self.index[i]
+        start = int(record["offset"]) + BLOCK_HEADER.size
+        settings = bytes(self.data[start:start + int(record["settings_length"])])
+        return {"capture_index": int(record["capture_index"]),
+                "start_time": float(record["start_time"]),
+                "sample_rate_hz": float(record["sample_rate_hz"]),
+                "n_samples": int(record["n_samples"]),
+                "settings": json.loads(settings) if settings else {}}
+
+    def capture(self, i):
+        # Returns (timebase, r, theta) as views into the archive for the i-th capture in the file
+        record = self.index[i]
+        n = int(record["n_samples"])
+        start = int(record["offset"]) + _padded(BLOCK_HEADER.size + int(record["settings_length"]))
+        data = self.data[start:start + len(CHANNELS) * n * 8].view('<f8').reshape(len(CHANNELS), n)
+        return data[0], data[1], data[2]
+
+    def find_capture(self, capture_index):
+        # Position in the file of a capture number. Captures are numbered consecutively so this is usually direct.
+        if len(self.index) == 0:
+            raise KeyError(capture_index)
+        guess = capture_index - int(self.index[0]["capture_index"])
+        if 0 <= guess < len(self.index) and self.index[guess]["capture_index"] == capture_index:
+            return guess
+        matches = np.flatnonzero(self.index["capture_index"] == capture_index)
+        if len(matches) == 0:
+            raise KeyError(capture_index)
+        return int(matches[0])
+
+    def find_time(self, t):
+        # Position of the last capture starting at or before time t
+        return max(int(np.searchsorted(self.index["start_time"], t, side="right")) - 1, 0)
+
+    def between(self, t_start, t_stop):
+        # Positions of captures starting between t_start and t_stop
+        start_times = self.index["start_time"]
+        return range(int(np.searchsorted(start_times, t_start, side="left")),
+                     int(np.searchsorted(start_times, t_stop, side="right")))
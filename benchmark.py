@@ -0,0 +1,254 @@
+# benchmark.py
+#
+# Benchmarks for the acquisition and analysis pipeline.
+#
+# Micro-benchmarks time the individual hot paths (serial reads, buffer parsing, the reflectance calculation and
+# file output). The macro-benchmark replays a recorded capture through parse, reflectance and persistence for a
+# chosen span of simulated run time, with no real-time pacing. The plot benchmark times a GUI frame, on the offscreen
+# Qt platform unless another is set, with a history as long as the simulated run. Results are written as JSON so runs
+# on different commits can be compared with --compare.
+#
+# David Lister
+# July 2023
+#
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import common
+import reflectance
+import srs830
+import srs830_sim
+import transport
+import writer
+
+DEFAULT_RECORDING = os.path.join("Exploration",
+                                 "Series_2_750rpm_realigment_2_with_mask_5_normal_reserve_sens22_oflt6_freq321_cover_2.csv")
+PERCENTILES = (50, 90, 99)
+
+
+class ReplayPort:
+    # Port-like object that serves a fixed byte string, used to benchmark the transport without a device
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    @property
+    def in_waiting(self):
+        return len(self.data) - self.pos
+
+    def read(self, n):
+        out = self.data[self.pos:self.pos + n]
+        self.pos += len(out)
+        return out
+
+    def write(self, data):
+        pass
+
+    def close(self):
+        pass
+
+
+def load_recording(fname):
+    data = np.loadtxt(fname, delimiter=",", skiprows=1)
+    return data[:, 0], data[:, 1], data[:, 2]
+
+
+def calc_reflectance_inline(r):
+    # Reflectance calculation as it was done inline in MainWindow.update_graphs, kept as a baseline
+    mean = np.mean(r)
+    stdev = np.std(r)
+    upper_median = np.median(r[r > mean + stdev/2])
+    lower_median = np.median(r[r < mean - stdev/2])
+    match common.CALC_TYPE:
+        case common.CALC_PEAK_TO_PEAK:
+            return upper_median - lower_median
+        case _:
+            return upper_median
+
+
+def time_call(func, repeats):
+    # Returns per-call timings in seconds
+    out = np.empty(repeats)
+    for i in range(repeats):
+        t0 = time.perf_counter()
+        func()
+        out[i] = time.perf_counter() - t0
+    return out
+
+
+def summarise(timings):
+    out = {f"p{p}_ms": float(np.percentile(timings, p) * 1e3) for p in PERCENTILES}
+    out["mean_ms"] = float(np.mean(timings) * 1e3)
+    out["calls"] = len(timings)
+    return out
+
+
+def micro_benchmarks(r, repeats, out_dir):
+    results = {}
+    ascii_reply = bytes("".join(f"{v:.6e}," for v in r) + "\r", encoding="ascii")
+    lia_reply = srs830_sim.encode_lia(r)
+
+    def read_eol():
+        srs830.capture_until_eol(transport.Transport(ReplayPort(ascii_reply)))
+    results["capture_until_eol"] = summarise(time_call(read_eol, repeats))
+
+    results["parse_ascii"] = summarise(time_call(lambda: srs830.decode_ascii(ascii_reply[:-1]), repeats))
+    results["parse_lia"] = summarise(time_call(lambda: srs830.decode_lia(lia_reply), repeats))
+    results["reflectance_inline"] = summarise(time_call(lambda: calc_reflectance_inline(r), repeats))
+    results["reflectance"] = summarise(time_call(lambda: reflectance.calculate(r), repeats))
+    batch = np.resize(r, (64, len(r)))
+    results["reflectance_batch_64"] = summarise(time_call(lambda: reflectance.calculate_batch(batch), repeats))
+
+    timebase = np.arange(len(r)) / common.SRS830_CAPTURE_RATE_HZ
+    theta = np.zeros(len(r))
+    fname = os.path.join(out_dir, "capture.csv")
+    results["save_csv"] = summarise(time_call(lambda: srs830.save_csv(timebase, r, theta, fname), max(repeats // 10, 1)))
+
+    fname = os.path.join(out_dir, "Reflectance.csv")
+
+    def append_point():
+        with open(fname, 'a') as f:
+            f.write(f"{1.0},{0.5}\n")
+    results["reflectance_append"] = summarise(time_call(append_point, repeats))
+
+    w = writer.ResultWriter(os.path.join(out_dir, "Reflectance_buffered.csv"), ("time", "reflectance"))
+    results["reflectance_writer"] = summarise(time_call(lambda: w.write(1.0, 0.5), repeats))
+    w.close()
+    return results
+
+
+def macro_benchmark(r, hours, out_dir):
+    # Replays the recording as a stream of 1 s captures through parse, reflectance and persistence
+    n = int(common.SRS830_CAPTURE_TIME_S * common.SRS830_CAPTURE_RATE_HZ)
+    reply = srs830_sim.encode_lia(np.resize(r, n))
+    captures = int(hours * 3600 / common.SRS830_CAPTURE_TIME_S)
+    w = writer.ResultWriter(os.path.join(out_dir, "Reflectance.csv"), ("time", "reflectance"))
+    stages = {"parse": np.empty(captures), "reflectance": np.empty(captures), "persist": np.empty(captures)}
+
+    t_start = time.perf_counter()
+    for i in range(captures):
+        t0 = time.perf_counter()
+        data_r = srs830.decode_lia(reply)
+        t1 = time.perf_counter()
+        value = reflectance.calculate(data_r)
+        t2 = time.perf_counter()
+        w.write(i * common.SRS830_CAPTURE_TIME_S, value)
+        t3 = time.perf_counter()
+        stages["parse"][i] = t1 - t0
+        stages["reflectance"][i] = t2 - t1
+        stages["persist"][i] = t3 - t2
+    w.close()
+    elapsed = time.perf_counter() - t_start
+
+    results = {name: summarise(timings) for name, timings in stages.items()}
+    results["simulated_hours"] = hours
+    results["captures"] = captures
+    results["captures_per_s"] = captures / elapsed
+    return results
+
+
+def plot_benchmark(r, repeats, hours, out_dir):
+    # Times MainWindow.update_graphs plus the repaint it causes, one new capture per frame
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    from PySide6.QtWidgets import QApplication
+    import analysis
+    import gui
+    import pipeline
+
+    app = QApplication.instance() or QApplication([])
+    results_queue = pipeline.BoundedQueue(common.GUI_QUEUE_SIZE, common.GUI_QUEUE_POLICY,
+                                          merge=analysis.merge_results, name="GUI queue")
+    window = gui.MainWindow(results_queue, "benchmark", out_dir)
+    window.timer.stop()
+    window.show()
+    name = window.names[0]
+
+    # History as it would be at the end of the simulated run
+    captures = int(hours * 3600 / common.SRS830_CAPTURE_TIME_S)
+    window.histories[name].extend(np.arange(captures) * common.SRS830_CAPTURE_TIME_S, np.resize(r, captures))
+    timebase = np.arange(len(r)) / common.SRS830_CAPTURE_RATE_HZ
+    upper, lower = reflectance.split_medians(r)
+
+    def frame():
+        t = len(window.histories[name]) * common.SRS830_CAPTURE_TIME_S
+        results_queue.put({"series": {name: {"time": np.array([t]),
+                                             "reflectance": np.array([upper[0] - lower[0]]),
+                                             "film": None,
+                                             "raw_time": timebase,
+                                             "raw_voltage": r,
+                                             "upper_median": upper[0],
+                                             "lower_median": lower[0]}},
+                           "queue_depth": 0, "lag_s": 0.0, "dropped": 0})
+        window.update_graphs()
+        app.processEvents()
+
+    results = {"frame": summarise(time_call(frame, repeats)), "history_points": len(window.histories[name])}
+    window.close()
+    window.close_history()
+    return results
+
+
+def peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        rss /= 1024  # Bytes on macOS, kB elsewhere
+    return rss / 1024
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(new, old):
+    # Prints the ratio of new to old p50 latency for every stage both files share
+    for section in ("micro", "macro", "plot"):
+        for name, stats in new.get(section, {}).items():
+            old_stats = old.get(section, {}).get(name)
+            if isinstance(stats, dict) and isinstance(old_stats, dict) and old_stats.get("p50_ms"):
+                print(f"{section}.{name}: {stats['p50_ms']:.4f} ms vs {old_stats['p50_ms']:.4f} ms "
+                      f"({stats['p50_ms'] / old_stats['p50_ms']:.2f}x)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="RTLR pipeline benchmarks")
+    parser.add_argument("--recording", default=DEFAULT_RECORDING, help="Raw capture CSV to seed the benchmarks")
+    parser.add_argument("--repeats", type=int, default=200, help="Calls per micro-benchmark")
+    parser.add_argument("--hours", type=float, default=1, help="Simulated run time for the macro-benchmark")
+    parser.add_argument("--output", default=None, help="JSON results file")
+    parser.add_argument("--compare", default=None, help="Earlier JSON results file to compare against")
+    parser.add_argument("--no-plot", action="store_true", help="Skip the GUI frame benchmark")
+    args = parser.parse_args()
+
+    _, r, _ = load_recording(args.recording)
+    with tempfile.TemporaryDirectory() as out_dir:
+        results = {"commit": git_commit(),
+                   "date": datetime.datetime.now().isoformat(),
+                   "python": platform.python_version(),
+                   "numpy": np.__version__,
+                   "micro": micro_benchmarks(r, args.repeats, out_dir),
+                   "macro": macro_benchmark(r, args.hours, out_dir)}
+        if not args.no_plot:
+            results["plot"] = plot_benchmark(r, args.repeats, args.hours, out_dir)
+    results["peak_rss_mb"] = peak_rss_mb()
+
+    output = args.output if args.output is not None else f"benchmark_{results['commit']}.json"
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps(results, indent=2))
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
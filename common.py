@@ -8,14 +8,80 @@
 # General purpose
 DATA_SUBPATH = "DATA"
 SAVE_CALCULATED_REFLECTANCE = True
+SAVE_BINARY_REFLECTANCE = False  # Also write Reflectance.bin, float64 records
+
+# Result writers
+WRITER_FORMAT_CSV = "WRITER_FORMAT_CSV"
+WRITER_FORMAT_BINARY = "WRITER_FORMAT_BINARY"
+WRITER_FSYNC_NEVER = "WRITER_FSYNC_NEVER"  # Leave it to the OS, a power cut can lose more than one interval
+WRITER_FSYNC_ON_FLUSH = "WRITER_FSYNC_ON_FLUSH"
+WRITER_FSYNC = WRITER_FSYNC_ON_FLUSH
+WRITER_FLUSH_POINTS = 256  # Flush after this many buffered points
+WRITER_FLUSH_INTERVAL_S = 2  # or after this long, whichever comes first
 
 # Types of reflectance calculations
 CALC_PEAK_TO_PEAK = "CALC_PEAK_TO_PEAK"
 CALC_UPPER_MEDIAN = "CALC_AVERAGE"
+CALC_DEMODULATION = "CALC_DEMODULATION"  # Several points per capture, see demodulation.py
 CALC_TYPE = CALC_UPPER_MEDIAN
 
+# Sliding-window demodulation, used by CALC_DEMODULATION
+DEMOD_WINDOW_PERIODS = 4  # Chopper periods in each fitted window
+DEMOD_STEP_PERIODS = 1  # Chopper periods between windows, sets the time between reflectance points
+DEMOD_MIN_HZ = 1  # Band searched for the chopper frequency
+DEMOD_MAX_HZ = 200
+DEMOD_FREQ_TOLERANCE = 0.005  # Relative change of chopper frequency that rebuilds the fit
+DEMOD_HARMONICS = (1, 3)  # Fitted harmonics of the chopper, must include 1
+
 # Main Window
 WINDOW_UPDATE_RATE_MS = 500  # ms
+WINDOW_FRAME_BUDGET_MS = 50  # Frames slower than this draw fewer history points, down to WINDOW_MIN_PLOT_POINTS
+WINDOW_MIN_PLOT_POINTS = 1000
+
+# Reflectance history kept for plotting and analysis. Points beyond the budget spill to a memory-mapped file.
+HISTORY_RAM_BUDGET_MB = 64
+HISTORY_CHUNK_POINTS = 65536
+HISTORY_PLOT_POINTS = 20000  # Most points drawn per curve, the history in view is decimated to this
+
+# Performance metrics, see metrics.py
+METRICS_ENABLED = True
+METRICS_EXPORT_INTERVAL_S = 10  # Written to metrics.json in the run directory
+METRICS_SHOW_PANEL = True  # Dock panel in the main window
+METRICS_PANEL_UPDATE_S = 1
+
+# Queue backpressure policies
+QUEUE_POLICY_BLOCK = "QUEUE_POLICY_BLOCK"  # Producer waits for space
+QUEUE_POLICY_DROP_OLDEST = "QUEUE_POLICY_DROP_OLDEST"  # Oldest item is discarded
+QUEUE_POLICY_COALESCE = "QUEUE_POLICY_COALESCE"  # New item is merged into the newest queued item
+
+# Analysis
+ANALYSIS_QUEUE_SIZE = 64  # Raw captures waiting for analysis
+# Block or drop oldest. Not coalesce, rtlr.py refuses it: captures from several instruments, or with gaps between
+# bursts, cannot be merged into one
+ANALYSIS_QUEUE_POLICY = QUEUE_POLICY_BLOCK
+GUI_QUEUE_SIZE = 8  # Results waiting to be drawn
+GUI_QUEUE_POLICY = QUEUE_POLICY_COALESCE
+ANALYSIS_MAX_BATCH = 256  # Most captures processed in one pass
+ANALYSIS_REPORT_INTERVAL_S = 10  # How often queue depth and lag are logged
+
+# Thickness tracking, see thickness.py. Set the optics to match the laser and film being grown.
+TRACK_THICKNESS = True
+SAVE_THICKNESS = True
+THICKNESS_WAVELENGTH_NM = 632.8
+THICKNESS_REFRACTIVE_INDEX = 1.5  # Film
+THICKNESS_ANGLE_DEG = 0  # Angle of incidence
+THICKNESS_HYSTERESIS_FRACTION = 0.3  # Extremum confirmed when reflectance moves back by this much of the envelope
+THICKNESS_MIN_HYSTERESIS_V = 1e-4  # Should be above the reflectance noise
+THICKNESS_PERIOD_SMOOTHING = 0.3  # Weight of the newest half-period in the moving average
+
+# Live results stream for other processes, see publisher.py and subscriber.py. The address is a Unix socket path or a
+# (host, port) pair on loopback.
+PUBLISH_ENABLED = False
+PUBLISH_ADDRESS = ("127.0.0.1", 8830)
+PUBLISH_RAW = True  # Offer raw captures to subscribers that ask for them
+PUBLISH_BUFFER_FRAMES = 256  # Frames held for each subscriber before its oldest are dropped
+
+ANALYSIS_COMMAND_RAISE_END_FLAG = "ANALYSIS_COMMAND_RAISE_END_FLAG"
 
 # SRS830
 SRS830_CAPTURE_TIME_S = 1  #s
@@ -23,6 +89,8 @@ SRS830_STATE_INIT = "SRS830_STATE_INIT"
 SRS830_STATE_WAITING_FOR_SERIAL_PORT = "SRS830_STATE_WAITING_FOR_SERIAL_PORT"
 SRS830_STATE_RUN_CAPTURING_DATA = "SRS830_STATE_RUN_CAPTURING_DATA"
 SRS830_STATE_RUN_TRANSFERRING_DATA = "SRS830_STATE_RUN_TRANSFERRING_DATA"
+SRS830_STATE_RUN_STREAMING_DATA = "SRS830_STATE_RUN_STREAMING_DATA"
+SRS830_STATE_RUN_REPLAYING_DATA = "SRS830_STATE_RUN_REPLAYING_DATA"
 SRS830_STATE_RUN_ENDING = "SRS830_STATE_RUN_ENDING"
 
 SRS830_COMMAND_RAISE_END_FLAG = "SRS830_COMMAND_RAISE_END_FLAG"
@@ -32,8 +100,88 @@ SRS830_COMMAND_CLOSE_SERIAL_PORT = "SRS830_COMMAND_CLOSE_SERIAL_PORT"
 SRS830_COM_PORT = "COM4"
 SRS830_BAUD = 19200
 SRS830_TIMEOUT_S = 5
+SRS830_REPLY_TIMEOUT_S = 1  # For short replies such as status and settings queries
+SRS830_RECONNECT_INTERVAL_S = 1  # After a serial error the port is reopened at once, then at most this often
+SRS830_IDLE_POLL_S = 0.05  # How often a driver waiting for its port checks for commands
+
+# Configuration profiles, see profiles.py. Values are as the instrument reports them. Only settings that differ from
+# the instrument's are sent on connect, then the driver waits for the outputs to settle and the reference to lock.
+SRS830_PROFILES = {"default": {"FMOD": "1",  # Internal Freq reference
+                               "FREQ": "2345",  # Frequency 2.345 kHz
+                               "SLVL": "5",  # Amplitude to 5V RMS
+                               "ISRC": "0",  # Open ended voltage input
+                               "IGND": "1",  # Ground the PD
+                               "ICPL": "0",  # AC couple the input
+                               "RMOD": "1",  # Normal reserve
+                               "SENS": "24",  # Gain (higher number is higher range)
+                               "OFLT": "4",  # Time constant, 1 ms (higher number is larger time constant)
+                               "OFSL": "1",  # 12 dB/oct filter slope
+                               "HARM": "1",  # Detect at the fundamental
+                               "DDEF 1": "1,0",  # Ch1 display to R
+                               "DDEF 2": "1,0",  # Ch2 display to theta
+                               "SRAT": "13",  # Capture rate 512Hz
+                               "SEND": "0",  # Single shot capture
+                               "TSTR": "0"}}  # Hardware trigger disabled
+SRS830_PROFILE = "default"
+SRS830_SETTLE_MAX_S = 10  # Longest the driver waits for the outputs to settle after a change
+SRS830_READY_TIMEOUT_S = 5  # How long to wait for the reference to lock before capturing anyway
+SRS830_READY_POLL_S = 0.05
+
+# Lock-ins read concurrently, each by its own handler on its own port. Besides name and port, an entry can set
+# "profile" (name in SRS830_PROFILES or a profile dict, replaces SRS830_PROFILE), "replay_path" (replaces SRS830_REPLAY_PATH) and "wavelength_nm",
+# "refractive_index" and "angle_deg" (replace the THICKNESS_* optics for that instrument's tracker). With more than one, each gets its own results files and capture
+# directory, and their reflectance is also merged onto a common timebase, see merge.py.
+SRS830_INSTRUMENTS = [{"name": "srs830", "port": SRS830_COM_PORT}]
+SAVE_MERGED_REFLECTANCE = True
+MERGE_INTERVAL_S = SRS830_CAPTURE_TIME_S  # Spacing of the merged timebase
+MERGE_MAX_WAIT_S = 10  # Merged rows stop waiting for an instrument this far behind the others
 SRS830_CAPTURE_RATE_HZ = 512
 SRS830_SAVE_EACH_CAPTURE = False
+SRS830_SAVE_CSV = "SRS830_SAVE_CSV"  # One CSV file per capture
+SRS830_SAVE_ARCHIVE = "SRS830_SAVE_ARCHIVE"  # Indexed binary archive per run, see archive.py
+SRS830_SAVE_FORMAT = SRS830_SAVE_ARCHIVE
 SRS830_CAPTURE_PHASE = False
 
+# Buffer transfer formats. ASCII uses TRCA, the binary modes use fixed-size reads of 4 bytes per point.
+SRS830_TRANSFER_ASCII = "SRS830_TRANSFER_ASCII"  # TRCA, comma separated text
+SRS830_TRANSFER_IEEE = "SRS830_TRANSFER_IEEE"  # TRCB, little-endian IEEE float32
+SRS830_TRANSFER_LIA = "SRS830_TRANSFER_LIA"  # TRCL, 16-bit mantissa and exponent, fastest for the instrument
+SRS830_TRANSFER_MODE = SRS830_TRANSFER_LIA
+
+# Adaptive capture length and sample rate, see adaptive.py. SRS830_CAPTURE_TIME_S is the starting and nominal length,
+# the rate starts at the profile's SRAT. Rate changes apply between bursts, or at a buffer restart in continuous mode.
+SRS830_ADAPTIVE = False
+ADAPTIVE_TARGET_ERROR = 0.002  # Wanted standard error of each reflectance point, relative to the reflectance
+ADAPTIVE_MAX_CHANGE = 0.005  # Largest relative change of reflectance within one capture
+ADAPTIVE_MIN_TIME_S = 0.25
+ADAPTIVE_MAX_TIME_S = 8
+ADAPTIVE_MIN_RATE_INDEX = 10  # SRAT 10, 64 Hz, keeps several samples per chopper period
+ADAPTIVE_MAX_RATE_INDEX = 13  # SRAT 13, 512 Hz
+ADAPTIVE_MIN_SAMPLES = 64
+ADAPTIVE_MAX_STEP = 2  # Largest factor the capture time changes by from one capture to the next
+
+# Acquisition modes. Burst alternates capture and transfer, continuous reads the buffer while it keeps filling.
+SRS830_ACQUISITION_BURST = "SRS830_ACQUISITION_BURST"
+SRS830_ACQUISITION_CONTINUOUS = "SRS830_ACQUISITION_CONTINUOUS"
+SRS830_ACQUISITION_MODE = SRS830_ACQUISITION_BURST
+SRS830_BUFFER_POINTS = 16383  # Size of the instrument's data buffer
+SRS830_BUFFER_ROLLOVER_MARGIN_S = 4  # Continuous mode restarts the buffer when less than this much space is left
+
 SRS830_FAKE_SERIAL = False
+
+# asyncio driver, see srs830_async.py
+SRS830_USE_ASYNC = False
+SRS830_COMMAND_POLL_S = 0.01  # How often the asyncio driver checks for commands
+SRS830_QUIET_S = 0.05  # Input must be idle this long before the asyncio driver starts talking to the instrument
+
+# Acquisition in a separate process with captures handed over in shared memory, see acquisition.py
+SRS830_USE_PROCESS = False
+SHM_SLOTS = 16  # Captures that can be in flight between the acquisition process and analysis
+SHM_SLOT_SAMPLES = SRS830_BUFFER_POINTS + 1  # Largest capture held in a slot, bigger ones are pickled instead
+SHM_JOIN_TIMEOUT_S = 10  # Acquisition process is terminated if it has not ended this long after the end flag
+
+# Replay of recordings in place of the instrument, see replay.py
+REPLAY_AS_FAST_AS_POSSIBLE = 0
+SRS830_REPLAY_PATH = None  # Archive run directory, run directory of capture CSVs, or a single recording CSV
+SRS830_REPLAY_SPEED = 1  # Multiple of the original cadence, or REPLAY_AS_FAST_AS_POSSIBLE
+SRS830_REPLAY_LOOP = False
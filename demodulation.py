@@ -0,0 +1,120 @@
+# demodulation.py
+#
+# Sliding-window demodulation of the chopped R signal, for reflectance points faster than one per capture.
+#
+# The chopper turns R into a square wave between the dark and lit levels. Its frequency is found from the spectrum of
+# each capture, then R is fitted by least squares over overlapping windows of DEMOD_WINDOW_PERIODS chopper periods,
+# one every DEMOD_STEP_PERIODS periods. The basis is a constant, a linear drift, and a sine and cosine at each of
+# DEMOD_HARMONICS. For a square wave the fundamental has amplitude 2/pi of the lit minus dark step, so each window
+# gives the same quantity as CALC_PEAK_TO_PEAK.
+#
+# The fit is linear, so the pseudo-inverse of the basis is computed once and every window is a single matrix product.
+# It is only recomputed when the sample rate changes or the chopper frequency moves by more than
+# DEMOD_FREQ_TOLERANCE. Samples after the last full window are kept, so when the next capture follows on without a
+# gap (continuous acquisition) the windows run across the boundary. After a gap, as between bursts, they start again.
+#
+# David Lister
+# July 2023
+#
+
+import math
+import numpy as np
+import common
+
+SQUARE_WAVE_SCALE = math.pi / 2  # Lit minus dark step over the amplitude of its fundamental
+
+
+def detect_frequency(data_r, rate_hz, min_hz=common.DEMOD_MIN_HZ, max_hz=common.DEMOD_MAX_HZ):
+    # Chopper frequency from the largest spectral peak in the band, refined between bins, or None if there is none
+    n = len(data_r)
+    if n < 8:
+        return None
+    spectrum = np.abs(np.fft.rfft((data_r - np.mean(data_r)) * np.hanning(n)))
+    freqs = np.fft.rfftfreq(n, 1 / rate_hz)
+    band = np.flatnonzero((freqs >= min_hz) & (freqs <= min(max_hz, 0.45 * rate_hz)))
+    if len(band) == 0:
+        return None
+    k = band[np.argmax(spectrum[band])]
+    if spectrum[k] <= 0:
+        return None
+    if 0 < k < len(spectrum) - 1:
+        # Parabola through the log magnitudes of the peak and its neighbours
+        a, b, c = np.log(spectrum[k - 1:k + 2] + 1e-300)
+        denominator = a - 2 * b + c
+        if denominator < 0:
+            k = k + 0.5 * (a - c) / denominator
+    return float(k * rate_hz / n)
+
+
+def basis(window, cycles_per_sample, harmonics=common.DEMOD_HARMONICS):
+    # Columns: constant, drift, then cosine and sine of each harmonic
+    tau = np.arange(window) - (window - 1) / 2
+    columns = [np.ones(window), tau / window]
+    for h in harmonics:
+        phase = 2 * np.pi * h * cycles_per_sample * tau
+        columns += [np.cos(phase), np.sin(phase)]
+    return np.column_stack(columns)
+
+
+class Demodulator:
+    def __init__(self, window_periods=common.DEMOD_WINDOW_PERIODS, step_periods=common.DEMOD_STEP_PERIODS,
+                 freq_tolerance=common.DEMOD_FREQ_TOLERANCE, harmonics=common.DEMOD_HARMONICS):
+        self.window_periods = window_periods
+        self.step_periods = step_periods
+        self.freq_tolerance = freq_tolerance
+        self.harmonics = harmonics
+
+        self.freq_hz = None  # Chopper frequency the basis was built for
+        self.rate_hz = None
+        self.window = 0
+        self.step = 0
+        self.projection = None  # Rows of the pseudo-inverse that give the fundamental's cosine and sine
+
+        self.pending = np.zeros(0)  # Samples from the start of the next window
+        self.pending_time = 0.0  # Time of pending[0]
+        self.end_time = None  # Time just after the last sample received
+
+    def rebuild(self, freq_hz, rate_hz):
+        self.freq_hz = freq_hz
+        self.rate_hz = rate_hz
+        samples_per_period = rate_hz / freq_hz
+        self.window = max(int(round(self.window_periods * samples_per_period)), 4)
+        self.step = max(int(round(self.step_periods * samples_per_period)), 1)
+        fundamental = 2 + 2 * list(self.harmonics).index(1)
+        pseudo_inverse = np.linalg.pinv(basis(self.window, freq_hz / rate_hz, self.harmonics))
+        self.projection = pseudo_inverse[fundamental:fundamental + 2]
+
+    def process(self, start_time, rate_hz, data_r):
+        # Takes the next capture, returns (window centre times, reflectance) for every window completed by it
+        data_r = np.asarray(data_r, dtype=np.float64)
+        contiguous = (self.end_time is not None and rate_hz == self.rate_hz
+                      and abs(start_time - self.end_time) < 1.5 / rate_hz)
+        if contiguous:
+            self.pending = np.concatenate((self.pending, data_r))
+        else:
+            self.pending = data_r.copy()  # May be a shared memory slot that is about to be reused
+            self.pending_time = start_time
+        self.end_time = start_time + len(data_r) / rate_hz
+
+        freq_hz = detect_frequency(data_r, rate_hz)
+        if freq_hz is not None and (self.projection is None or rate_hz != self.rate_hz
+                                    or abs(freq_hz - self.freq_hz) > self.freq_tolerance * self.freq_hz):
+            self.rebuild(freq_hz, rate_hz)
+        if self.projection is None or rate_hz != self.rate_hz:
+            # No chopper frequency at this rate yet, only this capture is kept
+            self.pending = data_r.copy()
+            self.pending_time = start_time
+            return np.zeros(0), np.zeros(0)
+        if len(self.pending) < self.window:
+            return np.zeros(0), np.zeros(0)
+
+        n_windows = (len(self.pending) - self.window) // self.step + 1
+        windows = np.lib.stride_tricks.sliding_window_view(self.pending, self.window)[:n_windows * self.step:self.step]
+        cos_sin = windows @ self.projection.T
+        values = SQUARE_WAVE_SCALE * np.hypot(cos_sin[:, 0], cos_sin[:, 1])
+        times = self.pending_time + (np.arange(n_windows) * self.step + (self.window - 1) / 2) / rate_hz
+
+        consumed = n_windows * self.step
+        self.pending = self.pending[consumed:]
+        self.pending_time += consumed / rate_hz
+        return times, values
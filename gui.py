@@ -0,0 +1,205 @@
+# gui.py
+#
+# Main window for the Real Time Laser Reflectometry (RTLR) program.
+# Draws the reflectance history, the newest raw capture and the film estimates published by the analysis stage.
+# Only imported when the GUI is wanted, so headless runs never load Qt or pyqtgraph.
+#
+# David Lister
+# July 2023
+#
+
+import logging
+import time
+import random
+import numpy as np
+from PySide6 import QtGui, QtCore
+from PySide6.QtWidgets import QMainWindow, QPushButton, QGridLayout, QLabel, QWidget, QDockWidget
+import pyqtgraph as pg
+import common
+import history
+import metrics
+
+
+# Curve colours, one per instrument
+INSTRUMENT_COLOURS = [(20, 20, 20), (0, 90, 160), (0, 130, 60), (200, 110, 0), (120, 0, 140)]
+
+
+class MainWindow(QMainWindow):
+    def __init__(self, data_queue, run_name, run_dir, instruments=common.SRS830_INSTRUMENTS):
+        super().__init__()
+        self.logger = logging.getLogger("ProgramName.MainWindow")
+        self.logger.debug("Main window started")
+        self.run_name = run_name
+        self.run_dir = run_dir
+
+        self.setWindowTitle("Program Name")
+        self.colour = self.palette().color(QtGui.QPalette.Window)
+        self.main_pen = pg.mkPen(color=(20, 20, 20))
+        self.fit_pen = pg.mkPen(color=(153, 0, 0))
+        self.data_queue = data_queue
+        self.names = [settings["name"] for settings in instruments]
+        self.multi = len(self.names) > 1
+        self.pens = {name: pg.mkPen(color=INSTRUMENT_COLOURS[i % len(INSTRUMENT_COLOURS)])
+                     for i, name in enumerate(self.names)}
+
+        self.layout = QGridLayout()
+
+        self.plot_reflectance = pg.PlotWidget()
+        self.plot_reflectance.setBackground(self.colour)
+        self.plot_reflectance.setTitle("Reflectance")
+        self.plot_reflectance.setLabel("bottom", "Time (s)")
+        self.plot_reflectance.setLabel("left", "Reflectance (V)")
+        self.plot_reflectance.enableAutoRange()
+        # History grows without bound, so only draw what is in view, reduced to about one peak pair per pixel
+        self.plot_reflectance.setClipToView(True)
+        self.plot_reflectance.setDownsampling(auto=True, mode="peak")
+        if self.multi:
+            self.plot_reflectance.addLegend()
+        self.curves_reflectance = {name: self.plot_reflectance.plot(pen=self.pens[name], name=name)
+                                   for name in self.names}
+        self.plot_reflectance.getViewBox().sigXRangeChanged.connect(self.view_changed)
+
+        self.plot_raw = pg.PlotWidget()
+        self.plot_raw.setBackground(self.colour)
+        self.plot_raw.setTitle("Raw Signal")
+        self.plot_raw.setLabel("bottom", "Time (s)")
+        self.plot_raw.setLabel("left", "Voltage (V)")
+        self.plot_raw.enableAutoRange()
+        self.plot_raw.setClipToView(True)
+        self.plot_raw.setDownsampling(auto=True, mode="peak")
+        self.curves_raw = {name: self.plot_raw.plot(pen=self.pens[name]) for name in self.names}
+        self.curves_upper_median = {name: self.plot_raw.plot(pen=self.fit_pen) for name in self.names}
+        self.curves_lower_median = {name: self.plot_raw.plot(pen=self.fit_pen) for name in self.names}
+
+
+        self.layout.addWidget(self.plot_reflectance, 0, 0, 3, 4)
+        self.layout.addWidget(self.plot_raw, 3, 0, 3, 4)
+
+        self.label_film = QLabel("Thickness: -")
+        self.layout.addWidget(self.label_film, 6, 0, 1, 4)
+
+        self.widget = QWidget()
+        self.widget.setLayout(self.layout)
+        self.setCentralWidget(self.widget)
+
+        self.label_metrics = None
+        self.last_metrics_update = 0
+        if common.METRICS_SHOW_PANEL and metrics.enabled:
+            self.label_metrics = QLabel()
+            self.label_metrics.setFont(QtGui.QFontDatabase.systemFont(QtGui.QFontDatabase.FixedFont))
+            self.label_metrics.setAlignment(QtCore.Qt.AlignTop)
+            self.dock_metrics = QDockWidget("Performance", self)
+            self.dock_metrics.setWidget(self.label_metrics)
+            self.addDockWidget(QtCore.Qt.RightDockWidgetArea, self.dock_metrics)
+
+        self.init_time = time.time()
+
+        # The RAM budget is shared between the instruments
+        self.histories = {name: history.History(("time", "reflectance"),
+                                                ram_budget_bytes=common.HISTORY_RAM_BUDGET_MB * 2 ** 20 // len(self.names),
+                                                chunk_points=common.HISTORY_CHUNK_POINTS,
+                                                spill_dir=self.run_dir,
+                                                name=f"Reflectance_history_{name}" if self.multi else "Reflectance_history")
+                          for name in self.names}
+        self.films = {}
+        self.frame_time_s = 0
+        self.plot_points = common.HISTORY_PLOT_POINTS  # Lowered while frames go over WINDOW_FRAME_BUDGET_MS
+        
+        self.timer = QtCore.QTimer()
+        self.timer.timeout.connect(self.update_graphs)
+        self.timer.start(common.WINDOW_UPDATE_RATE_MS)
+
+
+    def update_metrics_panel(self):
+        snapshot = metrics.snapshot()
+        lines = [f"{'stage':<14}{'p50 ms':>9}{'p99 ms':>9}{'count':>9}"]
+        for name, stage in sorted(snapshot["stages"].items()):
+            lines.append(f"{name:<14}{stage['p50_ms']:>9.2f}{stage['p99_ms']:>9.2f}{stage['count']:>9}")
+        lines.append("")
+        for name, value in sorted(snapshot["counters"].items()) + sorted(snapshot["gauges"].items()):
+            lines.append(f"{name:<24}{value:>12.4g}")
+        self.label_metrics.setText("\n".join(lines))
+
+    def update_graphs(self):
+        frame_start = time.perf_counter()
+        data_added = False
+        raw = {}
+        if not common.SRS830_FAKE_SERIAL:
+            # Take everything the analysis stage has published since the last tick
+            results = self.data_queue.drain(timeout=0)
+            for result in results:
+                data_added = True
+                for name, series in result["series"].items():
+                    if name not in self.histories:
+                        continue
+                    self.histories[name].extend(series["time"], series["reflectance"])
+                    raw[name] = series
+                    if series["film"] is not None:
+                        self.films[name] = series["film"]
+
+            if data_added:
+                if self.films:
+                    self.label_film.setText("\n".join(
+                        (f"{name}: " if self.multi else "") +
+                        f"Thickness: {film['thickness_nm']:.1f} nm   "
+                        f"Growth rate: {film['growth_rate_nm_s']:.3f} nm/s   "
+                        f"Roughness: {film['roughness_nm']:.1f} nm   "
+                        f"Half fringes: {film['half_fringes']}" for name, film in self.films.items()))
+                if result["lag_s"] > 2 * common.SRS830_CAPTURE_TIME_S:
+                    self.logger.warning(f"Analysis is falling behind, lag {result['lag_s']:.2f} s, "
+                                        f"queue depth {result['queue_depth']}, dropped {result['dropped']}")
+
+        else:
+            self.logger.info("Adding fake data!")
+            data_added = True
+            self.histories[self.names[0]].append(time.time() - self.init_time, random.gauss(1, 0.3))
+
+        if self.label_metrics is not None and time.time() - self.last_metrics_update >= common.METRICS_PANEL_UPDATE_S:
+            self.last_metrics_update = time.time()
+            self.update_metrics_panel()
+
+        if data_added:
+            self.draw_history()
+
+            for name, series in raw.items():
+                if len(series["raw_time"]):
+                    self.curves_raw[name].setData(series["raw_time"], series["raw_voltage"])
+                    span = [series["raw_time"][0], series["raw_time"][-1]]
+                    self.curves_upper_median[name].setData(span, [series["upper_median"]] * 2)
+                    self.curves_lower_median[name].setData(span, [series["lower_median"]] * 2)
+
+            self.frame_time_s = time.perf_counter() - frame_start
+            metrics.stop("plot", frame_start if metrics.enabled else None)
+            self.fit_budget()
+
+    def fit_budget(self):
+        # Halves the points drawn per curve after a frame over budget, and restores them once frames are well under
+        frame_ms = self.frame_time_s * 1000
+        if frame_ms > common.WINDOW_FRAME_BUDGET_MS and self.plot_points > common.WINDOW_MIN_PLOT_POINTS:
+            self.plot_points = max(self.plot_points // 2, common.WINDOW_MIN_PLOT_POINTS)
+            self.logger.warning(f"Frame took {frame_ms:.1f} ms, budget is {common.WINDOW_FRAME_BUDGET_MS} ms, "
+                                f"drawing at most {self.plot_points} points per curve")
+        elif frame_ms < common.WINDOW_FRAME_BUDGET_MS / 4 and self.plot_points < common.HISTORY_PLOT_POINTS:
+            self.plot_points = min(self.plot_points * 2, common.HISTORY_PLOT_POINTS)
+        metrics.gauge("plot_points", self.plot_points)
+
+    def draw_history(self):
+        # Only the time range in view, at most plot_points per curve, so a frame does not read the whole history
+        # back from the spill files
+        view = self.plot_reflectance.getViewBox()
+        t_start, t_stop = -np.inf, np.inf
+        if not view.autoRangeEnabled()[0]:
+            x0, x1 = view.viewRange()[0]
+            margin = (x1 - x0) / 2  # So a small pan shows data before the next redraw
+            t_start, t_stop = x0 - margin, x1 + margin
+        for name, h in self.histories.items():
+            self.curves_reflectance[name].setData(*h.decimated(t_start, t_stop, self.plot_points))
+
+    def view_changed(self, *args):
+        # Zooming or panning by hand needs the newly visible part of the history
+        if not self.plot_reflectance.getViewBox().autoRangeEnabled()[0]:
+            self.draw_history()
+
+    def close_history(self):
+        for h in self.histories.values():
+            h.close()
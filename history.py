@@ -0,0 +1,148 @@
+# history.py
+#
+# Bounded-memory store for long time series such as the reflectance history.
+#
+# Each column is a typed NumPy array. New points go into an in-memory block that grows by doubling until the RAM
+# budget is reached. After that the oldest points are moved, a chunk at a time, to one file per column that is
+# read back through a memory map. Appends are amortized O(1). Slices that fall entirely in memory or entirely in
+# the spill files are views, so plotting or analysing a time range does not copy unless it crosses the boundary.
+# For drawing, decimated returns at most a given number of points of a time range, so the cost of a frame stays the
+# same however long the history grows.
+#
+# David Lister
+# July 2023
+#
+
+import logging
+import os
+import numpy as np
+
+logger = logging.getLogger("RTLR.history")
+
+
+class History:
+    def __init__(self, columns=("time", "reflectance"), dtype=np.float64, ram_budget_bytes=64 * 2 ** 20,
+                 chunk_points=2 ** 16, spill_dir=None, name="history", keep_spill=False):
+        # The first column is the time axis and must be non-decreasing
+        self.columns = tuple(columns)
+        self.dtype = np.dtype(dtype)
+        self.chunk_points = chunk_points
+        self.spill_dir = spill_dir
+        self.name = name
+        self.keep_spill = keep_spill
+        self.max_ram_points = max(chunk_points, ram_budget_bytes // (self.dtype.itemsize * len(self.columns)))
+
+        self.ram = {c: np.empty(min(chunk_points, self.max_ram_points), dtype=self.dtype) for c in self.columns}
+        self.n_ram = 0
+        self.n_spilled = 0
+        self.spilled = {c: np.empty(0, dtype=self.dtype) for c in self.columns}
+        self.spill_paths = {}
+        if self.spill_dir is not None:
+            self.spill_paths = {c: os.path.join(self.spill_dir, f"{self.name}.{c}.{self.dtype.str[1:]}")
+                                for c in self.columns}
+            for path in self.spill_paths.values():
+                open(path, 'wb').close()
+
+    def __len__(self):
+        return self.n_spilled + self.n_ram
+
+    def nbytes_ram(self):
+        return sum(a.nbytes for a in self.ram.values())
+
+    def append(self, *values):
+        self.extend(*([v] for v in values))
+
+    def extend(self, *arrays):
+        arrays = [np.asarray(a, dtype=self.dtype) for a in arrays]
+        k = len(arrays[0])
+        if k == 0:
+            return
+        self._reserve(k)
+        for c, a in zip(self.columns, arrays):
+            self.ram[c][self.n_ram:self.n_ram + k] = a
+        self.n_ram += k
+
+    def _reserve(self, k):
+        capacity = len(self.ram[self.columns[0]])
+        if self.n_ram + k <= capacity:
+            return
+
+        if self.n_ram + k > self.max_ram_points and self.spill_dir is not None:
+            # Move whole chunks of the oldest points to disk, at least half of memory so spills stay infrequent
+            need = self.n_ram + k - self.max_ram_points
+            n = max(need, self.n_ram // 2)
+            n = min(-(-n // self.chunk_points) * self.chunk_points, self.n_ram)
+            if n:
+                self._spill(n)
+            if self.n_ram + k <= capacity:
+                return
+
+        size = max(self.n_ram + k, 2 * capacity)
+        if self.spill_dir is not None:
+            size = max(min(size, self.max_ram_points), self.n_ram + k)
+        for c in self.columns:
+            grown = np.empty(size, dtype=self.dtype)
+            grown[:self.n_ram] = self.ram[c][:self.n_ram]
+            self.ram[c] = grown
+
+    def _spill(self, n):
+        for c in self.columns:
+            with open(self.spill_paths[c], 'ab') as f:
+                self.ram[c][:n].tofile(f)
+            self.ram[c][:self.n_ram - n] = self.ram[c][n:self.n_ram]
+        self.n_ram -= n
+        self.n_spilled += n
+        self.spilled = {c: np.memmap(self.spill_paths[c], dtype=self.dtype, mode='r', shape=(self.n_spilled,))
+                        for c in self.columns}
+        logger.debug(f"Spilled {n} points of {self.name}, {self.n_spilled} on disk")
+
+    def slice(self, start=0, stop=None):
+        # Returns a tuple with one array per column for points start to stop. Views unless the range spans both
+        # the spill files and memory.
+        n = len(self)
+        stop = n if stop is None else min(stop, n)
+        start = min(max(start, 0), stop)
+        if stop <= self.n_spilled:
+            return tuple(self.spilled[c][start:stop] for c in self.columns)
+        if start >= self.n_spilled:
+            return tuple(self.ram[c][start - self.n_spilled:stop - self.n_spilled] for c in self.columns)
+        return tuple(np.concatenate((self.spilled[c][start:], self.ram[c][:stop - self.n_spilled]))
+                     for c in self.columns)
+
+    def index_of(self, t, side="left"):
+        # Index of time t in the time column, as np.searchsorted
+        time_column = self.columns[0]
+        in_spill = self.n_ram == 0 or t < self.ram[time_column][0] or (side == "left" and t == self.ram[time_column][0])
+        if self.n_spilled and in_spill:
+            return int(np.searchsorted(self.spilled[time_column], t, side))
+        return self.n_spilled + int(np.searchsorted(self.ram[time_column][:self.n_ram], t, side))
+
+    def time_range(self, t_start=-np.inf, t_stop=np.inf):
+        # Points with t_start <= time <= t_stop
+        return self.slice(self.index_of(t_start, "left"), self.index_of(t_stop, "right"))
+
+    def decimated(self, t_start=-np.inf, t_stop=np.inf, max_points=10000):
+        # Points with t_start <= time <= t_stop, every k-th one if there are more than max_points. The strided
+        # slices are views, so only the points returned are read from the spill files and the cost does not grow
+        # with the length of the history.
+        start, stop = self.index_of(t_start, "left"), self.index_of(t_stop, "right")
+        step = max(1, -(-(stop - start) // max_points))
+        if step == 1:
+            return self.slice(start, stop)
+        parts = []
+        if start < self.n_spilled:
+            parts.append([self.spilled[c][start:min(stop, self.n_spilled):step] for c in self.columns])
+        ram_start = max(start, self.n_spilled)
+        ram_start += (start - ram_start) % step  # Keep the stride going across the boundary
+        if ram_start < stop:
+            parts.append([self.ram[c][ram_start - self.n_spilled:stop - self.n_spilled:step] for c in self.columns])
+        if (stop - 1 - start) % step:
+            parts.append(self.slice(stop - 1, stop))  # The newest point is always drawn
+        return tuple(np.concatenate(column) for column in zip(*parts))
+
+    def close(self):
+        self.spilled = {c: np.empty(0, dtype=self.dtype) for c in self.columns}
+        if not self.keep_spill:
+            for path in self.spill_paths.values():
+                if os.path.exists(path):
+                    os.remove(path)
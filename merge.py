@@ -0,0 +1,63 @@
+# merge.py
+#
+# Time-aligns the reflectance series of several instruments onto a common timebase.
+#
+# Each instrument produces reflectance points at its own capture times. The merged timebase is a regular grid with
+# spacing MERGE_INTERVAL_S, and each instrument is linearly interpolated onto it. A grid point is only emitted once
+# every instrument has data past it, so rows are never revised. An instrument that has fallen more than
+# MERGE_MAX_WAIT_S behind the newest data is not waited for, and is NaN in the rows emitted without it.
+#
+# David Lister
+# July 2023
+#
+
+import math
+import numpy as np
+import common
+
+
+class Merger:
+    def __init__(self, names, interval_s=common.MERGE_INTERVAL_S, max_wait_s=common.MERGE_MAX_WAIT_S):
+        self.names = list(names)
+        self.interval_s = interval_s
+        self.max_wait_s = max_wait_s
+        self.times = {name: np.zeros(0) for name in self.names}
+        self.values = {name: np.zeros(0) for name in self.names}
+        self.next_index = None  # Grid index of the next row to emit
+
+    def add(self, name, times, values):
+        self.times[name] = np.concatenate((self.times[name], times))
+        self.values[name] = np.concatenate((self.values[name], values))
+
+    def watermark(self):
+        # Latest time every instrument that is keeping up has reached
+        latest = [self.times[name][-1] for name in self.names if len(self.times[name])]
+        if not latest:
+            return None
+        newest = max(latest)
+        return min(t for t in latest if t >= newest - self.max_wait_s)
+
+    def pop(self):
+        # Returns the grid times ready to emit and a dict of name to values on them
+        watermark = self.watermark()
+        if watermark is None:
+            return np.zeros(0), {name: np.zeros(0) for name in self.names}
+        if self.next_index is None:
+            first = min(self.times[name][0] for name in self.names if len(self.times[name]))
+            self.next_index = math.ceil(first / self.interval_s)
+
+        last_index = math.floor(watermark / self.interval_s)
+        grid = np.arange(self.next_index, last_index + 1) * self.interval_s
+        self.next_index = max(self.next_index, last_index + 1)
+
+        merged = {}
+        for name in self.names:
+            times, values = self.times[name], self.values[name]
+            if len(times):
+                merged[name] = np.interp(grid, times, values, left=np.nan, right=np.nan)
+                # Keep the last point before the next grid time for the next interpolation
+                keep = max(np.searchsorted(times, self.next_index * self.interval_s) - 1, 0)
+                self.times[name], self.values[name] = times[keep:], values[keep:]
+            else:
+                merged[name] = np.full(len(grid), np.nan)
+        return grid, merged
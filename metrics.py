@@ -0,0 +1,164 @@
+# metrics.py
+#
+# Low-overhead metrics for the hot paths.
+#
+# Stages are timed with start() and stop() around the work, using the monotonic perf_counter. Timings go into
+# histograms with fixed log-spaced bins, so recording is O(1) and memory does not grow. Counters and gauges cover
+# totals (bytes transferred, samples dropped) and current values (queue depth, duty cycle). Everything is kept in
+# memory and written to metrics.json in the run directory by export() or by an Exporter thread.
+#
+# When common.METRICS_ENABLED is False, start() returns None and every other call returns straight away.
+#
+# David Lister
+# July 2023
+#
+
+import json
+import logging
+import math
+import os
+import threading
+import time
+import common
+
+logger = logging.getLogger("RTLR.metrics")
+
+BINS_PER_DECADE = 10
+MIN_SECONDS = 1e-6
+N_BINS = 8 * BINS_PER_DECADE + 2  # 1 us to 100 s, plus underflow and overflow
+
+enabled = common.METRICS_ENABLED
+lock = threading.Lock()
+histograms = {}
+counters = {}
+gauges = {}
+
+
+class Histogram:
+    def __init__(self):
+        self.bins = [0] * N_BINS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        if seconds < MIN_SECONDS:
+            i = 0
+        else:
+            i = min(int(math.log10(seconds / MIN_SECONDS) * BINS_PER_DECADE) + 1, N_BINS - 1)
+        self.bins[i] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p):
+        # Upper edge of the bin holding the p-th percentile
+        target = self.count * p / 100
+        seen = 0
+        for i, n in enumerate(self.bins):
+            seen += n
+            if seen >= target and n:
+                return min(MIN_SECONDS * 10 ** (i / BINS_PER_DECADE), self.max)
+        return self.max
+
+    def summary(self):
+        return {"count": self.count,
+                "mean_ms": self.total / self.count * 1e3 if self.count else 0.0,
+                "p50_ms": self.percentile(50) * 1e3,
+                "p90_ms": self.percentile(90) * 1e3,
+                "p99_ms": self.percentile(99) * 1e3,
+                "max_ms": self.max * 1e3}
+
+
+def set_enabled(state):
+    global enabled
+    enabled = state
+
+
+def start():
+    if not enabled:
+        return None
+    return time.perf_counter()
+
+
+def stop(name, t0):
+    # Records the time since t0 against name
+    if t0 is None or not enabled:
+        return
+    elapsed = time.perf_counter() - t0
+    with lock:
+        h = histograms.get(name)
+        if h is None:
+            h = histograms[name] = Histogram()
+        h.record(elapsed)
+
+
+def lap(name, t0):
+    # Records the time since t0 against name and returns a new start for the next stage
+    if t0 is None or not enabled:
+        return None
+    stop(name, t0)
+    return time.perf_counter()
+
+
+def count(name, n=1):
+    if not enabled:
+        return
+    with lock:
+        counters[name] = counters.get(name, 0) + n
+
+
+def gauge(name, value):
+    if not enabled:
+        return
+    gauges[name] = value
+
+
+def snapshot():
+    with lock:
+        return {"time": time.time(),
+                "stages": {name: h.summary() for name, h in histograms.items()},
+                "counters": dict(counters),
+                "gauges": dict(gauges)}
+
+
+def reset():
+    with lock:
+        histograms.clear()
+        counters.clear()
+        gauges.clear()
+
+
+def export(path):
+    # Written to a temporary file and renamed, so readers never see a partial file
+    tmp = path + ".tmp"
+    with open(tmp, 'w') as f:
+        json.dump(snapshot(), f, indent=2)
+    os.replace(tmp, path)
+
+
+class Exporter:
+    def __init__(self, run_dir, interval_s=common.METRICS_EXPORT_INTERVAL_S, filename="metrics.json"):
+        self.path = os.path.join(run_dir, filename)
+        self.interval_s = interval_s
+        self.flagEnd = threading.Event()
+        self.p = threading.Thread(target=self.run, daemon=True)
+        self.p.start()
+
+    def run(self):
+        while not self.flagEnd.wait(self.interval_s):
+            self.export()
+        self.export()
+
+    def export(self):
+        if not enabled:
+            return
+        try:
+            export(self.path)
+        except OSError as e:
+            logger.warning(f"Could not export metrics: {e}")
+
+    def join(self, timeout=None):
+        self.flagEnd.set()
+        self.p.join(timeout)
@@ -0,0 +1,76 @@
+# pipeline.py
+#
+# Bounded queues for passing data between the acquisition, analysis and GUI stages.
+#
+# A full queue is handled by its backpressure policy: block waits for space, drop-oldest discards the oldest item
+# to make room, and coalesce merges the new item into the newest queued one with a merge function. Depth, peak depth
+# and drop counts are tracked so the stages can report when they are falling behind.
+#
+# David Lister
+# July 2023
+#
+
+import logging
+import queue
+import common
+import metrics
+
+logger = logging.getLogger("RTLR.pipeline")
+
+
+class BoundedQueue(queue.Queue):
+    def __init__(self, maxsize=0, policy=common.QUEUE_POLICY_BLOCK, merge=None, name="queue", on_drop=None):
+        # on_drop is called with each item discarded by the drop-oldest policy
+        super().__init__(maxsize)
+        if policy == common.QUEUE_POLICY_COALESCE and merge is None:
+            raise ValueError("Coalescing queue needs a merge function")
+        self.policy = policy
+        self.merge = merge
+        self.on_drop = on_drop
+        self.name = name
+        self.dropped = 0
+        self.coalesced = 0
+        self.peak_depth = 0
+
+    def put(self, item, block=True, timeout=None):
+        if self.policy == common.QUEUE_POLICY_BLOCK or self.maxsize <= 0:
+            super().put(item, block, timeout)
+
+        else:
+            with self.mutex:
+                if self._qsize() >= self.maxsize:
+                    if self.policy == common.QUEUE_POLICY_COALESCE:
+                        self.queue[-1] = self.merge(self.queue[-1], item)
+                        self.coalesced += 1
+                        metrics.count(f"coalesced.{self.name}")
+                        self.not_empty.notify()
+                        return
+
+                    dropped = self.queue.popleft()
+                    if self.on_drop is not None:
+                        self.on_drop(dropped)
+                    self.dropped += 1
+                    metrics.count(f"dropped.{self.name}")
+                    if self.dropped == 1 or self.dropped % 100 == 0:
+                        logger.warning(f"{self.name} is full, {self.dropped} items dropped so far")
+
+                self._put(item)
+                self.unfinished_tasks += 1
+                self.not_empty.notify()
+
+        depth = self.qsize()
+        if depth > self.peak_depth:
+            self.peak_depth = depth
+
+    def drain(self, max_items=None, timeout=None):
+        # Waits up to timeout for the first item, then returns everything queued (up to max_items) as a list
+        try:
+            items = [self.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while max_items is None or len(items) < max_items:
+            try:
+                items.append(self.get_nowait())
+            except queue.Empty:
+                break
+        return items
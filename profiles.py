@@ -0,0 +1,93 @@
+# profiles.py
+#
+# Configuration profiles for the SRS830.
+#
+# A profile maps setting names to values as the instrument reports them, e.g. {"SENS": "24", "DDEF 1": "1,0"}. Keys
+# with a number after the name are indexed settings, sent as "DDEF 1,1,0" and queried as "DDEF ? 1". Profiles are
+# defined in common.SRS830_PROFILES. On connect the drivers query every setting in the profile in one batch and send
+# only the ones that differ, so reconnecting to an instrument that is already configured changes nothing.
+#
+# After a change the outputs need time to settle. Following the SR830 manual, the output is within 1% of its final
+# value after 5, 7, 9 or 10 time constants for a 6, 12, 18 or 24 dB/oct filter slope.
+#
+# David Lister
+# July 2023
+#
+
+import math
+import common
+
+# Settings that do not disturb the outputs, so changing only these needs no settling time
+NO_SETTLING = {"DDEF", "SRAT", "SEND", "TSTR", "OUTX"}
+
+# Time constants to settle to 1%, by OFSL slope index
+SETTLING_TIME_CONSTANTS = [5, 7, 9, 10]
+
+# LIAS status bits
+STATUS_INPUT_OVERLOAD = 0x01
+STATUS_FILTER_OVERLOAD = 0x02
+STATUS_OUTPUT_OVERLOAD = 0x04
+STATUS_UNLOCKED = 0x08
+
+
+def get(profile):
+    # A profile by name from common.SRS830_PROFILES, or a profile dict as it is
+    if isinstance(profile, str):
+        return common.SRS830_PROFILES[profile]
+    return profile
+
+
+def _split(key):
+    name, _, index = key.partition(" ")
+    return name, index
+
+
+def query_command(key):
+    name, index = _split(key)
+    return f"{name} ? {index}" if index else f"{name} ?"
+
+
+def set_command(key, value):
+    name, index = _split(key)
+    return f"{name} {index},{value}" if index else f"{name} {value}"
+
+
+def same_value(a, b):
+    # Compares numerically where possible, the instrument may report "2345.000" for "2345"
+    a_parts = str(a).strip().split(",")
+    b_parts = str(b).strip().split(",")
+    if len(a_parts) != len(b_parts):
+        return False
+    for x, y in zip(a_parts, b_parts):
+        try:
+            if not math.isclose(float(x), float(y), rel_tol=1e-6, abs_tol=1e-9):
+                return False
+        except ValueError:
+            if x.strip() != y.strip():
+                return False
+    return True
+
+
+def differences(profile, current):
+    # Keys of the profile whose value differs from current, in profile order
+    return [key for key, value in profile.items() if key not in current or not same_value(value, current[key])]
+
+
+def rate_hz(srat):
+    # SRAT 0 is 62.5 mHz, each step doubles up to 512 Hz at SRAT 13
+    return 0.0625 * 2 ** int(srat)
+
+
+def time_constant_s(oflt):
+    # OFLT 0 is 10 us, then alternately x3 and x3.33 (10 us, 30 us, 100 us, ...) up to 30 ks
+    oflt = int(oflt)
+    return 10e-6 * (3 if oflt % 2 else 1) * 10 ** (oflt // 2)
+
+
+def settling_time_s(changed, settings):
+    # Time to wait after changing the given keys, settings holds the OFLT and OFSL in effect
+    if all(_split(key)[0] in NO_SETTLING for key in changed):
+        return 0.0
+    slope = min(int(settings.get("OFSL", 3)), len(SETTLING_TIME_CONSTANTS) - 1)
+    settle_s = SETTLING_TIME_CONSTANTS[slope] * time_constant_s(settings.get("OFLT", 10))
+    return min(settle_s, common.SRS830_SETTLE_MAX_S)
@@ -0,0 +1,225 @@
+# publisher.py
+#
+# Streams live results to other processes over a local socket.
+#
+# The analysis stage publishes every reflectance point, and optionally every raw capture, to all connected
+# subscribers. The address is a path for a Unix socket or a (host, port) pair for TCP on loopback. Each subscriber
+# has its own sending thread and a buffer of PUBLISH_BUFFER_FRAMES frames. When a subscriber falls behind its oldest
+# frames are dropped, so a slow reader never holds up the analysis or the GUI. Each frame is encoded once, whatever
+# the number of subscribers.
+#
+# Framing, all little-endian. Every frame starts with a header: magic "RT", version, frame type and payload length
+# (2s B B I). The payloads are:
+#   HELLO        init time (d), then the run name in UTF-8. Sent first on every connection, times in the other frames
+#                are seconds since the init time.
+#   REFLECTANCE  name length (B), point count (I), instrument name, count float64 times, count float64 reflectances
+#   RAW          name length (B), sample count (I), start time (d), sample rate (d), instrument name, count float32 R
+# After connecting a subscriber may send one byte of SUBSCRIBE_* bits to choose what it receives, otherwise it gets
+# reflectance only. subscriber.py is the client.
+#
+# David Lister
+# July 2023
+#
+
+import collections
+import logging
+import os
+import socket
+import struct
+import threading
+import numpy as np
+import common
+import metrics
+
+MAGIC = b"RT"
+VERSION = 1
+HEADER = struct.Struct("<2sBBI")
+HELLO = struct.Struct("<d")
+REFLECTANCE = struct.Struct("<BI")
+RAW = struct.Struct("<BIdd")
+
+FRAME_HELLO = 0
+FRAME_REFLECTANCE = 1
+FRAME_RAW = 2
+
+SUBSCRIBE_REFLECTANCE = 0x01
+SUBSCRIBE_RAW = 0x02
+SUBSCRIBE_WAIT_S = 1  # How long a new subscriber has to send its subscription byte
+
+
+def frame(frame_type, payload):
+    return HEADER.pack(MAGIC, VERSION, frame_type, len(payload)) + payload
+
+
+def encode_hello(init_time, run_name):
+    return frame(FRAME_HELLO, HELLO.pack(init_time) + run_name.encode("utf-8"))
+
+
+def encode_reflectance(name, times, values):
+    name = name.encode("utf-8")
+    times = np.ascontiguousarray(times, dtype="<f8")
+    values = np.ascontiguousarray(values, dtype="<f8")
+    return frame(FRAME_REFLECTANCE, REFLECTANCE.pack(len(name), len(times)) + name + times.tobytes() + values.tobytes())
+
+
+def encode_raw(name, start_time, rate_hz, data_r):
+    name = name.encode("utf-8")
+    data_r = np.ascontiguousarray(data_r, dtype="<f4")
+    return frame(FRAME_RAW, RAW.pack(len(name), len(data_r), start_time, rate_hz) + name + data_r.tobytes())
+
+
+def open_socket(address):
+    # A string is a Unix socket path, anything else a TCP address
+    if isinstance(address, str):
+        return socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    return socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+
+class Subscription:
+    def __init__(self, publisher, con, peer, buffer_frames, hello):
+        # hello is sent before anything buffered, so it cannot be dropped however far behind the subscriber starts
+        self.p = threading.Thread(target=self.run, daemon=True)
+        self.publisher = publisher
+        self.con = con
+        self.peer = peer
+        self.hello = hello
+        self.mask = SUBSCRIBE_REFLECTANCE
+        self.frames = collections.deque(maxlen=buffer_frames)
+        self.ready = threading.Condition()
+        self.dropped = 0
+        self.closed = False
+
+    def offer(self, data, kind):
+        if self.closed or not self.mask & kind:
+            return
+        with self.ready:
+            if len(self.frames) == self.frames.maxlen:
+                self.dropped += 1
+                metrics.count("dropped.publisher")
+            self.frames.append(data)
+            self.ready.notify()
+
+    def read_mask(self):
+        self.con.settimeout(SUBSCRIBE_WAIT_S)
+        try:
+            mask = self.con.recv(1)
+            if mask:
+                self.mask = mask[0]
+        except socket.timeout:
+            pass
+        self.con.settimeout(None)
+
+    def run(self):
+        try:
+            self.read_mask()
+            self.con.sendall(self.hello)
+            while True:
+                with self.ready:
+                    while not self.frames and not self.closed:
+                        self.ready.wait()
+                    if self.closed:
+                        break
+                    data = self.frames.popleft()
+                self.con.sendall(data)
+        except OSError as e:
+            if not self.closed:
+                self.publisher.logger.info(f"Subscriber {self.peer} disconnected: {e}")
+        self.close()
+        self.publisher.remove(self)
+
+    def close(self):
+        with self.ready:
+            self.closed = True
+            self.ready.notify()
+        try:
+            self.con.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.con.close()
+
+
+class Publisher:
+    def __init__(self, run_name, init_time, address=common.PUBLISH_ADDRESS,
+                 buffer_frames=common.PUBLISH_BUFFER_FRAMES, raw=common.PUBLISH_RAW):
+        # raw controls whether raw captures are offered at all, subscribers still have to ask for them
+        self.p = threading.Thread(target=self.run)
+        self.logger = logging.getLogger("RTLR.publisher.Publisher")
+        self.address = address
+        self.buffer_frames = buffer_frames
+        self.raw = raw
+        self.hello = encode_hello(init_time, run_name)
+        self.subscriptions = []
+        self.lock = threading.Lock()
+
+        if isinstance(address, str) and os.path.exists(address):
+            os.unlink(address)  # Left over from a run that did not shut down
+        self.server = open_socket(address)
+        if not isinstance(address, str):
+            self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(address)
+        self.server.listen()
+        self.server.settimeout(0.2)
+
+        # Flags
+        self.flagEnd = False
+
+        # Start the thread!
+        self.p.start()
+
+    def run(self):
+        self.logger.info(f"Publishing on {self.address}")
+        while not self.flagEnd:
+            try:
+                con, peer = self.server.accept()
+            except socket.timeout:
+                continue
+            except OSError as e:
+                if not self.flagEnd:
+                    self.logger.error(f"Error accepting subscribers: {e}")
+                break
+            con.settimeout(None)
+            subscription = Subscription(self, con, peer or str(self.address), self.buffer_frames, self.hello)
+            with self.lock:
+                self.subscriptions.append(subscription)
+            subscription.p.start()
+            self.logger.info(f"Subscriber {subscription.peer} connected")
+            metrics.gauge("publisher_subscribers", len(self.subscriptions))
+        self.logger.info("Ending Publisher")
+
+    def remove(self, subscription):
+        with self.lock:
+            if subscription in self.subscriptions:
+                self.subscriptions.remove(subscription)
+        metrics.gauge("publisher_subscribers", len(self.subscriptions))
+
+    def wants(self, kind):
+        if kind == SUBSCRIBE_RAW and not self.raw:
+            return False
+        with self.lock:
+            return any(subscription.mask & kind for subscription in self.subscriptions)
+
+    def publish(self, data, kind):
+        with self.lock:
+            subscriptions = list(self.subscriptions)
+        for subscription in subscriptions:
+            subscription.offer(data, kind)
+
+    def publish_reflectance(self, name, times, values):
+        if self.wants(SUBSCRIBE_REFLECTANCE):
+            self.publish(encode_reflectance(name, times, values), SUBSCRIBE_REFLECTANCE)
+
+    def publish_raw(self, name, start_time, rate_hz, data_r):
+        # Encoding copies the samples, so a shared memory slot can be released straight after
+        if self.wants(SUBSCRIBE_RAW):
+            self.publish(encode_raw(name, start_time, rate_hz, data_r), SUBSCRIBE_RAW)
+
+    def join(self, timeout=None):
+        self.flagEnd = True
+        self.p.join(timeout)
+        self.server.close()
+        with self.lock:
+            subscriptions = list(self.subscriptions)
+        for subscription in subscriptions:
+            subscription.close()
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.unlink(self.address)
@@ -0,0 +1,128 @@
+# reflectance.py
+#
+# Reflectance calculations on raw lock-in captures.
+#
+# The raw R signal is chopped, so it alternates between a lit level and a dark level. The upper and lower medians
+# are the medians of the samples more than half a standard deviation above and below the mean. Calculation types
+# from common.py are registered as estimators, each taking a batch of captures as a 2-D array (one capture per row)
+# and returning one value per capture. Estimators built on the medians take those instead, so callers that also want
+# the medians get them without a second pass. New estimators are added with the register decorator.
+# CALC_DEMODULATION gives several values per capture, see demodulation.py. Through this interface, which has no state
+# from one capture to the next, it gives the mean of each capture's windows instead. The live analysis and
+# reprocess.py run a demodulation.Demodulator over the captures in order to keep every window.
+#
+# David Lister
+# July 2023
+#
+
+import numpy as np
+import common
+import demodulation
+
+ESTIMATORS = {}
+VERSIONS = {}
+FROM_MEDIANS = set()  # Estimators that take the upper and lower medians instead of the batch
+WITH_RATES = set()  # Estimators that also take the sample rate of each capture
+
+
+def register(calc_type, version=1, from_medians=False, with_rates=False):
+    # Bump version whenever an estimator's output changes, so cached reprocessed results are regenerated
+    def decorator(func):
+        ESTIMATORS[calc_type] = func
+        VERSIONS[calc_type] = version
+        if from_medians:
+            FROM_MEDIANS.add(calc_type)
+        if with_rates:
+            WITH_RATES.add(calc_type)
+        return func
+    return decorator
+
+
+def _select_median(part, first, k):
+    # Median of the k values of part with sorted ranks first to first + k - 1. Partitions part in place so that
+    # everything after the median is no smaller than it. Returns the median and the rank of its lower middle value.
+    low = first + (k - 1) // 2
+    part.partition(low)
+    value = part[low]
+    if k % 2 == 0:
+        value = (value + part[low + 1:].min()) / 2
+    return value, low
+
+
+def split_medians(batch):
+    # Returns the upper and lower medians of each capture in batch, same values as
+    # np.median(r[r > mean + stdev/2]) and np.median(r[r < mean - stdev/2])
+    batch = np.atleast_2d(np.asarray(batch, dtype=np.float64))
+    n = batch.shape[1]
+    mean = np.mean(batch, axis=1, keepdims=True)
+    stdev = np.std(batch, axis=1, keepdims=True)
+    n_upper = np.count_nonzero(batch > mean + stdev/2, axis=1)
+    n_lower = np.count_nonzero(batch < mean - stdev/2, axis=1)
+
+    # The samples above the upper threshold are the n_upper largest, so their median is an order statistic of the
+    # whole capture and can be found by selection instead of masking and sorting
+    upper = np.full(len(batch), np.nan)
+    lower = np.full(len(batch), np.nan)
+    for i, row in enumerate(batch):
+        part = row.copy()
+        start = 0
+        if n_lower[i]:
+            lower[i], start = _select_median(part, 0, n_lower[i])
+        if n_upper[i]:
+            # The upper ranks all lie after the lower median, so only that part of the row needs selecting
+            upper[i], _ = _select_median(part[start:], n - n_upper[i] - start, n_upper[i])
+    return upper, lower
+
+
+@register(common.CALC_PEAK_TO_PEAK, from_medians=True)
+def peak_to_peak(upper, lower):
+    return upper - lower
+
+
+@register(common.CALC_UPPER_MEDIAN, from_medians=True)
+def upper_median(upper, lower):
+    return upper
+
+
+@register(common.CALC_DEMODULATION, version=3, with_rates=True)
+def demodulated(batch, rates_hz):
+    # One value per capture, the mean of its windows, each capture demodulated on its own
+    out = np.full(len(batch), np.nan)
+    for i, (row, rate_hz) in enumerate(zip(batch, rates_hz)):
+        _, values = demodulation.Demodulator().process(0.0, float(rate_hz), row)
+        if len(values):
+            out[i] = np.mean(values)
+    return out
+
+
+def calculate_batch_medians(batch, calc_type=None, rates_hz=None):
+    # Reflectance of each capture in batch, with the upper and lower medians when the estimator used them (else None).
+    # Captures of unequal length are passed as a list and handled one by one. rates_hz is the sample rate of each
+    # capture, default SRS830_CAPTURE_RATE_HZ for all of them.
+    if calc_type is None:
+        calc_type = common.CALC_TYPE
+    estimator = ESTIMATORS[calc_type]
+    if rates_hz is None:
+        rates_hz = np.full(len(batch), common.SRS830_CAPTURE_RATE_HZ)
+    if isinstance(batch, (list, tuple)) and len({len(r) for r in batch}) > 1:
+        rows = [calculate_batch_medians(np.atleast_2d(r), calc_type, rates_hz[i:i + 1]) for i, r in enumerate(batch)]
+        values = np.concatenate([row[0] for row in rows])
+        if calc_type not in FROM_MEDIANS:
+            return values, None, None
+        return values, np.concatenate([row[1] for row in rows]), np.concatenate([row[2] for row in rows])
+    if calc_type in WITH_RATES:
+        return estimator(np.atleast_2d(batch), rates_hz), None, None
+    if calc_type not in FROM_MEDIANS:
+        return estimator(np.atleast_2d(batch)), None, None
+    upper, lower = split_medians(batch)
+    return estimator(upper, lower), upper, lower
+
+
+def calculate_batch(batch, calc_type=None, rates_hz=None):
+    # Reflectance of each capture in batch
+    return calculate_batch_medians(batch, calc_type, rates_hz)[0]
+
+
+def calculate(r, calc_type=None):
+    # Reflectance of a single capture
+    return float(calculate_batch(np.atleast_2d(r), calc_type)[0])
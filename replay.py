@@ -0,0 +1,158 @@
+# replay.py
+#
+# Replay of recorded captures into the live pipeline.
+#
+# A ReplaySource stands in for the instrument. It reads captures from a run's archive (captures.rtlr), from a run
+# directory of per-capture CSV files, or from a single long CSV like the recordings in Exploration/, which is cut
+# into captures of SRS830_CAPTURE_TIME_S. The SRS830Handler pulls captures from it and publishes them exactly as it
+# would after a serial transfer. Captures are released at the original cadence, at a multiple of it, or as fast as
+# the pipeline takes them.
+#
+# David Lister
+# July 2023
+#
+
+import datetime
+import json
+import logging
+import os
+import time
+import numpy as np
+import archive
+import common
+
+logger = logging.getLogger("RTLR.replay")
+
+RUN_INFO_FILE = "run.json"  # Name and start time of the run, written by rtlr.py
+
+
+def run_init_time(run_dir):
+    # Start of the run, which result times are measured from
+    with open(os.path.join(run_dir, RUN_INFO_FILE)) as f:
+        return json.load(f)["init_time"]
+
+
+def archive_captures(run_dir):
+    # Yields (start_time, timebase, r, theta, sample_rate_hz) from a run archive
+    reader = archive.ArchiveReader(run_dir)
+    for i in range(len(reader)):
+        timebase, r, theta = reader.capture(i)
+        record = reader.index[i]
+        yield float(record["start_time"]), timebase, r, theta, float(record["sample_rate_hz"])
+
+
+def capture_files(run_dir):
+    # Per-capture files are named "<thread cycle>--<date>", sorted by thread cycle
+    names = [n for n in os.listdir(run_dir) if "--" in n and n.split("--")[0].isdigit()]
+    return sorted(names, key=lambda n: int(n.split("--")[0]))
+
+
+def has_captures(run_dir):
+    return os.path.exists(os.path.join(run_dir, archive.INDEX_FILE)) or bool(capture_files(run_dir))
+
+
+def instrument_dirs(run_dir):
+    # A run with several instruments keeps each one's captures in a subdirectory named after it
+    dirs = {}
+    for name in sorted(os.listdir(run_dir)):
+        path = os.path.join(run_dir, name)
+        if os.path.isdir(path) and has_captures(path):
+            dirs[name] = path
+    return dirs
+
+
+def instrument_path(path, name):
+    # Where the captures for instrument name are in a recording. An instrument missing from a run with several
+    # replays the first one there.
+    if not os.path.isdir(path) or has_captures(path):
+        return path
+    dirs = instrument_dirs(path)
+    if name in dirs:
+        return dirs[name]
+    if dirs:
+        first = next(iter(dirs))
+        logger.warning(f"No instrument {name} in {path}, replaying {first}")
+        return dirs[first]
+    return path
+
+
+def _load_csv(path):
+    data = np.loadtxt(path, delimiter=",", skiprows=1, ndmin=2)
+    timebase = data[:, 0]
+    rate = 1 / np.median(np.diff(timebase)) if len(timebase) > 1 else common.SRS830_CAPTURE_RATE_HZ
+    return timebase, data[:, 1], data[:, 2], float(rate)
+
+
+def run_csv_captures(run_dir):
+    # Capture start times come from the file names, which have one second resolution
+    for name in capture_files(run_dir):
+        timebase, r, theta, rate = _load_csv(os.path.join(run_dir, name))
+        stamp = datetime.datetime.strptime(name.split("--")[1], "%Y-%m-%d_%H-%M-%S")
+        yield stamp.timestamp(), timebase, r, theta, rate
+
+
+def recording_captures(path, capture_time_s=common.SRS830_CAPTURE_TIME_S):
+    # Cuts a single long recording into consecutive captures, the last one may be shorter
+    timebase, r, theta, rate = _load_csv(path)
+    n = max(int(round(capture_time_s * rate)), 1)
+    for start in range(0, len(r), n):
+        stop = min(start + n, len(r))
+        yield start / rate, np.arange(stop - start) / rate, r[start:stop], theta[start:stop], rate
+
+
+def open_captures(path):
+    if os.path.isdir(path):
+        if os.path.exists(os.path.join(path, archive.INDEX_FILE)):
+            return archive_captures(path)
+        return run_csv_captures(path)
+    return recording_captures(path)
+
+
+class ReplaySource:
+    def __init__(self, path, speed=common.SRS830_REPLAY_SPEED, loop=False):
+        # speed is a multiple of the original cadence, or REPLAY_AS_FAST_AS_POSSIBLE
+        self.path = path
+        self.speed = speed
+        self.loop = loop
+        self.captures = open_captures(path)
+        self.first_start = None  # Original start time of the first capture in this pass
+        self.wall_start = None
+        self.pass_offset = 0  # Replay time at which this pass began
+        self.pass_end = 0  # Replay time at the end of the latest capture
+        self.elapsed = 0  # Replay time at the start of the latest capture
+        self.replayed = 0
+
+    def next_capture(self):
+        # Returns (original start time, timebase, r, theta, sample rate), or None when the recording is finished.
+        # Sleeps as needed to keep to the requested cadence.
+        capture = next(self.captures, None)
+        if capture is None and self.loop and self.replayed:
+            self.captures = open_captures(self.path)
+            self.first_start = None
+            self.pass_offset = self.pass_end
+            capture = next(self.captures, None)
+        if capture is None:
+            return None
+
+        if self.first_start is None:
+            self.first_start = capture[0]
+        if self.wall_start is None:
+            self.wall_start = time.time()
+        self.elapsed = self.pass_offset + capture[0] - self.first_start
+        self.pass_end = self.elapsed + len(capture[2]) / capture[4]
+
+        if self.speed != common.REPLAY_AS_FAST_AS_POSSIBLE:
+            # A capture is released once the whole of it would have been recorded
+            delay = self.wall_start + self.pass_end / self.speed - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+        self.replayed += 1
+        return capture
+
+    def start_time(self):
+        # Start of the latest capture on the replay clock, keeping the recorded spacing scaled by speed. As fast as
+        # possible keeps the recorded spacing as it is.
+        if self.speed == common.REPLAY_AS_FAST_AS_POSSIBLE:
+            return self.wall_start + self.elapsed
+        return self.wall_start + self.elapsed / self.speed
@@ -0,0 +1,256 @@
+# reprocess.py
+#
+# Headless batch reprocessing of recorded runs.
+#
+# Recalculates reflectance for every run directory under a data path, using the same estimators as the live
+# analysis stage. Runs are read from their raw capture archive (captures.rtlr, see archive.py) or, for older runs,
+# from the per-capture CSV files. Captures are split into blocks and spread over a process pool, each worker memory
+# mapping the archive itself, so nothing but the results cross the process boundary.
+#
+# A cache file in each run directory records the size and modification time of the inputs, a hash of them and the
+# estimator version used. Runs whose inputs and estimator are unchanged are skipped unless --force is given. Only runs
+# whose sizes or times have changed are hashed, and that is done in the pool, so a copied or touched run that is
+# otherwise unchanged is still skipped without the parent reading every archive.
+#
+# Result times are measured from the start of the run recorded in its run.json, as the live results are. With
+# CALC_DEMODULATION every window is written with its own time, as live, rather than one value per capture.
+#
+# Usage: python reprocess.py DATA [--workers N] [--calc-type CALC_PEAK_TO_PEAK] [--binary] [--force]
+#
+# David Lister
+# July 2023
+#
+
+import argparse
+import concurrent.futures
+import datetime
+import hashlib
+import json
+import logging
+import os
+import time
+import numpy as np
+import archive
+import common
+import demodulation
+import reflectance
+import replay
+import writer
+
+logger = logging.getLogger("RTLR.reprocess")
+
+CACHE_FILE = "reprocess_cache.json"
+OUTPUT_NAME = "Reflectance_reprocessed"
+BLOCK_CAPTURES = 2048  # Captures per worker task
+
+
+def find_runs(data_path):
+    # Returns (captures directory, output path without extension) for every set of captures. A run directory holds
+    # an archive or per-capture CSV files, or with several instruments a subdirectory of them for each. Their
+    # results go in the run directory with the instrument name added, as the live results do.
+    runs = []
+    for name in sorted(os.listdir(data_path)):
+        run_dir = os.path.join(data_path, name)
+        if not os.path.isdir(run_dir):
+            continue
+        if replay.has_captures(run_dir):
+            runs.append((run_dir, os.path.join(run_dir, OUTPUT_NAME)))
+        for instrument, instrument_dir in replay.instrument_dirs(run_dir).items():
+            runs.append((instrument_dir, os.path.join(run_dir, f"{OUTPUT_NAME}_{instrument}")))
+    return runs
+
+
+def input_files(run_dir):
+    if os.path.exists(os.path.join(run_dir, archive.INDEX_FILE)):
+        return [archive.INDEX_FILE, archive.DATA_FILE]
+    return replay.capture_files(run_dir)
+
+
+def input_stat(run_dir):
+    # Cheap check for changed inputs, the name, size and modification time of each file
+    stats = []
+    for name in input_files(run_dir):
+        st = os.stat(os.path.join(run_dir, name))
+        stats.append([name, st.st_size, st.st_mtime_ns])
+    return stats
+
+
+def input_hash(run_dir):
+    # Worker task, reads every input file
+    h = hashlib.sha256()
+    for name in input_files(run_dir):
+        h.update(bytes(name, encoding="utf-8"))
+        with open(os.path.join(run_dir, name), 'rb') as f:
+            while chunk := f.read(2 ** 20):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+def load_cache(run_dir):
+    try:
+        with open(os.path.join(run_dir, CACHE_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_cache(run_dir, cache):
+    with open(os.path.join(run_dir, CACHE_FILE), 'w') as f:
+        json.dump(cache, f, indent=2)
+
+
+def unchanged(run_dir, cache, key, check="input_stat"):
+    # True if the cache matches key on check and the estimator settings, and its output is still there
+    keys = [check, "calc_type", "estimator_version", "format"]
+    return all(cache.get(k) == key[k] for k in keys) \
+        and os.path.exists(os.path.join(run_dir, cache.get("output", "")))
+
+
+def run_init_time(run_dir):
+    try:
+        return replay.run_init_time(run_dir)
+    except (OSError, ValueError, KeyError) as e:
+        logger.warning(f"No start time for {run_dir}, times are from its first capture: {e}")
+        return None
+
+
+def block_reflectance(start_times, captures, rates, calc_type, lead_in=None):
+    # Returns (times, reflectance). Demodulation runs across the block's captures like the live analysis, giving every
+    # window. lead_in is the (start_time, capture, rate) before the block, so windows run on from it as they did live.
+    if calc_type != common.CALC_DEMODULATION:
+        return start_times, reflectance.calculate_batch(captures, calc_type, rates)
+    demodulator = demodulation.Demodulator()
+    if lead_in is not None:
+        demodulator.process(lead_in[0], lead_in[2], lead_in[1])
+    points = [demodulator.process(t, rate, r) for t, r, rate in zip(start_times.tolist(), captures, rates.tolist())]
+    return np.concatenate([p[0] for p in points]), np.concatenate([p[1] for p in points])
+
+
+def process_archive_block(run_dir, start, stop, calc_type):
+    # Worker task, returns (times, reflectance) for archive captures start to stop
+    reader = archive.ArchiveReader(run_dir)
+    captures = [reader.capture(i)[1] for i in range(start, stop)]
+    start_times = np.array(reader.index["start_time"][start:stop])
+    rates = np.array(reader.index["sample_rate_hz"][start:stop])
+    lead_in = None
+    if start > 0 and calc_type == common.CALC_DEMODULATION:
+        lead_in = (float(reader.index["start_time"][start - 1]), reader.capture(start - 1)[1],
+                   float(reader.index["sample_rate_hz"][start - 1]))
+    return block_reflectance(start_times, captures, rates, calc_type, lead_in)
+
+
+def load_csv_capture(run_dir, name):
+    # Returns (start_time, r, sample_rate_hz). Start times come from the file name, which has one second resolution.
+    data = np.loadtxt(os.path.join(run_dir, name), delimiter=",", skiprows=1, ndmin=2)
+    rate = 1 / np.median(np.diff(data[:, 0])) if len(data) > 1 else common.SRS830_CAPTURE_RATE_HZ
+    stamp = datetime.datetime.strptime(name.split("--")[1], "%Y-%m-%d_%H-%M-%S")
+    return stamp.timestamp(), data[:, 1], rate
+
+
+def process_csv_block(run_dir, names, calc_type, lead_in_name=None):
+    # Worker task for older runs
+    loaded = [load_csv_capture(run_dir, name) for name in names]
+    lead_in = None
+    if lead_in_name is not None and calc_type == common.CALC_DEMODULATION:
+        lead_in = load_csv_capture(run_dir, lead_in_name)
+    return block_reflectance(np.array([c[0] for c in loaded]), [c[1] for c in loaded],
+                             np.array([c[2] for c in loaded]), calc_type, lead_in)
+
+
+def submit_run(pool, run_dir, calc_type):
+    # Splits a run into blocks of captures, returns the futures in capture order
+    futures = []
+    if os.path.exists(os.path.join(run_dir, archive.INDEX_FILE)):
+        n = len(archive.ArchiveReader(run_dir))
+        for start in range(0, n, BLOCK_CAPTURES):
+            futures.append(pool.submit(process_archive_block, run_dir, start, min(start + BLOCK_CAPTURES, n),
+                                       calc_type))
+    else:
+        names = replay.capture_files(run_dir)
+        for start in range(0, len(names), BLOCK_CAPTURES):
+            futures.append(pool.submit(process_csv_block, run_dir, names[start:start + BLOCK_CAPTURES], calc_type,
+                                       names[start - 1] if start > 0 else None))
+    return futures
+
+
+def write_run(output, futures, fmt, init_time=None):
+    # Times are from the start of the run as the live results are, or from the first capture if that is not known
+    if fmt == common.WRITER_FORMAT_BINARY:
+        path = output + ".bin"
+    else:
+        path = output + ".csv"
+    w = writer.ResultWriter(path, ("time", "reflectance"), header="Time (s),Reflectance (v)", fmt=fmt,
+                            flush_points=2 ** 16, fsync=common.WRITER_FSYNC_NEVER)
+    t0 = init_time
+    for future in futures:
+        times, values = future.result()
+        if len(times) == 0:
+            continue
+        if t0 is None:
+            t0 = times[0]
+        w.write(times - t0, values)
+    w.close()
+    return path
+
+
+def reprocess(data_path, workers=None, calc_type=None, fmt=common.WRITER_FORMAT_CSV, force=False):
+    if calc_type is None:
+        calc_type = common.CALC_TYPE
+    version = reflectance.VERSIONS[calc_type]
+    runs = find_runs(data_path)
+    logger.info(f"Found {len(runs)} runs in {data_path}")
+
+    # Runs whose input sizes and times match the cache are skipped straight away, the rest are hashed in the pool
+    todo = []
+    skipped = 0
+    t_start = time.time()
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        hashes = {}
+        for run_dir, output in runs:
+            key = {"input_stat": input_stat(run_dir), "calc_type": calc_type, "estimator_version": version,
+                   "format": fmt}
+            cache = load_cache(run_dir)
+            if not force and unchanged(run_dir, cache, key):
+                logger.info(f"Skipping unchanged run {run_dir}")
+                skipped += 1
+                continue
+            hashes[pool.submit(input_hash, run_dir)] = (run_dir, output, key, cache)
+
+        # Blocks are submitted as each hash arrives, so blocks from all runs keep the pool busy, then collected
+        # run by run
+        submitted = []
+        for future in concurrent.futures.as_completed(hashes):
+            run_dir, output, key, cache = hashes[future]
+            key["input_hash"] = future.result()
+            if not force and unchanged(run_dir, cache, key, "input_hash"):
+                logger.info(f"Skipping unchanged run {run_dir}, only its file times changed")
+                cache["input_stat"] = key["input_stat"]
+                save_cache(run_dir, cache)
+                skipped += 1
+                continue
+            submitted.append((run_dir, output, key, submit_run(pool, run_dir, calc_type)))
+
+        for run_dir, output, key, futures in submitted:
+            path = write_run(output, futures, fmt, run_init_time(os.path.dirname(output)))
+            key["output"] = os.path.relpath(path, run_dir)  # Relative to the cache, outside it for an instrument
+            save_cache(run_dir, key)
+            logger.info(f"Wrote {path}")
+            todo.append(run_dir)
+
+    logger.info(f"Reprocessed {len(todo)} runs in {time.time() - t_start:.1f} s, skipped {skipped}")
+    return todo
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recalculate reflectance for recorded runs")
+    parser.add_argument("data_path", nargs="?", default=common.DATA_SUBPATH)
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes, default is one per core")
+    parser.add_argument("--calc-type", default=None, choices=sorted(reflectance.ESTIMATORS),
+                        help="Estimator, default is common.CALC_TYPE")
+    parser.add_argument("--binary", action="store_true", help="Write binary output instead of CSV")
+    parser.add_argument("--force", action="store_true", help="Reprocess runs even if unchanged")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    reprocess(args.data_path, args.workers, args.calc_type,
+              common.WRITER_FORMAT_BINARY if args.binary else common.WRITER_FORMAT_CSV, args.force)
@@ -1,26 +1,35 @@
 # rtlr.py
 #
 # Main for the Real Time Laser Reflectometry (RTLR) program.
-# Opens GUI window and threads for interfacing with the lock-in amplifier.
+# Starts the threads for interfacing with the lock-in amplifier and for analysis, then opens the GUI window. With
+# --headless there is no window and Qt is never imported, the run continues until interrupted or --duration passes.
 #
 # David Lister
 # July 2023
 #
 
+import time
+startup_time = time.time()  # Start of the program, for the time to the first capture
+
+import argparse
+import json
 import logging
-#import multiprocessing
+import multiprocessing
 import queue
-import numpy as np
-import time
 import datetime
 import os
-from PySide6 import QtGui, QtCore
-from PySide6.QtWidgets import QApplication, QMainWindow, QPushButton, QGridLayout, QLabel, QWidget
-import pyqtgraph as pg
+import signal
 import sys
-import random
+import threading
 import common
+import acquisition
+import analysis
+import metrics
+import pipeline
+import publisher
+import replay
 import srs830
+import srs830_async
 
 
 logger = logging.getLogger("RTLR")
@@ -32,130 +41,150 @@ ch.setFormatter(formatter)
 logger.addHandler(ch)
 
 logger.debug("Logger Started")
-class MainWindow(QMainWindow):
-    def __init__(self, data_queue, run_name, run_dir):
-        super().__init__()
-        self.logger = logging.getLogger("ProgramName.MainWindow")
-        self.logger.debug("Main window started")
-        self.run_name = run_name
-        self.run_dir = run_dir
-
-        self.setWindowTitle("Program Name")
-        self.colour = self.palette().color(QtGui.QPalette.Window)
-        self.main_pen = pg.mkPen(color=(20, 20, 20))
-        self.fit_pen = pg.mkPen(color=(153, 0, 0))
-        self.data_queue = data_queue
-
-        self.layout = QGridLayout()
-
-        self.plot_reflectance = pg.PlotWidget()
-        self.plot_reflectance.setBackground(self.colour)
-        self.plot_reflectance.setTitle("Reflectance")
-        self.plot_reflectance.setLabel("bottom", "Time (s)")
-        self.plot_reflectance.setLabel("left", "Reflectance (V)")
-        self.plot_reflectance.enableAutoRange()
-
-        self.plot_raw = pg.PlotWidget()
-        self.plot_raw.setBackground(self.colour)
-        self.plot_raw.setTitle("Raw Signal")
-        self.plot_raw.setLabel("bottom", "Time (s)")
-        self.plot_raw.setLabel("left", "Voltage (V)")
-        self.plot_raw.enableAutoRange()
-
-
-        self.layout.addWidget(self.plot_reflectance, 0, 0, 3, 4)
-        self.layout.addWidget(self.plot_raw, 3, 0, 3, 4)
-
-        self.widget = QWidget()
-        self.widget.setLayout(self.layout)
-        self.setCentralWidget(self.widget)
-
-        self.init_time = time.time()
-
-        self.time = []
-        self.reflectance = []
-        self.save_file_name = os.path.join(self.run_dir, "Reflectance.csv")
-
-        self.raw_time = []
-        self.raw_voltage = []
-
-        if common.SAVE_CALCULATED_REFLECTANCE:
-            with open(self.save_file_name, 'w') as f:
-                f.write("Time (s),Reflectance (v)\n")
-        
-        self.timer = QtCore.QTimer()
-        self.timer.timeout.connect(self.update_graphs)
-        self.timer.start(common.WINDOW_UPDATE_RATE_MS)
-
-
-    def update_graphs(self):
-        data_added = False
-        if not common.SRS830_FAKE_SERIAL:
-            if not self.data_queue.empty():
-                print("Data in the queue!")
-                data_added = True
-                data = self.data_queue.get_nowait()
-                self.time.append(data[0] - self.init_time)
-                self.raw_time = data[1][0]
-                self.raw_voltage = data[1][1]
-
-                r = self.raw_voltage
-                mean = np.mean(r)
-                stdev = np.std(r)
-                upper_median = np.median(r[r > mean + stdev/2])
-                lower_median = np.median(r[r < mean - stdev/2])
-                match common.CALC_TYPE:
-                    case common.CALC_PEAK_TO_PEAK:
-                        self.reflectance.append(upper_median - lower_median)
-                        print(f"Pk-Pk Value Calculated: t={data[0] - self.init_time} R={upper_median - lower_median}")
-
-                    case common.CALC_UPPER_MEDIAN:
-                        self.reflectance.append(upper_median)
-                        print(f"Average Value Calculated: t={data[0] - self.init_time} R={upper_median}")
-            
-
-                if common.SAVE_CALCULATED_REFLECTANCE:
-                    with open(self.save_file_name, 'a') as f:
-                        f.write(f"{self.time[-1]},{self.reflectance[-1]}\n")
-        
 
 
-        else:
-            self.logger.info("Adding fake data!")
-            data_added = True
-            self.time.append(time.time() - self.init_time)
-            self.reflectance.append(random.gauss(1, 0.3))
+def start_handler(settings, data_queue, command_queue, run_name, run_dir):
+    # Acquisition for one instrument, in whichever form common.py asks for
+    name = settings["name"]
+    port = settings.get("port", common.SRS830_COM_PORT)
+    profile = settings.get("profile")
+    replay_path = settings.get("replay_path", common.SRS830_REPLAY_PATH)
+    if replay_path is not None:
+        replay_path = replay.instrument_path(replay_path, name)
+    if common.SRS830_USE_PROCESS:
+        replay_args = None
+        if replay_path is not None:
+            replay_args = (replay_path, common.SRS830_REPLAY_SPEED, common.SRS830_REPLAY_LOOP)
+        return acquisition.ProcessAcquisition(data_queue, command_queue, run_name, run_dir, serial_port=port,
+                                              replay_args=replay_args, name=name, profile=profile)
+    elif replay_path is not None:
+        source = replay.ReplaySource(replay_path, common.SRS830_REPLAY_SPEED, common.SRS830_REPLAY_LOOP)
+        return srs830.SRS830Handler(data_queue, command_queue, run_name, run_dir, replay_source=source, name=name)
+    elif common.SRS830_USE_ASYNC and not common.SRS830_FAKE_SERIAL:
+        return srs830_async.AsyncSRS830Handler(data_queue, command_queue, run_name, run_dir, serial_port=port,
+                                               name=name, profile=profile)
+    else:
+        return srs830.SRS830Handler(data_queue, command_queue, run_name, run_dir, serial_port=port, name=name,
+                                    profile=profile)
+
+
+def run_gui(gui_queue, run_name, run_dir, init_time):
+    # Qt is only imported here
+    from PySide6.QtWidgets import QApplication
+    import gui
 
-        if data_added:
-            self.plot_reflectance.clear()
-            self.plot_reflectance.plot(self.time, self.reflectance, pen=self.main_pen)
+    app = QApplication([])
+    window = gui.MainWindow(gui_queue, run_name, run_dir)
+    window.init_time = init_time
+    window.show()
+    over = app.exec()
+    window.timer.stop()
+    window.close_history()
+    return over
 
-            self.plot_raw.clear()
-            self.plot_raw.plot(self.raw_time, self.raw_voltage, pen=self.main_pen)
 
-            if not common.SRS830_FAKE_SERIAL:
-                self.plot_raw.plot([self.raw_time[0], self.raw_time[-1]], [upper_median] * 2, pen=self.fit_pen), self.raw_time[0]
-                self.plot_raw.plot([self.raw_time[0], self.raw_time[-1]], [lower_median] * 2, pen=self.fit_pen), self.raw_time[0]
-        
+def run_headless(duration_s=None):
+    # Waits for Ctrl+C, SIGTERM or the end of duration_s
+    stop = threading.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda signum, frame: stop.set())
+    logger.info("Running headless, stop with Ctrl+C" + (f" or after {duration_s} s" if duration_s else ""))
+    stop.wait(duration_s)
+    return 0
 
 
 if __name__ == "__main__":
-    run_name = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S") + "---ADD_RUN_INFO_HERE"
-    run_dir = os.path.join(common.DATA_SUBPATH, run_name)
-    os.makedirs(run_dir)
-    queue_srs_to_analysis = queue.Queue()
-    queue_srs_commands = queue.Queue()
-
-    srs830_handler = srs830.SRS830Handler(queue_srs_to_analysis, queue_srs_commands, run_name, run_dir, serial_port=common.SRS830_COM_PORT)
-
-    app = QApplication([])
-
-    window = MainWindow(queue_srs_to_analysis, run_name, run_dir)
-    window.show()
-    over = app.exec()
+    parser = argparse.ArgumentParser(description="Real Time Laser Reflectometry")
+    parser.add_argument("--name", default="", help="Run description, appended to the start time to name the run")
+    parser.add_argument("--run-dir", default=None, help="Directory for the run, default is DATA_SUBPATH/<run name>")
+    parser.add_argument("--headless", action="store_true", help="Acquire, analyse and save without the GUI")
+    parser.add_argument("--duration", type=float, default=None, help="Seconds to run for when headless")
+    parser.add_argument("--resume", default=None, metavar="RUN_DIR",
+                        help="Continue an interrupted run, appending to its results files")
+    args = parser.parse_args()
+    if common.ANALYSIS_QUEUE_POLICY == common.QUEUE_POLICY_COALESCE:
+        sys.exit("common.ANALYSIS_QUEUE_POLICY cannot be QUEUE_POLICY_COALESCE, raw captures are not merged. "
+                 "Use QUEUE_POLICY_BLOCK or QUEUE_POLICY_DROP_OLDEST.")
+
+    run_name = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    if args.name:
+        run_name += "---" + args.name
+    init_time = time.time()
+    if args.resume is not None:
+        # Times carry on from the original start, and partial records left by the crash are trimmed on reopening
+        run_dir = args.resume
+        run_name = os.path.basename(os.path.normpath(run_dir))
+        try:
+            init_time = replay.run_init_time(run_dir)
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"No start time for {run_dir}, times restart from zero: {e}")
+        logger.info(f"Resuming run {run_name} in {run_dir}")
+    else:
+        if args.run_dir is not None:
+            run_dir = args.run_dir
+            if not args.name:
+                run_name = os.path.basename(os.path.normpath(run_dir))
+        else:
+            run_dir = os.path.join(common.DATA_SUBPATH, run_name)
+        os.makedirs(run_dir)
+        with open(os.path.join(run_dir, replay.RUN_INFO_FILE), 'w') as f:
+            json.dump({"run_name": run_name, "init_time": init_time}, f)
+        logger.info(f"Run {run_name} in {run_dir}")
+    resume = args.resume is not None
+
+    queue_srs_to_analysis = pipeline.BoundedQueue(common.ANALYSIS_QUEUE_SIZE, common.ANALYSIS_QUEUE_POLICY,
+                                                  name="Analysis queue", on_drop=acquisition.release_capture)
+    queue_analysis_to_gui = None
+    if not args.headless:
+        queue_analysis_to_gui = pipeline.BoundedQueue(common.GUI_QUEUE_SIZE, common.GUI_QUEUE_POLICY,
+                                                      merge=analysis.merge_results, name="GUI queue")
+    queue_analysis_commands = queue.Queue()
+    metrics_exporter = metrics.Exporter(run_dir)
+
+    results_publisher = None
+    if common.PUBLISH_ENABLED:
+        try:
+            results_publisher = publisher.Publisher(run_name, init_time)
+        except OSError as e:
+            logger.error(f"Could not publish on {common.PUBLISH_ADDRESS}, continuing without: {e}")
+
+    # One handler per instrument, each with its own port, command queue and thread or process.
+    # With several instruments their captures go in a subdirectory each.
+    srs830_handlers = []
+    queues_srs_commands = []
+    for settings in common.SRS830_INSTRUMENTS:
+        instrument_dir = run_dir
+        if len(common.SRS830_INSTRUMENTS) > 1:
+            instrument_dir = os.path.join(run_dir, settings["name"])
+            os.makedirs(instrument_dir, exist_ok=resume)
+        queue_srs_commands = multiprocessing.Queue() if common.SRS830_USE_PROCESS else queue.Queue()
+        queues_srs_commands.append(queue_srs_commands)
+        srs830_handlers.append(start_handler(settings, queue_srs_to_analysis, queue_srs_commands, run_name,
+                                             instrument_dir))
+    analysis_handler = analysis.AnalysisHandler(queue_srs_to_analysis, queue_analysis_to_gui, queue_analysis_commands,
+                                                run_name, run_dir, init_time=init_time, startup_time=startup_time,
+                                                publisher=results_publisher, append=resume)
+
+    if args.headless:
+        over = run_headless(args.duration)
+    else:
+        over = run_gui(queue_analysis_to_gui, run_name, run_dir, analysis_handler.init_time)
 
     # Cleanup and close
-    window.timer.stop()
-    queue_srs_commands.put(common.SRS830_COMMAND_RAISE_END_FLAG)
-    srs830_handler.join()
+    for queue_srs_commands in queues_srs_commands:
+        queue_srs_commands.put(common.SRS830_COMMAND_RAISE_END_FLAG)
+    for srs830_handler in srs830_handlers:
+        srs830_handler.join()
+    queue_analysis_commands.put(common.ANALYSIS_COMMAND_RAISE_END_FLAG)
+    analysis_handler.join()
+    if results_publisher is not None:
+        results_publisher.join()
+    if common.SRS830_USE_PROCESS:
+        for srs830_handler in srs830_handlers:
+            srs830_handler.close()
+    metrics_exporter.join()
+    if analysis_handler.first_capture_s is not None:
+        logger.info(f"Startup to first capture took {analysis_handler.first_capture_s:.3f} s")
+    else:
+        logger.warning("No captures were analysed")
     sys.exit(over)
@@ -13,48 +13,126 @@ import os
 import time
 import logging
 import datetime
-import serial
 import threading
 import common
+import adaptive
+import archive
+import metrics
+import profiles
+import transport
 import numpy as np
 
 logger = logging.getLogger("RTLR.srs830")
 
 
 def send_command(con, command):
+    # con is a transport.Transport
     if not common.SRS830_FAKE_SERIAL:
         con.write(bytes(command + "\r\n", encoding="utf-8"))
 
 
-def capture_until_eol(con, timeout_s=1):
-    dout = bytes()
+def capture_until_eol(con, timeout_s=common.SRS830_REPLY_TIMEOUT_S):
+    # Short replies come at once, so a missing one is given up on quickly. Pass None to wait the port timeout.
+    return con.read_until(b'\r', timeout_s)
 
-    over = False
-    while not over:
-        if con.in_waiting >= 1:
-            data = con.read(1)
-            if data == bytes('\r', encoding="utf-8"):
-                over = True
-            else:
-                dout = dout + data
-        else:
-            wait_start = time.time()
-            waiting = True
-            while waiting:
-                if con.in_waiting >= 1:
-                    waiting = False
-                if time.time() - wait_start >= timeout_s:
-                    waiting = False
-                    over = True
 
-    return dout
+def capture_bytes(con, n_bytes):
+    # Binary replies have no terminator, so read a known number of bytes
+    return con.read_exact(n_bytes)
+
+
+def decode_ascii(data):
+    # TRCA format, comma separated with a trailing comma
+    return np.array([float(d) for d in str(data, encoding='utf-8').split(',')[:-1]])
+
+
+def decode_ieee(data):
+    # TRCB format, little-endian 32-bit floats
+    n = len(data) // 4
+    return np.frombuffer(data, dtype='<f4', count=n).astype(np.float64)
+
+
+def decode_lia(data):
+    # TRCL format, each point is a signed 16-bit mantissa followed by a 16-bit exponent, little-endian.
+    # Value is mantissa * 2^(exponent - 124)
+    n = len(data) // 4
+    words = np.frombuffer(data, dtype='<i2', count=2 * n).reshape(n, 2)
+    return np.ldexp(words[:, 0].astype(np.float64), words[:, 1].astype(np.int32) - 124)
+
+
+def transfer_trace(con, channel, points, offset=0):
+    # Pulls points from the buffer of the given channel (1 or 2) in the configured transfer format
+    t0 = metrics.start()
+    match common.SRS830_TRANSFER_MODE:
+        case common.SRS830_TRANSFER_IEEE:
+            send_command(con, f"TRCB ? {channel}, {offset}, {points}")
+            data = capture_bytes(con, 4 * points)
+            decode = decode_ieee
+
+        case common.SRS830_TRANSFER_LIA:
+            send_command(con, f"TRCL ? {channel}, {offset}, {points}")
+            data = capture_bytes(con, 4 * points)
+            decode = decode_lia
+
+        case _:
+            send_command(con, f"TRCA ? {channel}, {offset}, {points}")
+            data = con.read_until(b'\r', None, fields=points)
+            decode = decode_ascii
+
+    t0 = metrics.lap("transfer", t0)
+    metrics.count("bytes_transferred", len(data))
+    values = decode(data)
+    metrics.stop("parse", t0)
+    return values
+
+
+def query_points(con):
+    t0 = metrics.start()
+    send_command(con, "SPTS ?")  # Request number of stored points
+    points = int(capture_until_eol(con))
+    metrics.stop("spts", t0)
+    return points
+
+
+def query_settings(con, keys):
+    # Queries the settings in one batch, returns a dict of key to reply
+    keys = list(keys)
+    send_command(con, ";".join(profiles.query_command(key) for key in keys))
+    return {key: str(capture_until_eol(con), encoding="utf-8") for key in keys}
+
+
+def apply_profile(con, profile):
+    # Sends only the settings that differ from the instrument's, then reads them back.
+    # Returns the keys changed, the keys that did not take, and the settings now in effect.
+    current = query_settings(con, profile)
+    changed = profiles.differences(profile, current)
+    rejected = []
+    if changed:
+        send_command(con, ";".join(profiles.set_command(key, profile[key]) for key in changed))
+        after = query_settings(con, changed)
+        rejected = profiles.differences({key: profile[key] for key in changed}, after)
+        current.update(after)
+    return changed, rejected, current
+
+
+def wait_until_ready(con, settle_s, timeout_s=common.SRS830_READY_TIMEOUT_S):
+    # Waits for the outputs to settle, then polls the status until the reference is locked. Returns True if locked.
+    time.sleep(settle_s)
+    deadline = time.time() + timeout_s
+    while True:
+        send_command(con, "LIAS ?")  # Reading the status clears it, so a stale unlock shows only once
+        status = int(capture_until_eol(con))
+        if not status & profiles.STATUS_UNLOCKED:
+            return True
+        if time.time() >= deadline:
+            return False
+        time.sleep(common.SRS830_READY_POLL_S)
 
 
 def save_csv(t, r, theta, fname):
-    out = "Time (s),R (V), Theta (degrees)\n"
-    n = min(len(r), len(t), len(theta))  # Sometimes theta has fewer data points
-    for i in range(len(t)):
-        out = out + f"{t[i]},{r[i]},{theta[i]}\n"
+    # zip stops at the shortest array, sometimes theta has fewer data points
+    rows = zip(np.asarray(t).tolist(), np.asarray(r).tolist(), np.asarray(theta).tolist())
+    out = "Time (s),R (V), Theta (degrees)\n" + "".join(f"{a},{b},{c}\n" for a, b, c in rows)
 
     with open(fname, 'w') as f:
         f.write(out)
@@ -62,10 +140,14 @@ def save_csv(t, r, theta, fname):
 
 
 class SRS830Handler:
-    def __init__(self, data_queue, command_queue, run_name, run_dir, serial_port=None):
+    def __init__(self, data_queue, command_queue, run_name, run_dir, serial_port=None, replay_source=None,
+                 name="srs830", profile=None):
 ##        self.p = multiprocessing.Process(target=self.run)
         self.p = threading.Thread(target=self.run)
-        self.logger = logging.getLogger("RTLR.srs830.SRS830Handler")
+        self.logger = logging.getLogger(f"RTLR.srs830.SRS830Handler.{name}")
+        self.name = name  # Instrument name, travels with each capture
+        self.profile = profiles.get(profile if profile is not None else common.SRS830_PROFILE)
+        self.instrument_settings = {}  # As last read back from the instrument
         self.run_name = run_name
         self.run_dir = run_dir
         self.queue_data_out = data_queue
@@ -79,9 +161,36 @@ class SRS830Handler:
             self.serialPortDefined = True
 
         self.ser = None
+        self.archive = None
         if common.SRS830_FAKE_SERIAL:
             self.state = common.SRS830_STATE_RUN_CAPTURING_DATA  # Skip Init
 
+        # Recorded captures to play back instead of talking to the instrument, see replay.py
+        self.replay_source = replay_source
+        if self.replay_source is not None:
+            self.state = common.SRS830_STATE_RUN_REPLAYING_DATA
+
+        # Acquisition bookkeeping
+        self.capture_index = archive.count(run_dir)  # Captures published, carrying on from a resumed run's archive
+        self.sample_index = 0  # Index of the next sample published, counted from the start of acquisition
+        self.time_captured_s = 0  # Time the instrument has spent storing samples
+        self.acquisition_start_time = None
+        self.segment_index = 0
+        self.segment_start_time = None
+        self.read_offset = 0
+        self.next_poll_time = 0
+        self.spts_time = 0  # When the stored point count was last queried
+        self.duty_cycle = 0
+
+        # Capture length and sample rate, adjusted between captures in adaptive mode
+        self.capture_time_s = common.SRS830_CAPTURE_TIME_S
+        self.rate_hz = common.SRS830_CAPTURE_RATE_HZ
+        self.rate_index = None  # SRAT in effect, read from the instrument on connect
+        self.next_rate_index = None
+        self.controller = adaptive.CaptureController() if common.SRS830_ADAPTIVE else None
+
+        self.next_connect_time = 0  # Reconnection attempts after a serial error are spaced out
+
         # Flags
         self.flagEnd = False
         self.flagSerialError = False
@@ -105,115 +214,124 @@ class SRS830Handler:
 ##            self.logger.debug(f"Iteration {self.i}")
 ##            self.logger.debug(f"Current state is {self.state}")
 
-            match self.state:
-                case common.SRS830_STATE_INIT:
-                    self.logger.info("SRS830 Process Initialized")
-                    self.state = common.SRS830_STATE_WAITING_FOR_SERIAL_PORT
-
-                case common.SRS830_STATE_WAITING_FOR_SERIAL_PORT:
-                    if time.time() - start_time >= 10:
-                        start_time = time.time()
-                        self.logger.info(f"Waiting for serial port definition. Thread cycle {self.i}")
-                        time.sleep(9)  # Slow down if sitting idle
-                        
-
-                    if self.serialPortDefined:
-                        self.logger.info("Attempting to connect to serial port.")
-                        self.serialPortDefined = False
-                        self.ser = serial.Serial(self.serialPort,
-                                                 timeout=common.SRS830_TIMEOUT_S,
-                                                 baudrate=common.SRS830_BAUD)
-                        send_command(self.ser, "OUTX 0")
-                        send_command(self.ser, "*IDN ?")
-                        res = capture_until_eol(self.ser)
-                        if "SR830" in str(res):
-                            self.logger.info("Communication with SRS830 verified! Configuring instrument.")
-                            send_command(self.ser, "*RST")
-                            send_command(self.ser, "FMOD 1")  # Internal Freq reference
-                            send_command(self.ser, "FREQ 2345")  # Frequency 321 kHz
-                            send_command(self.ser, "SLVL 5")  # Amplitude to 5V RMS
-                            send_command(self.ser, "ISRC 0")  # Open ended voltage input
-                            send_command(self.ser, "IGND 1")  # Ground the PD
-                            send_command(self.ser, "ICPL 0")  # AC couple the input
-                            send_command(self.ser, "RMOD 1")  # Normal reserve
-                            send_command(self.ser, "SENS 24")  # Set gain to XmV range (higher number is higher range)
-                            send_command(self.ser, "OFLT 4")  # Set time constant to 3ms (higher number is larger time constant)
-                            send_command(self.ser, "DDEF 1,1,0")  # Set ch1 display to R
-                            send_command(self.ser, "DDEF 2,1,0")  # Set ch2 display to theta
-                            send_command(self.ser, "SRAT 13")  # Sets capture rate to 512Hz
-                            send_command(self.ser, "SEND 0")  # Sets to single shot capture
-                            send_command(self.ser, "TSTR 0")  # Disables hardware trigger
-                            time.sleep(5)  # Wait for settings to take effect
-                            self.state = common.SRS830_STATE_RUN_CAPTURING_DATA
+            try:
+                match self.state:
+                    case common.SRS830_STATE_INIT:
+                        self.logger.info("SRS830 Process Initialized")
+                        self.state = common.SRS830_STATE_WAITING_FOR_SERIAL_PORT
 
-                        else:
-                            self.logger.warning("Could not verify serial port connection. Closing connection.")
-                            self.ser.close()
-                            self.ser = None
-
-                    # todo: configure SRS830
-                    # todo: verify configuration
-                    # todo: move on to capturing data if it's okay
-
-                case common.SRS830_STATE_RUN_CAPTURING_DATA:
-                    self.logger.info(f"Capturing data, thread cycle {self.i}")
-                    start_time = time.time()
-                    capture_name = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-                    send_command(self.ser, "REST")  # Reset buffer
-                    send_command(self.ser, "STRT")  # Start data capture
-                    self.state = common.SRS830_STATE_RUN_CAPTURING_DATA
-                    # Wait for data to be captured
-                    time.sleep(common.SRS830_CAPTURE_TIME_S)
-                    send_command(self.ser, "PAUS")  # Pause capture
-                    self.state = common.SRS830_STATE_RUN_TRANSFERRING_DATA
-
-
-                case common.SRS830_STATE_RUN_TRANSFERRING_DATA:
-                    self.logger.info(f"Transferring data, thread cycle {self.i}")
-                    if not common.SRS830_FAKE_SERIAL:
-                        send_command(self.ser, "SPTS ?")  # Request number of stored points
-                        points = int(capture_until_eol(self.ser))
-
-                        # R data:
-                        send_command(self.ser, f"TRCA ? 1, 0, {points}")
-                        data_r = capture_until_eol(self.ser)
-                        data_r = np.array([float(d) for d in str(data_r, encoding='utf-8').split(',')[:-1]])
-                        timebase = np.array([n / common.SRS830_CAPTURE_RATE_HZ for n in range(len(data_r))])
-
-                        # Theta - if needed
-                        if common.SRS830_CAPTURE_PHASE:
-                            send_command(self.ser, f"TRCA ? 2, 0, {points}")
-                            data_theta = capture_until_eol(self.ser)
-                            data_theta = np.array([float(d) for d in str(data_theta, encoding='utf-8').split(',')[:-1]])
+                    case common.SRS830_STATE_WAITING_FOR_SERIAL_PORT:
+                        if self.serialPortDefined and time.time() >= self.next_connect_time:
+                            # The port stays defined, so a failed attempt is retried
+                            self.next_connect_time = time.time() + common.SRS830_RECONNECT_INTERVAL_S
+                            self.connect()
 
                         else:
-                            data_theta = np.zeros(timebase.shape)
-                        
-                        
-                        
+                            if time.time() - start_time >= 10:
+                                start_time = time.time()
+                                self.logger.info(f"Waiting for serial port definition. Thread cycle {self.i}")
+                            time.sleep(common.SRS830_IDLE_POLL_S)  # Slow down if sitting idle
 
-                        # Put data to queue
-                        self.queue_data_out.put([start_time, (timebase, data_r, data_theta)])
-
-                        # Save data
-                        if common.SRS830_SAVE_EACH_CAPTURE:
-                            fname = str(self.i) + "--" + datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-                            save_csv(timebase, data_r, data_theta, os.path.join(self.run_dir, fname))
+                    case common.SRS830_STATE_RUN_CAPTURING_DATA:
+                        self.logger.debug(f"Capturing data, thread cycle {self.i}")
+                        start_time = time.time()
+                        capture_name = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+                        self.apply_rate()
+                        send_command(self.ser, "REST")  # Reset buffer
+                        send_command(self.ser, "STRT")  # Start data capture
+                        if self.acquisition_start_time is None:
+                            self.acquisition_start_time = start_time
+
+                        if common.SRS830_ACQUISITION_MODE == common.SRS830_ACQUISITION_CONTINUOUS and not common.SRS830_FAKE_SERIAL:
+                            # Keep the buffer running and read it as it fills
+                            # The buffer restart at rollover is the only gap, sample indices are exact within a segment
+                            self.segment_index += 1
+                            self.segment_start_time = start_time
+                            self.read_offset = 0
+                            self.next_poll_time = start_time + self.capture_time_s
+                            self.state = common.SRS830_STATE_RUN_STREAMING_DATA
 
-                    else:
-                        if not self.queue_data_out.empty():
-                            logger.warning(f"Queue is not empty, data could be accumulating! Queue size is {self.queue_data_out.qsize()}")
-                        self.queue_data_out.put([start_time, (self.i, self.i, self.i)])
+                        else:
+                            self.state = common.SRS830_STATE_RUN_CAPTURING_DATA
+                            # Wait for data to be captured
+                            t0 = metrics.start()
+                            time.sleep(self.capture_time_s)
+                            metrics.stop("capture_wait", t0)
+                            send_command(self.ser, "PAUS")  # Pause capture
+                            self.state = common.SRS830_STATE_RUN_TRANSFERRING_DATA
+
+
+                    case common.SRS830_STATE_RUN_TRANSFERRING_DATA:
+                        self.logger.debug(f"Transferring data, thread cycle {self.i}")
+                        if not common.SRS830_FAKE_SERIAL:
+                            self.spts_time = time.time()
+                            points = query_points(self.ser)
+                            self.time_captured_s += points / self.rate_hz
+                            self.publish(start_time, self.transfer(0, points))
 
-                    # Back to capturing
-                    self.state = common.SRS830_STATE_RUN_CAPTURING_DATA
+                        else:
+                            if not self.queue_data_out.empty():
+                                logger.warning(f"Queue is not empty, data could be accumulating! Queue size is {self.queue_data_out.qsize()}")
+                            # Same shape as a real capture, the GUI makes its own data
+                            self.queue_data_out.put([start_time, (self.i, self.i, self.i),
+                                                     self.capture_info(0, self.rate_hz)])
+
+                        # Back to capturing
+                        self.state = common.SRS830_STATE_RUN_CAPTURING_DATA
+
+
+                    case common.SRS830_STATE_RUN_STREAMING_DATA:
+                        # Sleep until the next chunk is due, then read whatever has been stored since the last read
+                        delay = self.next_poll_time - time.time()
+                        if delay > 0:
+                            t0 = metrics.start()
+                            time.sleep(delay)
+                            metrics.stop("capture_wait", t0)
+                        self.next_poll_time += self.capture_time_s
+
+                        rollover = self.rollover_points()
+                        self.spts_time = time.time()
+                        points = query_points(self.ser)
+                        if points >= rollover:
+                            # Buffer is close to full, stop it and collect the tail before restarting
+                            send_command(self.ser, "PAUS")
+                            points = query_points(self.ser)
+                            self.state = common.SRS830_STATE_RUN_CAPTURING_DATA
 
+                        new_points = points - self.read_offset
+                        if new_points > 0:
+                            chunk_start = self.segment_start_time + self.read_offset / self.rate_hz
+                            self.time_captured_s += new_points / self.rate_hz
+                            self.publish(chunk_start, self.transfer(self.read_offset, new_points))
+                            self.read_offset = points
 
-                case common.SRS830_STATE_RUN_ENDING:
-                    over = True
+                    case common.SRS830_STATE_RUN_REPLAYING_DATA:
+                        capture = self.replay_source.next_capture()
+                        if capture is None:
+                            self.logger.info(f"Replay finished after {self.replay_source.replayed} captures")
+                            self.flagEnd = True
 
-                case _:
-                    self.logger.error("Fallback case hit, killing srs830 thread")
+                        else:
+                            _, timebase, data_r, data_theta, rate = capture
+                            self.spts_time = time.time()
+                            start_time = self.replay_source.start_time()
+                            if self.acquisition_start_time is None:
+                                self.acquisition_start_time = start_time
+                            self.time_captured_s += len(data_r) / rate
+                            self.publish(start_time, (timebase, data_r, data_theta), rate)
+
+                    case common.SRS830_STATE_RUN_ENDING:
+                        over = True
+
+                    case _:
+                        self.logger.error("Fallback case hit, killing srs830 thread")
+
+            except (ValueError, OSError) as e:
+                # A reply that timed out or came back garbled, or the port itself failing
+                if self.ser is None:
+                    raise
+                self.logger.error(f"Serial error in {self.state}: {e!r}")
+                self.flagSerialError = True
 
             command = None
             if not self.queue_commands_in.empty():
@@ -230,10 +348,11 @@ class SRS830Handler:
 
                 case common.SRS830_COMMAND_SET_SERIAL_PORT:
                     port = self.queue_commands_in.get()
-                    if self.state == common.SRS830_STATE_WAITING_FOR_SERIAL_PORT and not self.serialPortDefined:
+                    if self.state == common.SRS830_STATE_WAITING_FOR_SERIAL_PORT:
                         self.serialPort = port
                         self.logger.info(f"Setting serial port to {self.serialPort}")
                         self.serialPortDefined = True
+                        self.next_connect_time = 0
 
                 case common.SRS830_COMMAND_CLOSE_SERIAL_PORT:
                     self.flagCloseSerialPort = True
@@ -246,19 +365,175 @@ class SRS830Handler:
                 self.state = common.SRS830_STATE_RUN_ENDING
 
             if self.flagSerialError:
-                self.state = common.SRS830_STATE_WAITING_FOR_SERIAL_PORT
-                self.flagCloseSerialPort = True
+                # Reopen the same port, straight away unless it was connecting that failed
+                self.flagSerialError = False
+                self.close_port()
+                if self.state != common.SRS830_STATE_WAITING_FOR_SERIAL_PORT:
+                    self.next_connect_time = 0
+                if not self.flagEnd:
+                    self.state = common.SRS830_STATE_WAITING_FOR_SERIAL_PORT
 
             if self.flagCloseSerialPort:
-                self.ser.close()
+                # Stays closed until a port is set again
+                self.flagCloseSerialPort = False
+                self.close_port()
+                self.serialPortDefined = False
+                if not self.flagEnd and self.replay_source is None:
+                    self.state = common.SRS830_STATE_WAITING_FOR_SERIAL_PORT
 
         # Done the while loop
         self.end()
 
+    def connect(self):
+        self.logger.info(f"Attempting to connect to serial port {self.serialPort}.")
+        try:
+            self.ser = transport.open_serial(self.serialPort, common.SRS830_BAUD, common.SRS830_TIMEOUT_S)
+        except (ValueError, OSError) as e:
+            self.logger.warning(f"Could not open {self.serialPort}: {e}")
+            return
+        self.ser.flush_input()  # Anything left from before a reconnect
+        send_command(self.ser, "OUTX 0")
+        send_command(self.ser, "*IDN ?")
+        res = capture_until_eol(self.ser)
+        if "SR830" in str(res):
+            self.logger.info("Communication with SRS830 verified! Checking configuration.")
+            self.configure()
+            self.state = common.SRS830_STATE_RUN_CAPTURING_DATA
+
+        else:
+            self.logger.warning("Could not verify serial port connection. Closing connection.")
+            self.close_port()
+
+    def close_port(self):
+        if self.ser is not None:
+            try:
+                self.ser.close()
+            except OSError as e:
+                self.logger.warning(f"Error closing the serial port: {e}")
+            self.ser = None
+
+    def configure(self):
+        # Brings the instrument to the profile, sending only what differs, and waits until it is ready
+        t0 = time.time()
+        changed, rejected, self.instrument_settings = apply_profile(self.ser, self.profile)
+        if rejected:
+            self.logger.error(f"Settings not accepted by the instrument: "
+                              f"{', '.join(f'{k} = {self.instrument_settings[k]}, wanted {self.profile[k]}' for k in rejected)}")
+        settle_s = profiles.settling_time_s(changed, self.instrument_settings)
+        if not wait_until_ready(self.ser, settle_s):
+            self.logger.warning("Reference is not locked, capturing anyway")
+        self.logger.info(f"Configured in {time.time() - t0:.2f} s, {len(changed)} settings changed, "
+                         f"waited {settle_s:.3f} s to settle")
+        if "SRAT" in self.instrument_settings:
+            self.rate_index = int(self.instrument_settings["SRAT"])
+            self.rate_hz = profiles.rate_hz(self.rate_index)
+
+    def apply_rate(self):
+        # Sets a sample rate chosen by the controller, call while the buffer is stopped
+        if self.next_rate_index is None or self.next_rate_index == self.rate_index:
+            return
+        send_command(self.ser, f"SRAT {self.next_rate_index}")
+        self.rate_index = self.next_rate_index
+        self.instrument_settings["SRAT"] = str(self.rate_index)
+        self.rate_hz = profiles.rate_hz(self.rate_index)
+
+    def adapt(self, start_time, data_r, sample_rate_hz):
+        # Picks the length and rate of the next capture from the one just taken
+        self.capture_time_s, self.next_rate_index = self.controller.update(start_time, data_r, sample_rate_hz)
+        metrics.gauge("capture_time_s", self.capture_time_s)
+        metrics.gauge("sample_rate_hz", profiles.rate_hz(self.next_rate_index))
+
+    def transfer(self, offset, points):
+        # Reads points from the instrument buffer starting at offset, returns (timebase, R, theta)
+        data_r = transfer_trace(self.ser, 1, points, offset)
+        timebase = np.arange(len(data_r)) / self.rate_hz
+
+        # Theta - if needed
+        if common.SRS830_CAPTURE_PHASE:
+            data_theta = transfer_trace(self.ser, 2, points, offset)
+
+        else:
+            data_theta = np.zeros(timebase.shape)
+
+        return timebase, data_r, data_theta
+
+    def publish(self, start_time, capture, sample_rate_hz=None):
+        if sample_rate_hz is None:
+            sample_rate_hz = self.rate_hz
+        info, settings = self.claim(len(capture[1]), sample_rate_hz)
+        self.emit(start_time, capture, info, settings)
+        if self.controller is not None and self.replay_source is None:
+            self.adapt(start_time, capture[1], sample_rate_hz)
+
+    def claim(self, n_samples, sample_rate_hz):
+        # Info and archive settings for the capture just transferred, then moves the counters on past it. The asyncio
+        # driver calls this on its event loop, so they describe this capture however far behind decoding falls.
+        self.update_duty_cycle()
+        info = self.capture_info(n_samples, sample_rate_hz)
+        settings = self.capture_settings()
+        self.capture_index += 1
+        self.sample_index += n_samples
+        metrics.count("captures")
+        metrics.count("samples", n_samples)
+        return info, settings
+
+    def emit(self, start_time, capture, info, settings):
+        # Queues and saves a capture, touches nothing that the acquisition moves on
+        timebase, data_r, data_theta = capture
+
+        # Put data to queue
+        self.queue_data_out.put([start_time, capture, info])
+
+        # Save data
+        if common.SRS830_SAVE_EACH_CAPTURE:
+            if common.SRS830_SAVE_FORMAT == common.SRS830_SAVE_ARCHIVE:
+                if self.archive is None:
+                    self.archive = archive.ArchiveWriter(self.run_dir)
+                self.archive.write(info["capture_index"], start_time, info["sample_rate_hz"],
+                                   timebase, data_r, data_theta, settings)
+            else:
+                fname = str(self.i) + "--" + datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+                save_csv(timebase, data_r, data_theta, os.path.join(self.run_dir, fname))
+
+    def capture_info(self, n_samples, sample_rate_hz):
+        # Travels with each capture on the data queue
+        return {"instrument": self.name,
+                "capture_index": self.capture_index,
+                "sample_index": self.sample_index,
+                "segment_index": self.segment_index,
+                "sample_rate_hz": sample_rate_hz,
+                "n_samples": n_samples,
+                "capture_time_s": n_samples / sample_rate_hz,
+                "duty_cycle": self.duty_cycle}
+
+    def capture_settings(self):
+        # Acquisition and instrument settings saved with each archived capture. The instrument settings are as last
+        # read back from the SR830 (SENS, OFLT, FREQ, ...), empty for replayed or fake captures.
+        return {"instrument": self.name,
+                "instrument_settings": dict(self.instrument_settings),
+                "capture_time_s": self.capture_time_s,
+                "adaptive": common.SRS830_ADAPTIVE,
+                "acquisition_mode": common.SRS830_ACQUISITION_MODE,
+                "transfer_mode": common.SRS830_TRANSFER_MODE,
+                "capture_phase": common.SRS830_CAPTURE_PHASE,
+                "segment_index": self.segment_index}
+
+    def update_duty_cycle(self):
+        # Fraction of wall time since the first capture that the instrument spent storing samples
+        elapsed = self.spts_time - self.acquisition_start_time
+        if elapsed > 0:
+            self.duty_cycle = min(1.0, self.time_captured_s / elapsed)
+            metrics.gauge("duty_cycle", self.duty_cycle)
+
+    def rollover_points(self):
+        margin = int(common.SRS830_BUFFER_ROLLOVER_MARGIN_S * self.rate_hz)
+        return max(common.SRS830_BUFFER_POINTS - margin, 1)
+
     def end(self):
         self.logger.info("Ending SRS830Handler")
-        if self.ser is not None:
-            self.ser.close()
+        self.close_port()
+        if self.archive is not None:
+            self.archive.close()
 ##        self.queue_data_out.close()
 ##        self.queue_commands_in.close()
 ##        self.p.close()
@@ -0,0 +1,353 @@
+# srs830_async.py
+#
+# asyncio driver for the SRS830
+#
+# AsyncSRS830 wraps an AsyncTransport with awaitable command and query methods. Queries time out after
+# SRS830_TIMEOUT_S plus the time the reply takes at the baud rate, and the input buffer is flushed after a timeout so a
+# late reply cannot be mistaken for the next one.
+#
+# AsyncSRS830Handler is a drop-in for SRS830Handler that runs an event loop in its thread. Commands are checked every
+# SRS830_COMMAND_POLL_S and acquisition is a task that is cancelled on the end flag, so shutdown does not wait for a
+# capture or a transfer to finish. Each transfer is handed to a decode-and-publish task, and the next capture starts
+# while it runs. Publishing bookkeeping, archiving and the duty cycle are shared with SRS830Handler.
+#
+# David Lister
+# July 2023
+#
+
+import asyncio
+import logging
+import time
+import numpy as np
+import common
+import metrics
+import profiles
+import srs830
+import transport
+
+logger = logging.getLogger("RTLR.srs830_async")
+
+
+class AsyncSRS830:
+    def __init__(self, con, timeout_s=common.SRS830_TIMEOUT_S, baudrate=common.SRS830_BAUD):
+        self.con = con
+        self.timeout_s = timeout_s
+        self.baudrate = baudrate
+        self.lock = asyncio.Lock()  # One command/response exchange at a time
+
+    def reply_timeout(self, n_bytes):
+        # 10 bits per byte on the wire
+        return self.timeout_s + n_bytes * 10 / self.baudrate
+
+    async def write(self, command):
+        async with self.lock:
+            self.con.write(bytes(command + "\r\n", encoding="utf-8"))
+
+    async def _exchange(self, command, read, timeout_s):
+        # read is called for the coroutine that collects the reply
+        async with self.lock:
+            self.con.write(bytes(command + "\r\n", encoding="utf-8"))
+            try:
+                return await asyncio.wait_for(read(), timeout_s)
+            except (TimeoutError, asyncio.CancelledError):
+                self.con.flush_input()  # Part of the reply may still arrive
+                raise
+
+    async def query(self, command, timeout_s=None):
+        # Returns the reply as a string without its terminator
+        if timeout_s is None:
+            timeout_s = self.timeout_s
+        reply = await self._exchange(command, self.con.read_until, timeout_s)
+        return str(reply, encoding="utf-8")
+
+    async def query_bytes(self, command, n_bytes, timeout_s=None):
+        if timeout_s is None:
+            timeout_s = self.reply_timeout(n_bytes)
+        return await self._exchange(command, lambda: self.con.read_exact(n_bytes), timeout_s)
+
+    async def query_many(self, commands, timeout_s=None):
+        # Sends the queries on one line and returns the replies in order
+        if timeout_s is None:
+            timeout_s = self.timeout_s
+
+        async def read_all():
+            return [str(await self.con.read_until(b'\r'), encoding="utf-8") for _ in commands]
+
+        return await self._exchange(";".join(commands), read_all, timeout_s)
+
+    async def settings(self, keys):
+        keys = list(keys)
+        return dict(zip(keys, await self.query_many([profiles.query_command(key) for key in keys])))
+
+    async def apply_profile(self, profile):
+        # As srs830.apply_profile, returns the keys changed, the keys that did not take, and the settings in effect
+        current = await self.settings(profile)
+        changed = profiles.differences(profile, current)
+        rejected = []
+        if changed:
+            await self.write(";".join(profiles.set_command(key, profile[key]) for key in changed))
+            after = await self.settings(changed)
+            rejected = profiles.differences({key: profile[key] for key in changed}, after)
+            current.update(after)
+        return changed, rejected, current
+
+    async def wait_until_ready(self, settle_s, timeout_s=common.SRS830_READY_TIMEOUT_S):
+        # As srs830.wait_until_ready
+        await asyncio.sleep(settle_s)
+        deadline = time.time() + timeout_s
+        while True:
+            if not int(await self.query("LIAS ?")) & profiles.STATUS_UNLOCKED:
+                return True
+            if time.time() >= deadline:
+                return False
+            await asyncio.sleep(common.SRS830_READY_POLL_S)
+
+    async def identify(self):
+        return await self.query("*IDN ?")
+
+    async def points(self):
+        t0 = metrics.start()
+        points = int(await self.query("SPTS ?"))
+        metrics.stop("spts", t0)
+        return points
+
+    async def trace(self, channel, points, offset=0):
+        # Raw buffer contents of a channel in the configured transfer format, returns (data, decode function)
+        t0 = metrics.start()
+        match common.SRS830_TRANSFER_MODE:
+            case common.SRS830_TRANSFER_IEEE:
+                data = await self.query_bytes(f"TRCB ? {channel}, {offset}, {points}", 4 * points)
+                decode = srs830.decode_ieee
+
+            case common.SRS830_TRANSFER_LIA:
+                data = await self.query_bytes(f"TRCL ? {channel}, {offset}, {points}", 4 * points)
+                decode = srs830.decode_lia
+
+            case _:
+                # Roughly 15 characters per point in ASCII
+                data = await self._exchange(f"TRCA ? {channel}, {offset}, {points}", self.con.read_until,
+                                            self.reply_timeout(15 * points))
+                decode = srs830.decode_ascii
+
+        metrics.stop("transfer", t0)
+        metrics.count("bytes_transferred", len(data))
+        return data, decode
+
+
+class AsyncSRS830Handler(srs830.SRS830Handler):
+    def __init__(self, data_queue, command_queue, run_name, run_dir, serial_port=None, name="srs830",
+                 profile=None):
+        self.instrument = None
+        self.port_defined = None
+        self.acquiring = None
+        self.publishing = None  # Newest decode-and-publish task, each one waits for the one before
+        super().__init__(data_queue, command_queue, run_name, run_dir, serial_port=serial_port, name=name,
+                         profile=profile)
+
+    def run(self):
+        self.logger.info("Starting AsyncSRS830Handler")
+        asyncio.run(self.main())
+        self.end()
+
+    async def main(self):
+        self.port_defined = asyncio.Event()
+        if self.serialPortDefined:
+            self.port_defined.set()
+        self.acquiring = asyncio.create_task(self.acquire())
+        try:
+            await self.watch_commands()
+        finally:
+            self.state = common.SRS830_STATE_RUN_ENDING
+            self.acquiring.cancel()
+            await asyncio.gather(self.acquiring, return_exceptions=True)
+            if self.publishing is not None:
+                # Transferred captures are still published
+                await asyncio.gather(self.publishing, return_exceptions=True)
+
+    async def watch_commands(self):
+        while not self.flagEnd:
+            while not self.queue_commands_in.empty():
+                self.handle_command(self.queue_commands_in.get())
+            await asyncio.sleep(common.SRS830_COMMAND_POLL_S)
+
+    def handle_command(self, command):
+        self.logger.info(f"Received command {command}")
+        match command:
+            case common.SRS830_COMMAND_RAISE_END_FLAG:
+                self.logger.info("Raising the end flag")
+                self.flagEnd = True
+
+            case common.SRS830_COMMAND_SET_SERIAL_PORT:
+                port = self.queue_commands_in.get()
+                if self.state == common.SRS830_STATE_WAITING_FOR_SERIAL_PORT:
+                    self.serialPort = port
+                    self.logger.info(f"Setting serial port to {self.serialPort}")
+                    self.port_defined.set()
+
+            case common.SRS830_COMMAND_CLOSE_SERIAL_PORT:
+                # Stays closed until a port is set again
+                self.port_defined.clear()
+                self.acquiring.cancel()
+                self.acquiring = asyncio.create_task(self.acquire())
+
+            case _:
+                self.logger.error(f"Error - Command not handled properly {command}")
+
+    async def acquire(self):
+        try:
+            while True:
+                self.state = common.SRS830_STATE_WAITING_FOR_SERIAL_PORT
+                if not self.port_defined.is_set():
+                    self.logger.info("Waiting for serial port definition")
+                    await self.port_defined.wait()
+                connected = False
+                try:
+                    connected = await self.connect()
+                    if connected:
+                        if common.SRS830_ACQUISITION_MODE == common.SRS830_ACQUISITION_CONTINUOUS:
+                            await self.stream()
+                        else:
+                            await self.burst()
+                except (TimeoutError, OSError, ValueError) as e:
+                    self.logger.error(f"Lost communication with the SRS830: {e!r}")
+                self.close_port()
+                if not connected:
+                    # Reconnecting after a lost connection is immediate, a failed attempt is retried after a while
+                    await asyncio.sleep(common.SRS830_RECONNECT_INTERVAL_S)
+        finally:
+            self.close_port()
+
+    def close_port(self):
+        super().close_port()
+        self.instrument = None
+
+    async def connect(self):
+        self.logger.info(f"Attempting to connect to serial port {self.serialPort}.")
+        self.ser = transport.open_serial_async(self.serialPort, common.SRS830_BAUD)
+        self.instrument = AsyncSRS830(self.ser)
+        await self.ser.discard(common.SRS830_QUIET_S)  # The instrument may still be sending an abandoned reply
+        await self.instrument.write("OUTX 0")
+        if "SR830" not in await self.instrument.identify():
+            self.logger.warning("Could not verify serial port connection. Closing connection.")
+            self.close_port()
+            return False
+
+        self.logger.info("Communication with SRS830 verified! Checking configuration.")
+        t0 = time.time()
+        changed, rejected, self.instrument_settings = await self.instrument.apply_profile(self.profile)
+        if rejected:
+            self.logger.error(f"Settings not accepted by the instrument: "
+                              f"{', '.join(f'{k} = {self.instrument_settings[k]}, wanted {self.profile[k]}' for k in rejected)}")
+        settle_s = profiles.settling_time_s(changed, self.instrument_settings)
+        if not await self.instrument.wait_until_ready(settle_s):
+            self.logger.warning("Reference is not locked, capturing anyway")
+        self.logger.info(f"Configured in {time.time() - t0:.2f} s, {len(changed)} settings changed, "
+                         f"waited {settle_s:.3f} s to settle")
+        if "SRAT" in self.instrument_settings:
+            self.rate_index = int(self.instrument_settings["SRAT"])
+            self.rate_hz = profiles.rate_hz(self.rate_index)
+        return True
+
+    async def apply_rate(self):
+        # As SRS830Handler.apply_rate
+        if self.next_rate_index is None or self.next_rate_index == self.rate_index:
+            return
+        await self.instrument.write(f"SRAT {self.next_rate_index}")
+        self.rate_index = self.next_rate_index
+        self.instrument_settings["SRAT"] = str(self.rate_index)
+        self.rate_hz = profiles.rate_hz(self.rate_index)
+
+    async def burst(self):
+        while True:
+            self.state = common.SRS830_STATE_RUN_CAPTURING_DATA
+            await self.apply_rate()
+            start_time = time.time()
+            await self.instrument.write("REST")  # Reset buffer
+            await self.instrument.write("STRT")  # Start data capture
+            if self.acquisition_start_time is None:
+                self.acquisition_start_time = start_time
+            t0 = metrics.start()
+            await asyncio.sleep(self.capture_time_s)
+            metrics.stop("capture_wait", t0)
+            await self.instrument.write("PAUS")
+
+            self.state = common.SRS830_STATE_RUN_TRANSFERRING_DATA
+            self.spts_time = time.time()
+            points = await self.instrument.points()
+            self.time_captured_s += points / self.rate_hz
+            self.hand_off(start_time, await self.transfer_raw(0, points), points)
+
+    async def stream(self):
+        while True:
+            await self.apply_rate()
+            rollover = self.rollover_points()
+            start_time = time.time()
+            await self.instrument.write("REST")
+            await self.instrument.write("STRT")
+            if self.acquisition_start_time is None:
+                self.acquisition_start_time = start_time
+            self.state = common.SRS830_STATE_RUN_STREAMING_DATA
+            self.segment_index += 1
+            self.segment_start_time = start_time
+            self.read_offset = 0
+            self.next_poll_time = start_time + self.capture_time_s
+
+            restart = False
+            while not restart:
+                delay = self.next_poll_time - time.time()
+                if delay > 0:
+                    t0 = metrics.start()
+                    await asyncio.sleep(delay)
+                    metrics.stop("capture_wait", t0)
+                self.next_poll_time += self.capture_time_s
+
+                self.spts_time = time.time()
+                points = await self.instrument.points()
+                restart = points >= rollover
+                if restart:
+                    # Buffer is close to full, stop it and collect the tail before restarting
+                    await self.instrument.write("PAUS")
+                    points = await self.instrument.points()
+
+                new_points = points - self.read_offset
+                if new_points > 0:
+                    chunk_start = self.segment_start_time + self.read_offset / self.rate_hz
+                    self.time_captured_s += new_points / self.rate_hz
+                    self.hand_off(chunk_start, await self.transfer_raw(self.read_offset, new_points), new_points)
+                    self.read_offset = points
+
+    async def transfer_raw(self, offset, points):
+        raw_r = await self.instrument.trace(1, points, offset)
+        raw_theta = None
+        if common.SRS830_CAPTURE_PHASE:
+            raw_theta = await self.instrument.trace(2, points, offset)
+        return raw_r, raw_theta
+
+    def hand_off(self, start_time, raw, points):
+        # Decoding and publishing run while the next capture is taken, in order. The capture info is taken here on the
+        # loop, before the acquisition moves its counters and timings on to the next capture.
+        info, settings = self.claim(points, self.rate_hz)
+        self.publishing = asyncio.create_task(self.finish(self.publishing, start_time, raw, info, settings))
+
+    async def finish(self, previous, start_time, raw, info, settings):
+        if previous is not None:
+            await asyncio.gather(previous, return_exceptions=True)
+        data_r = await asyncio.to_thread(self.decode_and_emit, start_time, raw, info, settings)
+        if self.controller is not None:
+            # Back on the loop, which is the only place capture_time_s and next_rate_index are touched
+            self.adapt(start_time, data_r, info["sample_rate_hz"])
+
+    def decode_and_emit(self, start_time, raw, info, settings):
+        rate_hz = info["sample_rate_hz"]
+        t0 = metrics.start()
+        (data, decode), raw_theta = raw
+        data_r = decode(data)
+        timebase = np.arange(len(data_r)) / rate_hz
+        if raw_theta is not None:
+            data, decode = raw_theta
+            data_theta = decode(data)
+        else:
+            data_theta = np.zeros(timebase.shape)
+        metrics.stop("parse", t0)
+        self.emit(start_time, (timebase, data_r, data_theta), info, settings)
+        return data_r
@@ -0,0 +1,264 @@
+# srs830_sim.py
+#
+# SR830 lock-in simulator on a pseudo-terminal, for running the full acquisition path without the instrument.
+#
+# The simulator opens a pty and answers the subset of the SR830 command set used by srs830.py. The data buffer is
+# filled in real time at the configured sample rate with a synthetic chopped reflectance signal: a square wave
+# whose upper level follows a growth oscillation, plus gaussian noise. Replies are paced to the configured baud
+# rate so transfer times match the real RS232 link.
+#
+# Run standalone with "python srs830_sim.py" and point SRS830Handler at the printed port name.
+#
+# David Lister
+# July 2023
+#
+
+import argparse
+import logging
+import os
+import select
+import threading
+import time
+import tty
+import numpy as np
+import common
+
+logger = logging.getLogger("RTLR.srs830_sim")
+
+IDN = "Stanford_Research_Systems,SR830,s/n00000,ver1.07"
+BUFFER_POINTS = 16383
+MAX_RATE_INDEX = 13
+
+# Settings accepted and echoed back by queries, with their reset values
+DEFAULT_SETTINGS = {"FMOD": "1", "FREQ": "1000", "SLVL": "1", "ISRC": "0", "IGND": "0", "ICPL": "0", "RMOD": "1",
+                    "SENS": "26", "OFLT": "8", "OFSL": "1", "SYNC": "0", "DDEF 1": "0,0", "DDEF 2": "0,0",
+                    "SRAT": "4", "SEND": "1", "TSTR": "0", "OUTX": "0", "HARM": "1", "PHAS": "0"}
+
+
+def rate_from_index(index):
+    # SRAT 0 is 62.5 mHz, each step doubles up to 512 Hz at SRAT 13
+    return 0.0625 * 2 ** index
+
+
+def encode_lia(values):
+    # Inverse of srs830.decode_lia, value = mantissa * 2^(exponent - 124)
+    mantissa, exponent = np.frexp(np.asarray(values, dtype=np.float64))
+    words = np.empty((len(mantissa), 2), dtype='<i2')
+    words[:, 0] = np.round(mantissa * 2 ** 14)
+    words[:, 1] = np.where(mantissa == 0, 0, exponent - 14 + 124)
+    return words.tobytes()
+
+
+class SignalModel:
+    def __init__(self, growth_period_s=60, chop_hz=7.0, dark_v=0.002, mean_v=0.015, amplitude_v=0.004,
+                 noise_v=0.0002, seed=None):
+        self.growth_period_s = growth_period_s
+        self.chop_hz = chop_hz
+        self.dark_v = dark_v
+        self.mean_v = mean_v
+        self.amplitude_v = amplitude_v
+        self.noise_v = noise_v
+        self.rng = np.random.default_rng(seed)
+
+    def reflectance(self, t):
+        return self.mean_v + self.amplitude_v * np.sin(2 * np.pi * t / self.growth_period_s)
+
+    def sample(self, t):
+        chopper_open = np.floor(2 * self.chop_hz * t) % 2 == 0
+        r = np.where(chopper_open, self.reflectance(t), self.dark_v)
+        return r + self.rng.normal(0, self.noise_v, len(t))
+
+    def phase(self, t):
+        return 130 + self.rng.normal(0, 0.5, len(t))
+
+
+class SR830Simulator:
+    def __init__(self, model=None, baud=common.SRS830_BAUD, pacing=True):
+        self.model = model if model is not None else SignalModel()
+        self.baud = baud
+        self.pacing = pacing
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.port_name = os.ttyname(self.slave)
+        self.settings = dict(DEFAULT_SETTINGS)
+        self.clock_start = time.time()
+
+        # Buffer state
+        self.buffer_r = np.zeros(BUFFER_POINTS)
+        self.buffer_theta = np.zeros(BUFFER_POINTS)
+        self.stored = 0  # Points generated into the buffer
+        self.running = False
+        self.run_start = 0  # Simulator time the current run of storage began
+        self.run_start_point = 0  # Buffer index at run_start
+
+        self.silent = False  # Ignores commands while True, as if the cable were pulled
+        self.garbled_replies = 0  # Text replies to corrupt, as after a glitch on the cable
+        self.flagEnd = False
+        self.bytes_sent = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.flagEnd = True
+        self.thread.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+    def now(self):
+        return time.time() - self.clock_start
+
+    def rate(self):
+        return rate_from_index(min(int(self.settings["SRAT"]), MAX_RATE_INDEX))
+
+    def update_buffer(self):
+        # Generates samples for the time elapsed since the last update
+        if not self.running:
+            return
+        target = self.run_start_point + int((self.now() - self.run_start) * self.rate())
+        target = min(target, BUFFER_POINTS)
+        if target > self.stored:
+            t = self.run_start + (np.arange(self.stored, target) - self.run_start_point) / self.rate()
+            self.buffer_r[self.stored:target] = self.model.sample(t)
+            self.buffer_theta[self.stored:target] = self.model.phase(t)
+            self.stored = target
+        if self.stored == BUFFER_POINTS:
+            self.running = False  # Shot mode stops when full
+
+    def run(self):
+        pending = bytearray()
+        while not self.flagEnd:
+            ready, _, _ = select.select([self.master], [], [], 0.1)
+            if not ready:
+                continue
+            try:
+                pending += os.read(self.master, 4096)
+            except OSError:
+                break
+            if self.silent:
+                pending.clear()
+                continue
+            while True:
+                idx = min([i for i in (pending.find(b'\r'), pending.find(b'\n')) if i >= 0], default=-1)
+                if idx < 0:
+                    break
+                line = bytes(pending[:idx]).decode("ascii", errors="replace")
+                del pending[:idx + 1]
+                for command in line.split(";"):
+                    command = command.strip()
+                    if command:
+                        self.handle(command)
+
+    def reply(self, data):
+        if isinstance(data, str):
+            if self.garbled_replies > 0:
+                self.garbled_replies -= 1
+                data = "#" + data[1:]
+            data = bytes(data + "\r", encoding="ascii")
+        chunk = 64
+        bytes_per_s = self.baud / 10
+        t0 = time.perf_counter()
+        for i in range(0, len(data), chunk):
+            os.write(self.master, data[i:i + chunk])
+            if self.pacing:
+                delay = t0 + min(i + chunk, len(data)) / bytes_per_s - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+        self.bytes_sent += len(data)
+
+    def handle(self, command):
+        query = "?" in command
+        name, _, args = command.replace("?", " ").partition(" ")
+        name = name.upper()
+        args = [a.strip() for a in args.split(",") if a.strip()]
+        self.update_buffer()
+
+        match name:
+            case "*IDN":
+                self.reply(IDN)
+
+            case "*RST":
+                self.settings = dict(DEFAULT_SETTINGS)
+                self.reset_buffer()
+
+            case "REST":
+                self.reset_buffer()
+
+            case "STRT":
+                if not self.running and self.stored < BUFFER_POINTS:
+                    self.running = True
+                    self.run_start = self.now()
+                    self.run_start_point = self.stored
+
+            case "PAUS":
+                self.running = False
+
+            case "SPTS":
+                self.reply(str(self.stored))
+
+            case "LIAS":
+                self.reply("0")  # Always locked, no overloads
+
+            case "TRCA" | "TRCB" | "TRCL":
+                self.transfer(name, args)
+
+            case "DDEF" if args:
+                key = f"DDEF {args[0]}"
+                if query:
+                    self.reply(self.settings.get(key, "0,0"))
+                else:
+                    self.settings[key] = ",".join(args[1:])
+
+            case _ if name in self.settings:
+                if query:
+                    self.reply(self.settings[name])
+                elif args:
+                    self.settings[name] = args[0]
+
+            case _:
+                logger.warning(f"Unhandled command {command}")
+
+    def reset_buffer(self):
+        self.running = False
+        self.stored = 0
+        self.run_start_point = 0
+
+    def transfer(self, name, args):
+        channel, offset, points = int(args[0]), int(args[1]), int(args[2])
+        if offset + points > self.stored:
+            logger.warning(f"Transfer of {points} points at {offset} beyond the {self.stored} stored")
+            points = max(self.stored - offset, 0)
+        buffer = self.buffer_r if channel == 1 else self.buffer_theta
+        values = buffer[offset:offset + points]
+        match name:
+            case "TRCB":
+                self.reply(values.astype('<f4').tobytes())
+            case "TRCL":
+                self.reply(encode_lia(values))
+            case _:
+                self.reply("".join(f"{v:.6e}," for v in values))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SR830 simulator on a pseudo-terminal")
+    parser.add_argument("--period", type=float, default=60, help="Growth oscillation period (s)")
+    parser.add_argument("--noise", type=float, default=0.0002, help="Gaussian noise on R (V)")
+    parser.add_argument("--chop", type=float, default=7.0, help="Chopper frequency (Hz)")
+    parser.add_argument("--baud", type=int, default=common.SRS830_BAUD)
+    parser.add_argument("--no-pacing", action="store_true", help="Reply as fast as the pty allows")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    sim = SR830Simulator(SignalModel(growth_period_s=args.period, chop_hz=args.chop, noise_v=args.noise,
+                                     seed=args.seed),
+                         baud=args.baud, pacing=not args.no_pacing)
+    print(sim.port_name, flush=True)
+    sim.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        sim.stop()
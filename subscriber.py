@@ -0,0 +1,116 @@
+# subscriber.py
+#
+# Client for the live results stream of publisher.py.
+#
+# Subscriber connects to a running RTLR and yields its frames as named tuples of NumPy arrays. Times are seconds
+# since the run's init time, which is available as init_time once the first frame has been read.
+#
+#     with subscriber.Subscriber(raw=True) as sub:
+#         for frame in sub:
+#             if isinstance(frame, subscriber.Reflectance):
+#                 print(frame.instrument, frame.time[-1], frame.reflectance[-1])
+#
+# Run standalone with "python subscriber.py" to print the reflectance as it arrives.
+#
+# David Lister
+# July 2023
+#
+
+import argparse
+import collections
+import numpy as np
+import common
+import publisher
+
+Reflectance = collections.namedtuple("Reflectance", ["instrument", "time", "reflectance"])
+RawCapture = collections.namedtuple("RawCapture", ["instrument", "start_time", "sample_rate_hz", "voltage"])
+
+
+class Subscriber:
+    def __init__(self, address=common.PUBLISH_ADDRESS, reflectance=True, raw=False, timeout_s=None):
+        # timeout_s is how long a read waits for the next frame, None waits forever
+        self.address = address
+        self.mask = (publisher.SUBSCRIBE_REFLECTANCE if reflectance else 0) | (publisher.SUBSCRIBE_RAW if raw else 0)
+        self.run_name = None
+        self.init_time = None
+        self.con = publisher.open_socket(address)
+        self.con.settimeout(timeout_s)
+        self.con.connect(address)
+        self.con.sendall(bytes([self.mask]))
+
+    def read_exact(self, n):
+        data = bytearray(n)
+        view = memoryview(data)
+        got = 0
+        while got < n:
+            count = self.con.recv_into(view[got:])
+            if count == 0:
+                raise EOFError("Publisher closed the connection")
+            got += count
+        return data
+
+    def read(self):
+        # Next data frame, the hello frame is read along the way
+        while True:
+            magic, version, frame_type, length = publisher.HEADER.unpack(self.read_exact(publisher.HEADER.size))
+            if magic != publisher.MAGIC or version != publisher.VERSION:
+                raise ValueError(f"Not an RTLR stream, or an unsupported version {version}")
+            payload = self.read_exact(length)
+            match frame_type:
+                case publisher.FRAME_HELLO:
+                    self.init_time, = publisher.HELLO.unpack_from(payload)
+                    self.run_name = payload[publisher.HELLO.size:].decode("utf-8")
+
+                case publisher.FRAME_REFLECTANCE:
+                    name_length, count = publisher.REFLECTANCE.unpack_from(payload)
+                    offset = publisher.REFLECTANCE.size
+                    name = payload[offset:offset + name_length].decode("utf-8")
+                    values = np.frombuffer(payload, dtype="<f8", count=2 * count, offset=offset + name_length)
+                    return Reflectance(name, values[:count], values[count:])
+
+                case publisher.FRAME_RAW:
+                    name_length, count, start_time, rate_hz = publisher.RAW.unpack_from(payload)
+                    offset = publisher.RAW.size
+                    name = payload[offset:offset + name_length].decode("utf-8")
+                    voltage = np.frombuffer(payload, dtype="<f4", count=count, offset=offset + name_length)
+                    return RawCapture(name, start_time, rate_hz, voltage)
+
+                case _:
+                    pass  # Newer frame types are skipped
+
+    def __iter__(self):
+        try:
+            while True:
+                yield self.read()
+        except EOFError:
+            return
+
+    def close(self):
+        self.con.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Print the live reflectance of a running RTLR")
+    parser.add_argument("--address", default=None, help="Unix socket path or host:port, default is PUBLISH_ADDRESS")
+    parser.add_argument("--raw", action="store_true", help="Also report raw captures")
+    args = parser.parse_args()
+
+    address = common.PUBLISH_ADDRESS
+    if args.address is not None:
+        host, _, port = args.address.rpartition(":")
+        address = (host, int(port)) if port.isdigit() and host else args.address
+
+    with Subscriber(address, raw=args.raw) as sub:
+        for frame in sub:
+            if isinstance(frame, Reflectance):
+                for t, r in zip(frame.time.tolist(), frame.reflectance.tolist()):
+                    print(f"{sub.run_name} {frame.instrument} {t:.3f} s {r:.6f} V", flush=True)
+            else:
+                print(f"{sub.run_name} {frame.instrument} raw capture of {len(frame.voltage)} samples at "
+                      f"{frame.sample_rate_hz:g} Hz", flush=True)
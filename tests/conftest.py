@@ -0,0 +1,12 @@
+# conftest.py
+#
+# The modules live at the top of the repository, so it goes on the path for the tests.
+#
+# David Lister
+# July 2023
+#
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,35 @@
+# test_acquisition.py
+#
+# Tests for the shared memory capture ring of the acquisition process.
+#
+# David Lister
+# July 2023
+#
+
+import numpy as np
+from multiprocessing import resource_tracker
+import acquisition
+import common
+
+
+def test_attached_ring_sees_writes_and_is_not_tracked(monkeypatch):
+    owner = acquisition.SharedCaptureRing(2, 16)
+    registered = []
+    monkeypatch.setattr(resource_tracker, "register", lambda name, rtype: registered.append((name, rtype)))
+    attached = acquisition.SharedCaptureRing(2, 16, name=owner.name)
+    monkeypatch.undo()
+    try:
+        n = attached.write(1, 7, np.arange(10.0), np.ones(10), np.zeros(10))
+        assert owner.is_ready(1, 7) and not owner.is_ready(0, 7)
+        assert np.array_equal(owner.data(1, n)[0], np.arange(10.0))
+        assert registered == []
+    finally:
+        attached.close()
+        owner.close()
+
+
+def test_settings_include_run_time_changes(monkeypatch):
+    monkeypatch.setattr(common, "SHM_SLOTS", 3)
+    config = acquisition.settings()
+    assert config["SHM_SLOTS"] == 3
+    assert all(key.isupper() for key in config)
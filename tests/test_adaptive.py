@@ -0,0 +1,57 @@
+# test_adaptive.py
+#
+# Tests for adapting the capture length and sample rate, on captures from the simulator's signal model.
+#
+# David Lister
+# July 2023
+#
+
+import numpy as np
+import adaptive
+import common
+import profiles
+import srs830_sim
+
+
+def run(model, n_captures=8, start_time=0.0, gap_s=0.1):
+    # Captures as the controller asks for them, returns its (capture time, SRAT index) after each
+    controller = adaptive.CaptureController()
+    t = start_time
+    choices = []
+    for _ in range(n_captures):
+        rate_hz = profiles.rate_hz(controller.rate_index)
+        n = int(controller.capture_time_s * rate_hz)
+        choices.append(controller.update(t, model.sample(t + np.arange(n) / rate_hz), rate_hz))
+        t += n / rate_hz + gap_s
+    return choices
+
+
+def test_noise_estimate_ignores_chopper_steps():
+    model = srs830_sim.SignalModel(noise_v=1e-3, seed=2)
+    assert abs(adaptive.noise_sigma(model.sample(np.arange(4096) / 512)) - 1e-3) < 1e-4
+
+
+def test_quiet_steady_signal_keeps_length_and_slows_rate():
+    choices = run(srs830_sim.SignalModel(growth_period_s=1e9, noise_v=1e-6, seed=1))
+    assert all(t == common.SRS830_CAPTURE_TIME_S and index == common.ADAPTIVE_MIN_RATE_INDEX for t, index in choices)
+
+
+def test_noisy_signal_lengthens_in_steps():
+    choices = run(srs830_sim.SignalModel(growth_period_s=1e9, noise_v=2e-3, seed=1))
+    times = [t for t, _ in choices]
+    assert times[:3] == [2, 4, 8] and times[-1] == common.ADAPTIVE_MAX_TIME_S
+    assert all(index == common.ADAPTIVE_MAX_RATE_INDEX for _, index in choices)
+
+
+def test_fast_growth_shortens_captures():
+    choices = run(srs830_sim.SignalModel(growth_period_s=20, noise_v=1e-6, seed=1), start_time=2.5)
+    times = [t for t, _ in choices]
+    assert times[-1] == common.ADAPTIVE_MIN_TIME_S
+    assert all(later >= earlier / common.ADAPTIVE_MAX_STEP for earlier, later in zip(times, times[1:]))
+
+
+def test_short_or_dark_captures_change_nothing():
+    controller = adaptive.CaptureController()
+    before = (controller.capture_time_s, controller.rate_index)
+    assert controller.update(0.0, np.ones(3), 512.0) == before
+    assert controller.update(0.0, np.zeros(512), 512.0) == before
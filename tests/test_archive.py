@@ -0,0 +1,94 @@
+# test_archive.py
+#
+# Tests for the raw capture archive.
+#
+# David Lister
+# July 2023
+#
+
+import os
+import numpy as np
+import pytest
+import archive
+
+
+def capture(i, n=100, rate_hz=512.0):
+    t = np.arange(n) / rate_hz
+    return t, np.sin(t + i).astype(np.float32), np.cos(t + i)
+
+
+def write_archive(run_dir, capture_indices, start_times=None):
+    w = archive.ArchiveWriter(run_dir)
+    if start_times is None:
+        start_times = [100.0 + 2 * i for i in capture_indices]
+    for i, t in zip(capture_indices, start_times):
+        w.write(i, t, 512.0, *capture(i), settings={"capture_index": i, "profile": "default"})
+    w.close()
+
+
+def test_round_trip(tmp_path):
+    write_archive(str(tmp_path), range(3))
+    reader = archive.ArchiveReader(str(tmp_path))
+    assert len(reader) == 3 == archive.count(str(tmp_path))
+    for i in range(3):
+        timebase, r, theta = reader.capture(i)
+        expected = capture(i)
+        assert np.array_equal(timebase, expected[0])
+        assert np.array_equal(r, expected[1])  # float32 samples are kept exactly in float64
+        assert np.array_equal(theta, expected[2])
+        assert reader.header(i) == {"capture_index": i, "start_time": 100.0 + 2 * i, "sample_rate_hz": 512.0,
+                                    "n_samples": 100, "settings": {"capture_index": i, "profile": "default"}}
+
+
+def test_find_capture(tmp_path):
+    # Numbered from 5, with 7 missing, so 8 and 9 are not where their numbers put them
+    write_archive(str(tmp_path), [5, 6, 8, 9])
+    reader = archive.ArchiveReader(str(tmp_path))
+    assert [reader.find_capture(i) for i in (5, 6, 8, 9)] == [0, 1, 2, 3]
+    for missing in (4, 7, 10):
+        with pytest.raises(KeyError):
+            reader.find_capture(missing)
+
+
+def test_find_time(tmp_path):
+    write_archive(str(tmp_path), range(4))
+    reader = archive.ArchiveReader(str(tmp_path))
+    assert reader.find_time(99.0) == 0
+    assert reader.find_time(100.0) == 0
+    assert reader.find_time(103.9) == 1
+    assert reader.find_time(104.0) == 2
+    assert reader.find_time(1000.0) == 3
+    assert list(reader.between(101.0, 104.0)) == [1, 2]
+
+
+def test_resume_after_a_partial_block(tmp_path):
+    # The process died part way through writing a block, and part way through its index record
+    run_dir = str(tmp_path)
+    write_archive(run_dir, range(3))
+    with open(os.path.join(run_dir, archive.DATA_FILE), 'ab') as f:
+        f.write(archive.BLOCK_MAGIC + bytes(37))
+    with open(os.path.join(run_dir, archive.INDEX_FILE), 'ab') as f:
+        f.write(bytes(11))
+    assert len(archive.ArchiveReader(run_dir)) == 3
+
+    write_archive(run_dir, [3])
+    reader = archive.ArchiveReader(run_dir)
+    assert [reader.header(i)["capture_index"] for i in range(len(reader))] == [0, 1, 2, 3]
+    assert np.array_equal(reader.capture(3)[1], capture(3)[1])
+
+
+def test_resume_after_a_truncated_block(tmp_path):
+    # The last block's index record reached the disk but not all of the block
+    run_dir = str(tmp_path)
+    write_archive(run_dir, range(3))
+    data_path = os.path.join(run_dir, archive.DATA_FILE)
+    os.truncate(data_path, os.path.getsize(data_path) - 100)
+    reader = archive.ArchiveReader(run_dir)
+    assert len(reader) == 2
+    assert np.array_equal(reader.capture(1)[2], capture(1)[2])
+
+    write_archive(run_dir, [3])
+    reader = archive.ArchiveReader(run_dir)
+    assert [reader.header(i)["capture_index"] for i in range(len(reader))] == [0, 1, 3]
+    assert np.array_equal(reader.capture(2)[1], capture(3)[1])
+    assert reader.header(2)["settings"]["capture_index"] == 3
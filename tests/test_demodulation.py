@@ -0,0 +1,75 @@
+# test_demodulation.py
+#
+# Tests for sliding-window demodulation and its use in the analysis stage.
+#
+# David Lister
+# July 2023
+#
+
+import numpy as np
+import analysis
+import common
+import demodulation
+import reflectance
+
+
+def square_wave(n, rate_hz, chop_hz, dark=0.2, lit=1.0, start=0):
+    t = (start + np.arange(n)) / rate_hz
+    return np.where(np.sin(2 * np.pi * chop_hz * t) >= 0, lit, dark)
+
+
+def test_detect_frequency():
+    r = square_wave(2048, 512.0, 37.3)
+    assert abs(demodulation.detect_frequency(r, 512.0) - 37.3) < 0.1
+    assert demodulation.detect_frequency(np.ones(4), 512.0) is None
+
+
+def test_windows_give_the_step():
+    demodulator = demodulation.Demodulator()
+    times, values = demodulator.process(10.0, 512.0, square_wave(1024, 512.0, 16.0))
+    assert len(values) > 20
+    assert np.allclose(values, 0.8, atol=0.02)
+    assert np.all(np.diff(times) > 0) and times[0] > 10.0 and times[-1] < 12.0
+
+
+def test_windows_run_across_contiguous_captures():
+    demodulator = demodulation.Demodulator()
+    r = square_wave(2048, 512.0, 16.0)
+    t1, v1 = demodulator.process(0.0, 512.0, r[:1024])
+    t2, v2 = demodulator.process(2.0, 512.0, r[1024:])
+    whole_t, whole_v = demodulation.Demodulator().process(0.0, 512.0, r)
+    assert np.allclose(np.concatenate((t1, t2)), whole_t)
+    assert np.allclose(np.concatenate((v1, v2)), whole_v, atol=1e-3)  # Each capture refines the frequency
+
+
+def test_batch_interface_gives_the_mean_of_each_capture():
+    # calculate_batch keeps no state between captures, so each gives one value rather than its windows
+    r = np.stack((square_wave(1024, 512.0, 16.0), square_wave(1024, 512.0, 16.0, lit=0.6)))
+    values = reflectance.calculate_batch(r, common.CALC_DEMODULATION, np.array([512.0, 512.0]))
+    assert values.shape == (2,)
+    for row, value in zip(r, values):
+        _, windows = demodulation.Demodulator().process(0.0, 512.0, row)
+        assert np.isclose(value, np.mean(windows))
+    assert np.allclose(values, [0.8, 0.4], atol=0.02)
+
+
+def item(start_time, r, rate_hz=512.0):
+    return [start_time, (np.arange(len(r)) / rate_hz, r, np.zeros(len(r))), {"sample_rate_hz": rate_hz}]
+
+
+def test_empty_batch_keeps_previous_film(tmp_path, monkeypatch):
+    monkeypatch.setattr(common, "CALC_TYPE", common.CALC_DEMODULATION)
+    monkeypatch.setattr(common, "TRACK_THICKNESS", True)
+    stream = analysis.InstrumentStream(str(tmp_path), {"name": "srs830"})
+    r = square_wave(1024, 512.0, 16.0)
+    series = stream.process(np.array([0.0]), [item(0.0, r)])
+    film = series["film"]
+    assert film is not None and len(series["time"]) > 0
+
+    # Too short for a window, and not contiguous so nothing is carried over
+    series = stream.process(np.array([5.0]), [item(5.0, r[:8])])
+    assert len(series["time"]) == 0 and len(series["reflectance"]) == 0
+    assert series["film"] == film
+    stream.close()
+    rows = np.loadtxt(tmp_path / "Reflectance.csv", delimiter=",", skiprows=1)
+    assert np.all(rows[:, 0] < 5.0)
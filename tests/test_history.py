@@ -0,0 +1,62 @@
+# test_history.py
+#
+# Tests for the bounded-memory history.
+#
+# David Lister
+# July 2023
+#
+
+import numpy as np
+import history
+
+
+def filled(tmp_path, n=10007, step=7):
+    h = history.History(ram_budget_bytes=16 * 1000, chunk_points=100, spill_dir=str(tmp_path))
+    for i in range(0, n, step):
+        t = np.arange(i, min(i + step, n), dtype=np.float64)
+        h.extend(t, 2 * t)
+    return h
+
+
+def test_spill_keeps_every_point(tmp_path):
+    h = filled(tmp_path)
+    assert h.n_spilled > 0
+    assert h.nbytes_ram() <= 16 * 1000
+    t, v = h.slice()
+    assert np.array_equal(t, np.arange(10007))
+    assert np.array_equal(v, 2 * t)
+    h.close()
+
+
+def test_time_range_across_the_boundary(tmp_path):
+    h = filled(tmp_path)
+    boundary = h.n_spilled
+    t, v = h.time_range(boundary - 5, boundary + 5)
+    assert np.array_equal(t, np.arange(boundary - 5, boundary + 6))
+    h.close()
+
+
+def test_decimated_is_bounded_and_ends_on_the_newest_point(tmp_path):
+    h = filled(tmp_path)
+    t, v = h.decimated(max_points=1000)
+    assert len(t) <= 1001
+    assert t[0] == 0 and t[-1] == 10006
+    assert np.all(np.diff(t) > 0)
+    assert np.array_equal(v, 2 * t)
+    h.close()
+
+
+def test_decimated_small_range_is_exact(tmp_path):
+    h = filled(tmp_path)
+    t, _ = h.decimated(50, 60, max_points=1000)
+    assert np.array_equal(t, np.arange(50, 61))
+    h.close()
+
+
+def test_extend_larger_than_the_budget(tmp_path):
+    h = history.History(ram_budget_bytes=16 * 1000, chunk_points=100, spill_dir=str(tmp_path))
+    h.extend(np.arange(5000.), np.arange(5000.))
+    h.extend(np.arange(5000., 5010.), np.arange(5000., 5010.))
+    assert len(h) == 5010
+    assert np.array_equal(h.slice()[0], np.arange(5010))
+    h.close()
@@ -0,0 +1,39 @@
+# test_merge.py
+#
+# Tests for time-aligning several instruments.
+#
+# David Lister
+# July 2023
+#
+
+import numpy as np
+import merge
+
+
+def test_rows_wait_for_every_instrument():
+    merger = merge.Merger(["a", "b"], interval_s=1.0, max_wait_s=10.0)
+    merger.add("a", np.array([0.0, 2.0, 4.0]), np.array([0.0, 2.0, 4.0]))
+    merger.add("b", np.array([0.5, 1.5]), np.array([10.0, 20.0]))
+    grid, merged = merger.pop()
+    # b has only reached 1.5 s, and a has no data before 0 s
+    assert np.array_equal(grid, [0.0, 1.0])
+    assert np.allclose(merged["a"], [0.0, 1.0])
+    assert np.isnan(merged["b"][0]) and merged["b"][1] == 15.0
+
+    merger.add("b", np.array([3.5]), np.array([40.0]))
+    grid, merged = merger.pop()
+    assert np.array_equal(grid, [2.0, 3.0])
+    assert np.allclose(merged["a"], [2.0, 3.0])
+    assert np.allclose(merged["b"], [25.0, 35.0])
+
+
+def test_stalled_instrument_is_not_waited_for():
+    merger = merge.Merger(["a", "b"], interval_s=1.0, max_wait_s=2.0)
+    merger.add("a", np.arange(0.0, 11.0), np.arange(0.0, 11.0))
+    merger.add("b", np.array([0.0, 1.0]), np.array([5.0, 5.0]))
+    grid, merged = merger.pop()
+    assert np.array_equal(grid, np.arange(0.0, 11.0))
+    assert np.allclose(merged["a"], grid)
+    assert np.allclose(merged["b"][:2], 5.0) and np.all(np.isnan(merged["b"][2:]))
+    # Nothing is emitted twice
+    assert len(merger.pop()[0]) == 0
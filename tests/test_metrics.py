@@ -0,0 +1,73 @@
+# test_metrics.py
+#
+# Tests for the hot path metrics and their export.
+#
+# David Lister
+# July 2023
+#
+
+import json
+import os
+import time
+import pytest
+import metrics
+
+
+@pytest.fixture
+def fresh(monkeypatch):
+    monkeypatch.setattr(metrics, "enabled", True)
+    metrics.reset()
+    yield
+    metrics.reset()
+
+
+def test_disabled_records_nothing(fresh, monkeypatch):
+    t0 = metrics.start()  # Taken while enabled, as a stage already under way when metrics are turned off
+    monkeypatch.setattr(metrics, "enabled", False)
+    assert metrics.start() is None
+    metrics.stop("parse", t0)
+    assert metrics.lap("transfer", t0) is None
+    metrics.count("captures")
+    metrics.gauge("queue_depth", 3)
+    assert metrics.snapshot()["stages"] == {}
+    assert metrics.snapshot()["counters"] == {}
+    assert metrics.snapshot()["gauges"] == {}
+
+
+def test_exporter_file(fresh, tmp_path):
+    t0 = metrics.start()
+    t0 = metrics.lap("transfer", t0)
+    metrics.stop("parse", t0)
+    metrics.stop("parse", metrics.start())
+    metrics.count("samples", 512)
+    metrics.count("samples", 512)
+    metrics.gauge("queue_depth", 3)
+
+    exporter = metrics.Exporter(str(tmp_path), interval_s=0.01)
+    path = tmp_path / "metrics.json"
+    deadline = time.time() + 5
+    while not path.exists():
+        assert time.time() < deadline, "Nothing exported"
+        time.sleep(0.01)
+    metrics.count("captures")
+    exporter.join()
+
+    # The final export on joining has everything, and no temporary file is left behind
+    assert os.listdir(tmp_path) == ["metrics.json"]
+    with open(path) as f:
+        data = json.load(f)
+    assert set(data) == {"time", "stages", "counters", "gauges"}
+    assert abs(data["time"] - time.time()) < 5
+    assert data["counters"] == {"samples": 1024, "captures": 1}
+    assert data["gauges"] == {"queue_depth": 3}
+    assert set(data["stages"]) == {"transfer", "parse"}
+    parse = data["stages"]["parse"]
+    assert set(parse) == {"count", "mean_ms", "p50_ms", "p90_ms", "p99_ms", "max_ms"}
+    assert parse["count"] == 2
+    assert 0 <= parse["p50_ms"] <= parse["p90_ms"] <= parse["p99_ms"] <= parse["max_ms"]
+
+
+def test_exporter_disabled_writes_nothing(fresh, tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, "enabled", False)
+    metrics.Exporter(str(tmp_path), interval_s=0.01).join()
+    assert os.listdir(tmp_path) == []
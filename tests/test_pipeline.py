@@ -0,0 +1,52 @@
+# test_pipeline.py
+#
+# Tests for the bounded queues between the stages.
+#
+# David Lister
+# July 2023
+#
+
+import queue
+import threading
+import pytest
+import common
+import pipeline
+
+
+def test_block_waits_for_space():
+    q = pipeline.BoundedQueue(2, common.QUEUE_POLICY_BLOCK)
+    q.put(1)
+    q.put(2)
+    with pytest.raises(queue.Full):
+        q.put(3, timeout=0.05)
+    threading.Timer(0.05, q.get).start()
+    q.put(3, timeout=5)
+    assert q.drain() == [2, 3] and q.dropped == 0 and q.peak_depth == 2
+
+
+def test_drop_oldest_hands_back_what_it_drops():
+    dropped = []
+    q = pipeline.BoundedQueue(3, common.QUEUE_POLICY_DROP_OLDEST, on_drop=dropped.append)
+    for i in range(5):
+        q.put(i)
+    assert q.drain() == [2, 3, 4]
+    assert dropped == [0, 1] and q.dropped == 2 and q.peak_depth == 3
+
+
+def test_coalesce_merges_into_the_newest():
+    q = pipeline.BoundedQueue(2, common.QUEUE_POLICY_COALESCE, merge=lambda older, newer: older + newer)
+    for item in ([1], [2], [3], [4]):
+        q.put(item)
+    assert q.drain() == [[1], [2, 3, 4]]
+    assert q.coalesced == 2 and q.dropped == 0
+    with pytest.raises(ValueError):
+        pipeline.BoundedQueue(2, common.QUEUE_POLICY_COALESCE)
+
+
+def test_drain_limits_and_times_out():
+    q = pipeline.BoundedQueue(0)
+    assert q.drain(timeout=0.01) == []
+    for i in range(5):
+        q.put(i)
+    assert q.drain(max_items=3) == [0, 1, 2]
+    assert q.drain(max_items=3) == [3, 4]
@@ -0,0 +1,56 @@
+# test_profiles.py
+#
+# Tests for configuring the SR830 from profiles, against the simulator.
+#
+# David Lister
+# July 2023
+#
+
+import pytest
+import common
+import profiles
+import srs830
+import srs830_sim
+import transport
+
+pytest.importorskip("serial")
+
+
+@pytest.fixture
+def con():
+    sim = srs830_sim.SR830Simulator(pacing=False).start()
+    con = transport.open_serial(sim.port_name, common.SRS830_BAUD, common.SRS830_TIMEOUT_S)
+    yield sim, con
+    con.close()
+    sim.stop()
+
+
+def test_only_differences_are_sent(con):
+    sim, con = con
+    profile = common.SRS830_PROFILES["default"]
+    expected = profiles.differences(profile, srs830_sim.DEFAULT_SETTINGS)
+    changed, rejected, settings = srs830.apply_profile(con, profile)
+    assert changed == expected and rejected == []
+    assert all(profiles.same_value(sim.settings[key], value) for key, value in profile.items())
+    assert profiles.settling_time_s(changed, settings) == pytest.approx(7 * 1e-3)
+
+    # A reconnect to a configured instrument changes nothing and needs no settling
+    changed, rejected, settings = srs830.apply_profile(con, profile)
+    assert changed == [] and profiles.settling_time_s(changed, settings) == 0
+
+
+def test_values_compare_numerically():
+    assert profiles.same_value("2345", "2345.000")
+    assert profiles.same_value("1,0", " 1, 0")
+    assert not profiles.same_value("1,0", "1,1")
+    assert profiles.differences({"SENS": "24", "DDEF 1": "1,0"}, {"SENS": "24.0"}) == ["DDEF 1"]
+
+
+def test_settling_and_rates():
+    assert profiles.time_constant_s(4) == pytest.approx(1e-3)
+    assert profiles.time_constant_s(5) == pytest.approx(3e-3)
+    assert profiles.settling_time_s(["SRAT", "DDEF 1"], {"OFLT": "10", "OFSL": "3"}) == 0
+    assert profiles.settling_time_s(["SENS"], {"OFLT": "8", "OFSL": "3"}) == pytest.approx(10 * 0.1)
+    assert profiles.settling_time_s(["SENS"], {"OFLT": "19", "OFSL": "3"}) == common.SRS830_SETTLE_MAX_S
+    assert profiles.rate_hz(13) == 512
+    assert profiles.query_command("DDEF 1") == "DDEF ? 1" and profiles.set_command("DDEF 1", "1,0") == "DDEF 1,1,0"
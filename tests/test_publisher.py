@@ -0,0 +1,81 @@
+# test_publisher.py
+#
+# Tests for the live results stream, a publisher and subscriber over a local socket.
+#
+# David Lister
+# July 2023
+#
+
+import time
+import numpy as np
+import publisher
+import subscriber
+
+
+def wait_for(condition, timeout_s=5):
+    deadline = time.time() + timeout_s
+    while not condition():
+        assert time.time() < deadline, "Timed out"
+        time.sleep(0.01)
+
+
+def test_slow_subscriber_drops_frames_but_not_the_hello(tmp_path):
+    address = str(tmp_path / "rtlr.sock")
+    pub = publisher.Publisher("run", 1234.5, address=address, buffer_frames=4, raw=False)
+    try:
+        with subscriber.Subscriber(address, timeout_s=5) as sub:
+            wait_for(lambda: pub.subscriptions)
+            subscription = pub.subscriptions[0]
+
+            # Frames far bigger than the socket buffers, offered while nothing is read, so most are dropped
+            n_frames = 40
+            values = np.zeros(100000)
+            for i in range(n_frames):
+                pub.publish_reflectance("srs830", np.full(len(values), float(i)), values)
+            assert subscription.dropped > 0
+
+            received = [sub.read() for i in range(n_frames - subscription.dropped)]
+            assert sub.init_time == 1234.5
+            assert sub.run_name == "run"
+            firsts = [frame.time[0] for frame in received]
+            assert firsts == sorted(firsts)
+            assert firsts[-1] == n_frames - 1
+            assert all(frame.instrument == "srs830" and len(frame.reflectance) == len(values) for frame in received)
+    finally:
+        pub.join()
+
+
+def read_frame(f):
+    magic, version, frame_type, length = publisher.HEADER.unpack(f.read(publisher.HEADER.size))
+    assert magic == publisher.MAGIC
+    return frame_type, f.read(length)
+
+
+def test_hello_survives_a_full_buffer(tmp_path):
+    # Until the subscriber sends its subscription byte nothing is sent, so every frame waits in the buffer
+    address = str(tmp_path / "rtlr.sock")
+    pub = publisher.Publisher("run", 1234.5, address=address, buffer_frames=4, raw=False)
+    con = publisher.open_socket(address)
+    try:
+        con.settimeout(5)
+        con.connect(address)
+        wait_for(lambda: pub.subscriptions)
+        for i in range(10):
+            pub.publish_reflectance("srs830", np.array([float(i)]), np.array([0.5]))
+        assert pub.subscriptions[0].dropped == 6
+        con.sendall(bytes([publisher.SUBSCRIBE_REFLECTANCE]))
+
+        f = con.makefile("rb")
+        frame_type, payload = read_frame(f)
+        assert frame_type == publisher.FRAME_HELLO
+        assert publisher.HELLO.unpack_from(payload) == (1234.5,)
+        times = []
+        for i in range(4):
+            frame_type, payload = read_frame(f)
+            assert frame_type == publisher.FRAME_REFLECTANCE
+            times.append(np.frombuffer(payload, dtype="<f8", count=1, offset=publisher.REFLECTANCE.size + 6)[0])
+        assert times == [6, 7, 8, 9]
+        f.close()
+    finally:
+        con.close()
+        pub.join()
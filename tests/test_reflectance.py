@@ -0,0 +1,59 @@
+# test_reflectance.py
+#
+# Tests for the reflectance estimators.
+#
+# David Lister
+# July 2023
+#
+
+import numpy as np
+import common
+import reflectance
+
+
+def chopped(n=1024, dark=0.2, lit=1.0, period=64, noise=0.01, seed=0):
+    rng = np.random.default_rng(seed)
+    lit_mask = (np.arange(n) // (period // 2)) % 2 == 0
+    return np.where(lit_mask, lit, dark) + rng.normal(0, noise, n)
+
+
+def test_split_medians_matches_masked_medians():
+    rng = np.random.default_rng(1)
+    batch = np.vstack([chopped(seed=i) for i in range(4)] + [rng.normal(size=1024), rng.normal(size=1024)])
+    upper, lower = reflectance.split_medians(batch)
+    for row, u, l in zip(batch, upper, lower):
+        mean, stdev = np.mean(row), np.std(row)
+        assert u == np.median(row[row > mean + stdev / 2])
+        assert l == np.median(row[row < mean - stdev / 2])
+
+
+def test_peak_to_peak_and_upper_median():
+    r = chopped()
+    assert abs(reflectance.calculate(r, common.CALC_PEAK_TO_PEAK) - 0.8) < 0.005
+    assert abs(reflectance.calculate(r, common.CALC_UPPER_MEDIAN) - 1.0) < 0.005
+
+
+def test_batch_medians_are_returned_once():
+    batch = np.vstack([chopped(seed=i) for i in range(3)])
+    values, upper, lower = reflectance.calculate_batch_medians(batch, common.CALC_PEAK_TO_PEAK)
+    expected_upper, expected_lower = reflectance.split_medians(batch)
+    assert np.array_equal(upper, expected_upper)
+    assert np.array_equal(lower, expected_lower)
+    assert np.array_equal(values, upper - lower)
+
+
+def test_unequal_lengths():
+    rows = [chopped(1024), chopped(512, lit=0.5)]
+    values = reflectance.calculate_batch(rows, common.CALC_PEAK_TO_PEAK)
+    assert values.shape == (2,)
+    assert abs(values[1] - 0.3) < 0.005
+
+
+def test_demodulation_uses_each_capture_rate():
+    # A 7 Hz chopper sampled at 16 Hz would be 224 Hz at the default rate, outside the search band
+    rate_hz = 16.0
+    t = np.arange(512) / rate_hz
+    r = np.where(np.sin(2 * np.pi * 7 * t) >= 0, 1.0, 0.2)
+    values = reflectance.calculate_batch([r, chopped()], common.CALC_DEMODULATION, [rate_hz, 1024.0])
+    assert abs(values[0] - 0.8) < 0.02
+    assert abs(values[1] - 0.8) < 0.02
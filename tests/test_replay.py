@@ -0,0 +1,53 @@
+# test_replay.py
+#
+# Tests for replaying recorded runs.
+#
+# David Lister
+# July 2023
+#
+
+import os
+import numpy as np
+import archive
+import common
+import replay
+
+
+def write_archive(run_dir, starts, rate_hz=512.0, n=256):
+    os.makedirs(run_dir, exist_ok=True)
+    w = archive.ArchiveWriter(str(run_dir))
+    t = np.arange(n) / rate_hz
+    for i, start in enumerate(starts):
+        w.write(i, start, rate_hz, t, np.full(n, i, np.float32), np.zeros(n, np.float32))
+    w.close()
+
+
+def test_start_times_keep_recorded_spacing_scaled_by_speed(tmp_path):
+    starts = [1000.0, 1002.0, 1003.0, 1010.0]
+    write_archive(tmp_path, starts)
+    source = replay.ReplaySource(str(tmp_path), speed=100)
+    replayed = []
+    while source.next_capture() is not None:
+        replayed.append(source.start_time())
+    assert np.allclose(np.diff(replayed), np.diff(starts) / 100)
+
+
+def test_fast_replay_keeps_recorded_spacing(tmp_path):
+    starts = [50.0, 51.5, 60.0]
+    write_archive(tmp_path, starts)
+    source = replay.ReplaySource(str(tmp_path), speed=common.REPLAY_AS_FAST_AS_POSSIBLE, loop=True)
+    replayed = []
+    for _ in range(6):
+        source.next_capture()
+        replayed.append(source.start_time())
+    # The second pass carries on from the end of the first
+    assert np.allclose(np.diff(replayed[:3]), np.diff(starts))
+    assert np.isclose(replayed[3] - replayed[0], starts[-1] - starts[0] + 256 / 512.0)
+
+
+def test_instrument_path_finds_each_instrument(tmp_path):
+    write_archive(tmp_path / "x", [0.0])
+    write_archive(tmp_path / "y", [0.0])
+    assert replay.instrument_path(str(tmp_path), "y") == str(tmp_path / "y")
+    assert replay.instrument_path(str(tmp_path), "srs830") == str(tmp_path / "x")
+    assert replay.instrument_path(str(tmp_path / "x"), "y") == str(tmp_path / "x")
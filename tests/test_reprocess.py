@@ -0,0 +1,82 @@
+# test_reprocess.py
+#
+# Tests for batch reprocessing of recorded runs.
+#
+# David Lister
+# July 2023
+#
+
+import json
+import os
+import queue
+import numpy as np
+import pytest
+import analysis
+import archive
+import common
+import pipeline
+import replay
+import reprocess
+
+
+def write_run(run_dir, lit, n_captures=3, rate_hz=512.0, n=1024):
+    os.makedirs(run_dir)
+    w = archive.ArchiveWriter(run_dir)
+    t = np.arange(n) / rate_hz
+    r = np.where((np.arange(n) // 32) % 2 == 0, lit, 0.0).astype(np.float32)
+    for i in range(n_captures):
+        w.write(i, 100.0 + 2 * i, rate_hz, t, r, np.zeros(n, np.float32))
+    w.close()
+
+
+def test_runs_with_several_instruments(tmp_path):
+    write_run(str(tmp_path / "single"), 0.5)
+    write_run(str(tmp_path / "multi" / "x"), 0.25)
+    write_run(str(tmp_path / "multi" / "y"), 0.75)
+    runs = reprocess.find_runs(str(tmp_path))
+    assert runs == [(str(tmp_path / "multi" / "x"), str(tmp_path / "multi" / "Reflectance_reprocessed_x")),
+                    (str(tmp_path / "multi" / "y"), str(tmp_path / "multi" / "Reflectance_reprocessed_y")),
+                    (str(tmp_path / "single"), str(tmp_path / "single" / "Reflectance_reprocessed"))]
+
+    done = reprocess.reprocess(str(tmp_path), workers=1, calc_type=common.CALC_PEAK_TO_PEAK)
+    assert len(done) == 3
+    for path, lit in (("multi/Reflectance_reprocessed_x.csv", 0.25), ("multi/Reflectance_reprocessed_y.csv", 0.75),
+                      ("single/Reflectance_reprocessed.csv", 0.5)):
+        data = np.loadtxt(tmp_path / path, delimiter=",", skiprows=1)
+        assert np.allclose(data[:, 0], [0, 2, 4])
+        assert np.allclose(data[:, 1], lit)
+
+    # Unchanged runs are skipped, even after their files are touched
+    os.utime(tmp_path / "multi" / "x" / archive.DATA_FILE)
+    assert reprocess.reprocess(str(tmp_path), workers=1, calc_type=common.CALC_PEAK_TO_PEAK) == []
+
+
+@pytest.mark.parametrize("calc_type", [common.CALC_PEAK_TO_PEAK, common.CALC_DEMODULATION])
+def test_matches_the_live_results(calc_type, tmp_path, monkeypatch):
+    # The live analysis measures times from the run's start in run.json, which is before the first capture. Demodulation
+    # gives every window, running on across captures and across reprocessing blocks.
+    monkeypatch.setattr(common, "CALC_TYPE", calc_type)
+    monkeypatch.setattr(common, "TRACK_THICKNESS", False)
+    monkeypatch.setattr(reprocess, "BLOCK_CAPTURES", 2)
+    run_dir = str(tmp_path / "run")
+    write_run(run_dir, 0.5, n_captures=5)
+    with open(os.path.join(run_dir, replay.RUN_INFO_FILE), 'w') as f:
+        json.dump({"run_name": "run", "init_time": 97.5}, f)
+
+    data, commands = pipeline.BoundedQueue(), queue.Queue()
+    handler = analysis.AnalysisHandler(data, None, commands, "run", run_dir, init_time=97.5,
+                                       instruments=[{"name": "srs830"}])
+    for start_time, timebase, r, theta, rate_hz in replay.archive_captures(run_dir):
+        data.put([start_time, (timebase, r, theta), {"sample_rate_hz": rate_hz}])
+    commands.put(common.ANALYSIS_COMMAND_RAISE_END_FLAG)
+    handler.join()
+    live = np.loadtxt(os.path.join(run_dir, "Reflectance.csv"), delimiter=",", skiprows=1)
+
+    reprocess.reprocess(str(tmp_path), workers=1, calc_type=calc_type)
+    batch = np.loadtxt(os.path.join(run_dir, "Reflectance_reprocessed.csv"), delimiter=",", skiprows=1)
+    if calc_type == common.CALC_PEAK_TO_PEAK:
+        assert np.allclose(live[:, 0], [2.5, 4.5, 6.5, 8.5, 10.5])
+    else:
+        assert len(live) > 5 * 10
+    assert batch.shape == live.shape
+    assert np.allclose(batch, live, atol=1e-4)
@@ -0,0 +1,175 @@
+# test_srs830.py
+#
+# Tests for the SR830 drivers, against the simulator on a pseudo-terminal.
+#
+# David Lister
+# July 2023
+#
+
+import logging
+import queue
+import time
+import numpy as np
+import pytest
+import common
+import srs830
+import srs830_async
+import srs830_sim
+import transport
+
+pytest.importorskip("serial")
+
+
+@pytest.fixture
+def sim():
+    sim = srs830_sim.SR830Simulator(pacing=False).start()
+    yield sim
+    sim.stop()
+
+
+def start_handler(handler_class, sim, tmp_path, monkeypatch):
+    monkeypatch.setattr(common, "SRS830_CAPTURE_TIME_S", 0.1)
+    data, commands = queue.Queue(), queue.Queue()
+    handler = handler_class(data, commands, "test", str(tmp_path), serial_port=sim.port_name)
+    return handler, data, commands
+
+
+def drain(data):
+    while not data.empty():
+        data.get()
+
+
+def wait_for_state(handler, state, timeout_s=10):
+    deadline = time.time() + timeout_s
+    while handler.state != state:
+        assert time.time() < deadline, f"Still {handler.state}"
+        time.sleep(0.002)
+
+
+@pytest.mark.parametrize("handler_class", [srs830.SRS830Handler, srs830_async.AsyncSRS830Handler])
+def test_reconnects_after_a_garbled_reply(handler_class, sim, tmp_path, monkeypatch, caplog):
+    handler, data, commands = start_handler(handler_class, sim, tmp_path, monkeypatch)
+    try:
+        data.get(timeout=10)
+        caplog.set_level(logging.INFO)
+        caplog.clear()
+        sim.garbled_replies = 1  # The next stored point count
+        deadline = time.time() + 10
+        while "Attempting to connect" not in caplog.text:
+            assert time.time() < deadline, "No reconnection"
+            time.sleep(0.002)
+        t0 = time.time()
+        drain(data)
+        start_time, capture, info = data.get(timeout=10)
+        assert time.time() - t0 < 1
+        assert len(capture[1]) > 0
+    finally:
+        commands.put(common.SRS830_COMMAND_RAISE_END_FLAG)
+        handler.join()
+
+
+@pytest.mark.parametrize("handler_class", [srs830.SRS830Handler, srs830_async.AsyncSRS830Handler])
+def test_reconnects_when_the_instrument_answers_again(handler_class, sim, tmp_path, monkeypatch):
+    monkeypatch.setattr(common, "SRS830_RECONNECT_INTERVAL_S", 0.1)
+    handler, data, commands = start_handler(handler_class, sim, tmp_path, monkeypatch)
+    try:
+        data.get(timeout=10)
+        sim.silent = True
+        wait_for_state(handler, common.SRS830_STATE_WAITING_FOR_SERIAL_PORT)
+        sim.silent = False
+        drain(data)
+        data.get(timeout=10)
+        assert handler.serialPort == sim.port_name
+    finally:
+        commands.put(common.SRS830_COMMAND_RAISE_END_FLAG)
+        handler.join()
+
+
+@pytest.mark.parametrize("handler_class", [srs830.SRS830Handler, srs830_async.AsyncSRS830Handler])
+def test_close_then_set_port(handler_class, sim, tmp_path, monkeypatch):
+    handler, data, commands = start_handler(handler_class, sim, tmp_path, monkeypatch)
+    try:
+        data.get(timeout=10)
+        commands.put(common.SRS830_COMMAND_CLOSE_SERIAL_PORT)
+        wait_for_state(handler, common.SRS830_STATE_WAITING_FOR_SERIAL_PORT)
+        time.sleep(0.3)
+        drain(data)
+        with pytest.raises(queue.Empty):
+            data.get(timeout=0.3)
+        assert handler.ser is None
+
+        commands.put(common.SRS830_COMMAND_SET_SERIAL_PORT)
+        commands.put(sim.port_name)
+        data.get(timeout=10)
+    finally:
+        commands.put(common.SRS830_COMMAND_RAISE_END_FLAG)
+        handler.join()
+
+
+@pytest.mark.parametrize("handler_class", [srs830.SRS830Handler, srs830_async.AsyncSRS830Handler])
+def test_continuous_capture_info(handler_class, tmp_path, monkeypatch):
+    # Paced like the real instrument, so the asyncio driver decodes each chunk while the next is being transferred
+    monkeypatch.setattr(common, "SRS830_ACQUISITION_MODE", common.SRS830_ACQUISITION_CONTINUOUS)
+    sim = srs830_sim.SR830Simulator().start()
+    handler, data, commands = start_handler(handler_class, sim, tmp_path, monkeypatch)
+    try:
+        infos = [data.get(timeout=10)[2] for i in range(15)]
+    finally:
+        commands.put(common.SRS830_COMMAND_RAISE_END_FLAG)
+        handler.join()
+        sim.stop()
+    assert [info["capture_index"] for info in infos] == list(range(15))
+    assert all(b["segment_index"] >= a["segment_index"] for a, b in zip(infos, infos[1:]))
+    assert all(b["sample_index"] == a["sample_index"] + a["n_samples"] for a, b in zip(infos, infos[1:]))
+    assert all(info["duty_cycle"] > 0.95 for info in infos)
+
+
+@pytest.mark.parametrize("handler_class", [srs830.SRS830Handler, srs830_async.AsyncSRS830Handler])
+def test_continuous_across_buffer_restarts(handler_class, tmp_path, monkeypatch):
+    # A small buffer, so the driver restarts it every half second or so
+    monkeypatch.setattr(common, "SRS830_ACQUISITION_MODE", common.SRS830_ACQUISITION_CONTINUOUS)
+    monkeypatch.setattr(common, "SRS830_BUFFER_POINTS", 300)
+    monkeypatch.setattr(common, "SRS830_BUFFER_ROLLOVER_MARGIN_S", 0.1)
+    monkeypatch.setattr(srs830_sim, "BUFFER_POINTS", 300)
+    sim = srs830_sim.SR830Simulator(pacing=False).start()
+    handler, data, commands = start_handler(handler_class, sim, tmp_path, monkeypatch)
+    try:
+        items = [data.get(timeout=10) for i in range(25)]
+    finally:
+        commands.put(common.SRS830_COMMAND_RAISE_END_FLAG)
+        handler.join()
+        sim.stop()
+    infos = [info for _, _, info in items]
+    assert infos[-1]["segment_index"] - infos[0]["segment_index"] >= 2
+    for (t_a, capture_a, a), (t_b, capture_b, b) in zip(items, items[1:]):
+        assert len(capture_a[1]) == a["n_samples"] > 0
+        assert b["sample_index"] == a["sample_index"] + a["n_samples"]  # No gaps or repeats in the numbering
+        end_a = t_a + a["n_samples"] / a["sample_rate_hz"]
+        if b["segment_index"] == a["segment_index"]:
+            assert t_b == pytest.approx(end_a)  # Chunks of one buffer run on from each other
+        else:
+            assert b["segment_index"] == a["segment_index"] + 1
+            assert t_b >= end_a - 1e-6  # A restarted buffer does not overlap the last one
+    assert all(info["duty_cycle"] > 0.95 for info in infos)
+
+
+def test_lia_decode_round_trip():
+    values = np.array([0.0, 1e-3, -2.5e-4, 0.0153, -1.0, 3.2e-7])
+    decoded = srs830.decode_lia(srs830_sim.encode_lia(values))
+    assert np.allclose(decoded, values, rtol=2 ** -13, atol=0)
+
+
+@pytest.mark.parametrize("mode", [common.SRS830_TRANSFER_ASCII, common.SRS830_TRANSFER_IEEE,
+                                  common.SRS830_TRANSFER_LIA])
+def test_transfer_modes_read_the_buffer(mode, sim, monkeypatch):
+    monkeypatch.setattr(common, "SRS830_TRANSFER_MODE", mode)
+    con = transport.open_serial(sim.port_name, common.SRS830_BAUD, common.SRS830_TIMEOUT_S)
+    try:
+        sim.buffer_r[:100] = np.linspace(-0.01, 0.02, 100)
+        sim.stored = 100
+        values = srs830.transfer_trace(con, 1, 60, offset=20)
+        assert len(values) == 60
+        assert np.allclose(values, sim.buffer_r[20:80], rtol=1e-4, atol=1e-9)
+        assert srs830.query_points(con) == 100
+    finally:
+        con.close()
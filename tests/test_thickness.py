@@ -0,0 +1,48 @@
+# test_thickness.py
+#
+# Tests for the streaming thickness tracker.
+#
+# David Lister
+# July 2023
+#
+
+import math
+import numpy as np
+import thickness
+
+
+def fringes(tracker, t, period_s=20.0, mean=1.0, amplitude=0.5):
+    states = []
+    for ti in t:
+        states.append(tracker.update(float(ti), mean + amplitude * math.cos(2 * math.pi * ti / period_s)))
+    return states
+
+
+def test_growth_rate_from_fringe_period():
+    tracker = thickness.ThicknessTracker()
+    state = fringes(tracker, np.arange(0, 200, 0.1))[-1]
+    assert state["half_fringes"] == 19
+    assert abs(state["growth_rate_nm_s"] - tracker.half_fringe_nm / 10) < 1e-3 * tracker.half_fringe_nm
+    assert state["roughness_nm"] == 0.0
+
+
+def test_decaying_envelope_gives_roughness():
+    tracker = thickness.ThicknessTracker()
+    t = np.arange(0, 400, 0.1)
+    for ti in t:
+        tracker.update(float(ti), 1.0 + 0.5 * math.exp(-ti / 400) * math.cos(2 * math.pi * ti / 20))
+    assert tracker.roughness_nm() > 0
+
+
+def test_non_finite_points_are_ignored():
+    tracker = thickness.ThicknessTracker()
+    state = tracker.update(0.0, math.nan)
+    assert tracker.candidate_max is None and math.isnan(state["growth_rate_nm_s"])
+    t = np.arange(0, 200, 0.1)
+    clean = fringes(thickness.ThicknessTracker(), t)[-1]
+    for i, ti in enumerate(t):
+        r = 1.0 + 0.5 * math.cos(2 * math.pi * ti / 20.0)
+        tracker.update(float(ti), r)
+        if i % 50 == 0:
+            tracker.update(float(ti), math.inf if i % 100 else math.nan)
+    assert tracker.state() == clean
@@ -0,0 +1,113 @@
+# test_transport.py
+#
+# Tests for the chunked serial transport.
+#
+# David Lister
+# July 2023
+#
+
+import asyncio
+import transport
+
+
+class ChunkPort:
+    # Hands out the given chunks one read at a time, then times out with nothing
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+        self.timeout = 5
+        self.timeouts = []
+
+    @property
+    def in_waiting(self):
+        return len(self.chunks[0]) if self.chunks else 0
+
+    def read(self, n):
+        self.timeouts.append(self.timeout)
+        return self.chunks.pop(0) if self.chunks else b""
+
+    def write(self, data):
+        pass
+
+    def close(self):
+        pass
+
+
+class TricklePort:
+    # A long reply still arriving: in_waiting only ever shows a few bytes, while a blocking read waits for what was
+    # asked for
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    @property
+    def in_waiting(self):
+        return min(32, len(self.data) - self.pos)
+
+    def read(self, n):
+        out = self.data[self.pos:self.pos + n]
+        self.pos += len(out)
+        return out
+
+    def fileno(self):
+        raise OSError
+
+    def write(self, data):
+        pass
+
+    def close(self):
+        pass
+
+
+def trca_reply(points):
+    return bytes("".join(f"{-v * 1e-4:.6e}," for v in range(points)) + "\r", encoding="ascii")
+
+
+def test_read_until_fields_in_few_reads():
+    reply = trca_reply(500)
+    con = transport.Transport(TricklePort(reply))
+    assert con.read_until(fields=500) == reply[:-1]
+    assert con.read_calls < 50
+
+    con = transport.Transport(TricklePort(reply))
+    assert con.read_until() == reply[:-1]
+    assert con.read_calls > 200
+
+
+def test_async_read_until_in_chunks():
+    reply = trca_reply(500)
+    con = transport.AsyncTransport(TricklePort(reply), poll_s=0)
+    assert asyncio.run(con.read_until()) == reply[:-1]
+    assert con.read_calls == -(-len(reply) // transport.READ_CHUNK)
+
+
+def test_read_until_split_reply():
+    con = transport.Transport(ChunkPort([b"12", b"34\r5", b"6\r"]))
+    assert con.read_until() == b"1234"
+    assert con.read_until() == b"56"
+
+
+def test_read_until_after_compaction():
+    # The second reply arrives when the buffer is nearly full, so it is moved to the front before the terminator lands
+    con = transport.Transport(ChunkPort([b"0123456789\rab", b"cdef\r"]), buffer_size=16)
+    assert con.read_until() == b"0123456789"
+    assert con.read_until() == b"abcdef"
+    assert con.pending() == 0
+
+
+def test_read_until_timeout_returns_partial():
+    con = transport.Transport(ChunkPort([b"abc"]))
+    assert con.read_until() == b"abc"
+
+
+def test_read_until_timeout_override():
+    port = ChunkPort([b"ok\r"])
+    con = transport.Transport(port)
+    assert con.read_until(b"\r", 0.5) == b"ok"
+    assert port.timeouts == [0.5]
+    assert port.timeout == 5
+
+
+def test_read_exact():
+    con = transport.Transport(ChunkPort([b"\x01\x02", b"\x03\x04\x05"]), buffer_size=4)
+    assert con.read_exact(4) == b"\x01\x02\x03\x04"
+    assert con.read_exact(4) == b"\x05"
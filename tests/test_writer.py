@@ -0,0 +1,60 @@
+# test_writer.py
+#
+# Tests for the buffered result writer and its crash repair.
+#
+# David Lister
+# July 2023
+#
+
+import numpy as np
+import common
+import writer
+
+
+def test_csv_round_trip(tmp_path):
+    path = str(tmp_path / "Reflectance.csv")
+    w = writer.ResultWriter(path, ("time", "reflectance"), header="Time (s),Reflectance (v)", flush_points=2)
+    w.write([0.0, 1.0, 2.0], [0.5, 0.6, 0.7])
+    w.close()
+    data = np.loadtxt(path, delimiter=",", skiprows=1)
+    assert np.array_equal(data, [[0.0, 0.5], [1.0, 0.6], [2.0, 0.7]])
+
+
+def test_csv_append_trims_partial_record(tmp_path):
+    path = str(tmp_path / "Reflectance.csv")
+    w = writer.ResultWriter(path, ("time", "reflectance"))
+    w.write([0.0, 1.0], [0.5, 0.6])
+    w.close()
+    with open(path, 'ab') as f:
+        f.write(b"2.0,0.")  # Cut off by a crash
+
+    w = writer.ResultWriter(path, ("time", "reflectance"), append=True)
+    w.write(3.0, 0.8)
+    w.close()
+    with open(path) as f:
+        assert f.read() == "time,reflectance\n0.0,0.5\n1.0,0.6\n3.0,0.8\n"
+
+
+def test_binary_append_trims_partial_record(tmp_path):
+    path = str(tmp_path / "Reflectance.bin")
+    w = writer.ResultWriter(path, ("time", "reflectance"), fmt=common.WRITER_FORMAT_BINARY)
+    w.write([0.0, 1.0], [0.5, 0.6])
+    w.close()
+    with open(path, 'ab') as f:
+        f.write(b"\x00" * 11)
+
+    assert writer.repair(path, common.WRITER_FORMAT_BINARY) == 11
+    w = writer.ResultWriter(path, ("time", "reflectance"), fmt=common.WRITER_FORMAT_BINARY, append=True)
+    w.write(2.0, 0.7)
+    w.close()
+    data = writer.read_binary(path)
+    assert np.array_equal(data["time"], [0.0, 1.0, 2.0])
+    assert np.array_equal(data["reflectance"], [0.5, 0.6, 0.7])
+
+
+def test_repair_leaves_complete_file_alone(tmp_path):
+    path = str(tmp_path / "Reflectance.csv")
+    w = writer.ResultWriter(path, ("time", "reflectance"))
+    w.write(0.0, 0.5)
+    w.close()
+    assert writer.repair(path, common.WRITER_FORMAT_CSV) == 0
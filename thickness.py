@@ -0,0 +1,152 @@
+# thickness.py
+#
+# Streaming film thickness and roughness tracker.
+#
+# As a film grows, its reflectance oscillates: each half fringe (maximum to minimum or back) is a thickness increase
+# of wavelength / (4 n cos(theta_film)). Extrema are found online with a hysteresis detector, so each new
+# reflectance point costs O(1) and no history is refitted. The fringe half-period is smoothed with an exponential
+# moving average to give the growth rate, and the thickness between extrema is interpolated from it. Thickness is
+# counted from the first extremum, growth before that cannot be seen.
+#
+# Surface roughness scatters light out of the specular beam and makes the fringe envelope decay. The log of each
+# half-fringe amplitude is fitted against fringe count with running sums, and the decay is converted to an RMS
+# roughness with the Debye-Waller factor, envelope ratio = exp(-(4 pi sigma cos(theta) / wavelength)^2).
+#
+# David Lister
+# July 2023
+#
+
+import math
+import common
+
+MAXIMUM = 1
+MINIMUM = -1
+
+
+class ThicknessTracker:
+    def __init__(self, wavelength_nm=common.THICKNESS_WAVELENGTH_NM, refractive_index=common.THICKNESS_REFRACTIVE_INDEX,
+                 angle_deg=common.THICKNESS_ANGLE_DEG, hysteresis_fraction=common.THICKNESS_HYSTERESIS_FRACTION,
+                 min_hysteresis=common.THICKNESS_MIN_HYSTERESIS_V, period_smoothing=common.THICKNESS_PERIOD_SMOOTHING):
+        self.wavelength_nm = wavelength_nm
+        self.angle = math.radians(angle_deg)
+        angle_film = math.asin(math.sin(self.angle) / refractive_index)
+        self.half_fringe_nm = wavelength_nm / (4 * refractive_index * math.cos(angle_film))
+        self.hysteresis_fraction = hysteresis_fraction
+        self.min_hysteresis = min_hysteresis
+        self.period_smoothing = period_smoothing
+
+        # Extremum detection
+        self.direction = 0  # MAXIMUM while looking for a maximum, MINIMUM while looking for a minimum, 0 at start
+        self.candidate_max = None  # (t, r)
+        self.candidate_min = None
+        self.last_extremum = None  # (kind, t, r)
+        self.min_seen = math.inf
+        self.max_seen = -math.inf
+
+        # Fringe statistics
+        self.half_fringes = 0
+        self.half_period_s = None
+        self.envelope = None  # Smoothed half-fringe amplitude
+
+        # Running sums for the fit of log(amplitude) against half-fringe count
+        self.n_fit = 0
+        self.sum_x = 0.0
+        self.sum_y = 0.0
+        self.sum_xx = 0.0
+        self.sum_xy = 0.0
+
+        self.t = None
+
+    def update(self, t, r):
+        # Adds one reflectance point, returns the current estimates. Non-finite points, such as a capture the
+        # estimator could not handle, are ignored.
+        if not math.isfinite(r):
+            return self.state()
+        self.t = t
+        self.min_seen = min(self.min_seen, r)
+        self.max_seen = max(self.max_seen, r)
+        if self.candidate_max is None:
+            self.candidate_max = (t, r)
+            self.candidate_min = (t, r)
+            return self.state()
+
+        amplitude = self.envelope if self.envelope is not None else self.max_seen - self.min_seen
+        hysteresis = max(self.min_hysteresis, self.hysteresis_fraction * amplitude)
+
+        if self.direction != MINIMUM and r > self.candidate_max[1]:
+            self.candidate_max = (t, r)
+        if self.direction != MAXIMUM and r < self.candidate_min[1]:
+            self.candidate_min = (t, r)
+
+        if self.direction != MINIMUM and r < self.candidate_max[1] - hysteresis:
+            self.confirm(MAXIMUM, *self.candidate_max)
+            self.direction = MINIMUM
+            self.candidate_min = (t, r)
+
+        elif self.direction != MAXIMUM and r > self.candidate_min[1] + hysteresis:
+            self.confirm(MINIMUM, *self.candidate_min)
+            self.direction = MAXIMUM
+            self.candidate_max = (t, r)
+
+        return self.state()
+
+    def confirm(self, kind, t, r):
+        if self.last_extremum is not None and self.last_extremum[0] != kind:
+            half_period = t - self.last_extremum[1]
+            amplitude = abs(r - self.last_extremum[2])
+            self.half_fringes += 1
+
+            if self.half_period_s is None:
+                self.half_period_s = half_period
+                self.envelope = amplitude
+            else:
+                self.half_period_s += self.period_smoothing * (half_period - self.half_period_s)
+                self.envelope += self.period_smoothing * (amplitude - self.envelope)
+
+            if amplitude > 0:
+                x = self.half_fringes
+                y = math.log(amplitude)
+                self.n_fit += 1
+                self.sum_x += x
+                self.sum_y += y
+                self.sum_xx += x * x
+                self.sum_xy += x * y
+
+        self.last_extremum = (kind, t, r)
+
+    def envelope_decay(self):
+        # Fitted change of log(amplitude) per half fringe, None until three amplitudes are in
+        if self.n_fit < 3:
+            return None
+        denominator = self.n_fit * self.sum_xx - self.sum_x ** 2
+        if denominator == 0:
+            return None
+        return (self.n_fit * self.sum_xy - self.sum_x * self.sum_y) / denominator
+
+    def roughness_nm(self):
+        decay = self.envelope_decay()
+        if decay is None:
+            return math.nan
+        log_ratio = decay * (self.half_fringes - 1)  # Envelope now relative to the first half fringe
+        if log_ratio >= 0:
+            return 0.0
+        return self.wavelength_nm / (4 * math.pi * math.cos(self.angle)) * math.sqrt(-log_ratio)
+
+    def thickness_nm(self):
+        thickness = self.half_fringes * self.half_fringe_nm
+        if self.half_period_s and self.last_extremum is not None:
+            # Progress through the current half fringe, assuming the growth rate holds
+            fraction = min((self.t - self.last_extremum[1]) / self.half_period_s, 1.0)
+            thickness += fraction * self.half_fringe_nm
+        return thickness
+
+    def growth_rate_nm_s(self):
+        if not self.half_period_s:
+            return math.nan
+        return self.half_fringe_nm / self.half_period_s
+
+    def state(self):
+        return {"thickness_nm": self.thickness_nm(),
+                "growth_rate_nm_s": self.growth_rate_nm_s(),
+                "roughness_nm": self.roughness_nm(),
+                "half_fringes": self.half_fringes}
@@ -0,0 +1,225 @@
+# transport.py
+#
+# Byte transports for talking to the instruments.
+#
+# A transport wraps a port-like object (anything with read, write, close and optionally in_waiting) and provides
+# the reads the SRS830 protocol needs: terminated replies for queries, and fixed-length replies for binary
+# buffer transfers. Data is read in chunks into a preallocated buffer, and reads block on the port's own timeout
+# rather than polling in_waiting.
+#
+# AsyncTransport provides the same reads as coroutines for the asyncio driver. The port is opened non-blocking and
+# the event loop wakes the read when the file descriptor becomes readable, so a pending read costs nothing and can be
+# cancelled or timed out at any moment. Ports without a file descriptor (Windows COM ports) are polled instead.
+#
+# David Lister
+# July 2023
+#
+
+import asyncio
+import logging
+
+logger = logging.getLogger("RTLR.transport")
+
+DEFAULT_BUFFER_SIZE = 64 * 1024
+DEFAULT_TERMINATOR = b'\r'
+DEFAULT_POLL_S = 0.002  # Read poll interval for ports without a file descriptor
+READ_CHUNK = 4096  # Read size of the non-blocking asyncio transport
+
+
+class Transport:
+    def __init__(self, port, buffer_size=DEFAULT_BUFFER_SIZE):
+        self.port = port
+        self.buf = bytearray(buffer_size)
+        self.start = 0  # First unconsumed byte in buf
+        self.end = 0  # One past the last valid byte in buf
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.read_calls = 0
+
+    def write(self, data):
+        self.bytes_written += len(data)
+        self.port.write(data)
+
+    def close(self):
+        self.port.close()
+
+    def pending(self):
+        return self.end - self.start
+
+    def _fill(self, want):
+        # Blocks until at least one byte arrives or the port times out, then appends up to want bytes.
+        # Returns the number of bytes added.
+        if self.end + want > len(self.buf):
+            self._compact(want)
+        data = self.port.read(want)
+        self.read_calls += 1
+        n = len(data)
+        if n:
+            self.buf[self.end:self.end + n] = data
+            self.end += n
+            self.bytes_read += n
+        return n
+
+    def _compact(self, want):
+        # Moves unconsumed data to the front of the buffer, growing it if it is still too small
+        n = self.end - self.start
+        if self.start:
+            self.buf[:n] = self.buf[self.start:self.end]
+            self.start = 0
+            self.end = n
+        if n + want > len(self.buf):
+            self.buf.extend(bytes(max(n + want, 2 * len(self.buf)) - len(self.buf)))
+
+    def _take(self, n):
+        out = bytes(memoryview(self.buf)[self.start:self.start + n])
+        self.start += n
+        if self.start == self.end:
+            self.start = 0
+            self.end = 0
+        return out
+
+    def _waiting(self):
+        try:
+            return self.port.in_waiting
+        except AttributeError:
+            return 0
+
+    def read_until(self, terminator=DEFAULT_TERMINATOR, timeout_s=None, fields=0, separator=b','):
+        # Returns the reply without its terminator. On a timeout, whatever arrived is returned.
+        # timeout_s replaces the port's own timeout for this read.
+        # fields is the number of values in the reply, each ending in separator. Every value still to come is at least
+        # a character and its separator, so that much is read in one go rather than as it trickles in.
+        if timeout_s is None or not hasattr(self.port, "timeout"):
+            return self._read_until(terminator, fields, separator)
+        saved = self.port.timeout
+        self.port.timeout = timeout_s
+        try:
+            return self._read_until(terminator, fields, separator)
+        finally:
+            self.port.timeout = saved
+
+    def _read_until(self, terminator, fields, separator):
+        # scanned counts bytes after start already searched, filling can move the data to the front of the buffer
+        scanned = 0
+        while True:
+            idx = self.buf.find(terminator, self.start + scanned, self.end)
+            if idx >= 0:
+                out = self._take(idx - self.start)
+                self._take(len(terminator))
+                return out
+            scanned = max(0, self.pending() - len(terminator) + 1)
+            want = max(1, self._waiting())
+            if fields:
+                still_to_come = fields - self.buf.count(separator, self.start, self.end)
+                want = max(want, 2 * still_to_come + len(terminator))
+            if self._fill(want) == 0:
+                logger.debug("Timed out waiting for terminator")
+                return self._take(self.pending())
+
+    def read_exact(self, n_bytes):
+        # Returns n_bytes, or fewer if the port times out first
+        while self.pending() < n_bytes:
+            if self._fill(n_bytes - self.pending()) == 0:
+                logger.debug(f"Timed out with {self.pending()} of {n_bytes} bytes")
+                break
+        return self._take(min(n_bytes, self.pending()))
+
+    def flush_input(self):
+        self.start = 0
+        self.end = 0
+        if hasattr(self.port, "reset_input_buffer"):
+            self.port.reset_input_buffer()
+
+
+def open_serial(port_name, baudrate, timeout_s):
+    import serial
+    return Transport(serial.Serial(port_name, timeout=timeout_s, baudrate=baudrate))
+
+
+class AsyncTransport:
+    def __init__(self, port, poll_s=DEFAULT_POLL_S):
+        # port must have been opened with a read timeout of 0
+        self.port = port
+        self.poll_s = poll_s
+        self.buf = bytearray()
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.read_calls = 0
+        try:
+            self.fd = port.fileno()
+        except (AttributeError, OSError):
+            self.fd = None
+
+    def write(self, data):
+        self.bytes_written += len(data)
+        self.port.write(data)
+
+    def close(self):
+        self.port.close()
+
+    def pending(self):
+        return len(self.buf)
+
+    async def _readable(self):
+        if self.fd is None:
+            await asyncio.sleep(self.poll_s)
+            return
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+
+        def wake():
+            if not ready.done():
+                ready.set_result(None)
+
+        loop.add_reader(self.fd, wake)
+        try:
+            await ready
+        finally:
+            loop.remove_reader(self.fd)
+
+    async def _fill(self):
+        # Waits for data, then appends what the port has. The port does not block, so a fixed chunk is asked for
+        # rather than checking in_waiting first.
+        await self._readable()
+        data = self.port.read(READ_CHUNK)
+        self.read_calls += 1
+        self.buf += data
+        self.bytes_read += len(data)
+
+    async def read_until(self, terminator=DEFAULT_TERMINATOR):
+        # Returns the reply without its terminator. Waits indefinitely, wrap in asyncio.wait_for for a timeout.
+        scan = 0
+        while True:
+            idx = self.buf.find(terminator, scan)
+            if idx >= 0:
+                out = bytes(self.buf[:idx])
+                del self.buf[:idx + len(terminator)]
+                return out
+            scan = max(0, len(self.buf) - len(terminator) + 1)
+            await self._fill()
+
+    async def read_exact(self, n_bytes):
+        while len(self.buf) < n_bytes:
+            await self._fill()
+        out = bytes(self.buf[:n_bytes])
+        del self.buf[:n_bytes]
+        return out
+
+    def flush_input(self):
+        self.buf.clear()
+        if hasattr(self.port, "reset_input_buffer"):
+            self.port.reset_input_buffer()
+
+    async def discard(self, quiet_s):
+        # Throws away input until nothing has arrived for quiet_s, e.g. the rest of a reply that was abandoned
+        while True:
+            self.flush_input()
+            try:
+                await asyncio.wait_for(self._fill(), quiet_s)
+            except TimeoutError:
+                return
+
+
+def open_serial_async(port_name, baudrate):
+    import serial
+    return AsyncTransport(serial.Serial(port_name, timeout=0, baudrate=baudrate))
@@ -0,0 +1,156 @@
+# writer.py
+#
+# Buffered writers for calculated results.
+#
+# The file is kept open and records are batched in memory, then written when enough points have accumulated or
+# enough time has passed since the last flush. Each flush writes whole records only, optionally followed by an
+# fsync, so a crash loses at most the records of one flush interval. When an existing file is reopened for
+# appending, as by rtlr.py --resume, any partial record left by a crash is trimmed off first.
+#
+# Two formats are available. CSV matches the layout of the original Reflectance.csv. The binary format is a short
+# header (magic, column count and names) followed by little-endian float64 records, one value per column.
+#
+# David Lister
+# July 2023
+#
+
+import logging
+import os
+import struct
+import time
+import numpy as np
+import common
+import metrics
+
+logger = logging.getLogger("RTLR.writer")
+
+BINARY_MAGIC = b"RTLRBIN1"
+
+
+def _binary_header(columns):
+    names = "\n".join(columns).encode("utf-8")
+    return BINARY_MAGIC + struct.pack("<HH", len(columns), len(names)) + names
+
+
+def read_binary_header(f):
+    # Returns the column names and the header length in bytes
+    magic = f.read(len(BINARY_MAGIC))
+    if magic != BINARY_MAGIC:
+        raise ValueError("Not an RTLR binary file")
+    n_columns, n_bytes = struct.unpack("<HH", f.read(4))
+    columns = f.read(n_bytes).decode("utf-8").split("\n")
+    if len(columns) != n_columns:
+        raise ValueError("Corrupt RTLR binary header")
+    return columns, len(BINARY_MAGIC) + 4 + n_bytes
+
+
+def read_binary(path):
+    # Memory maps a binary results file, returns a dict of column name to array. A partial trailing record is ignored.
+    with open(path, 'rb') as f:
+        columns, offset = read_binary_header(f)
+    n = (os.path.getsize(path) - offset) // (8 * len(columns))
+    if n == 0:
+        return {c: np.zeros(0) for c in columns}
+    data = np.memmap(path, dtype='<f8', mode='r', offset=offset, shape=(n, len(columns)))
+    return {c: data[:, i] for i, c in enumerate(columns)}
+
+
+def repair(path, fmt):
+    # Trims a partial record from the end of a file left by a crash. Returns the number of bytes removed.
+    size = os.path.getsize(path)
+    if fmt == common.WRITER_FORMAT_BINARY:
+        with open(path, 'rb') as f:
+            columns, offset = read_binary_header(f)
+        keep = offset + (size - offset) // (8 * len(columns)) * 8 * len(columns)
+
+    else:
+        # Keep everything up to and including the last newline
+        keep = 0
+        with open(path, 'rb') as f:
+            pos = size
+            while pos > 0:
+                step = min(4096, pos)
+                pos -= step
+                f.seek(pos)
+                idx = f.read(step).rfind(b"\n")
+                if idx >= 0:
+                    keep = pos + idx + 1
+                    break
+
+    if keep < size:
+        logger.warning(f"Trimming {size - keep} bytes of partial record from {path}")
+        with open(path, 'r+b') as f:
+            f.truncate(keep)
+    return size - keep
+
+
+class ResultWriter:
+    def __init__(self, path, columns, header=None, fmt=common.WRITER_FORMAT_CSV, append=False,
+                 flush_points=common.WRITER_FLUSH_POINTS, flush_interval_s=common.WRITER_FLUSH_INTERVAL_S,
+                 fsync=common.WRITER_FSYNC):
+        self.path = path
+        self.columns = tuple(columns)
+        self.fmt = fmt
+        self.flush_points = flush_points
+        self.flush_interval_s = flush_interval_s
+        self.fsync = fsync
+
+        self.pending = [[] for _ in self.columns]
+        self.n_pending = 0
+        self.last_flush_time = time.monotonic()
+        self.points_written = 0
+
+        if append and os.path.exists(path) and os.path.getsize(path) > 0:
+            repair(path, fmt)
+            self.f = open(path, 'ab')
+
+        else:
+            self.f = open(path, 'wb')
+            if fmt == common.WRITER_FORMAT_BINARY:
+                self.f.write(_binary_header(self.columns))
+            else:
+                if header is None:
+                    header = ",".join(self.columns)
+                self.f.write(bytes(header + "\n", encoding="utf-8"))
+            self._sync()
+
+    def write(self, *arrays):
+        # One array (or scalar) per column
+        arrays = [np.atleast_1d(np.asarray(a, dtype=np.float64)) for a in arrays]
+        for pending, a in zip(self.pending, arrays):
+            pending.append(a)
+        self.n_pending += len(arrays[0])
+        self.poll()
+
+    def poll(self):
+        # Flushes if either threshold has been reached, call periodically so idle data still reaches the disk
+        if self.n_pending == 0:
+            return
+        if self.n_pending >= self.flush_points or time.monotonic() - self.last_flush_time >= self.flush_interval_s:
+            self.flush()
+
+    def flush(self):
+        self.last_flush_time = time.monotonic()
+        if self.n_pending == 0:
+            return
+        t0 = metrics.start()
+        data = [np.concatenate(p) for p in self.pending]
+        if self.fmt == common.WRITER_FORMAT_BINARY:
+            self.f.write(np.column_stack(data).astype('<f8').tobytes())
+        else:
+            self.f.write(bytes("".join(",".join(str(v) for v in row) + "\n"
+                                       for row in zip(*(d.tolist() for d in data))), encoding="utf-8"))
+        self.points_written += self.n_pending
+        self.pending = [[] for _ in self.columns]
+        self.n_pending = 0
+        self._sync()
+        metrics.stop("flush", t0)
+
+    def _sync(self):
+        self.f.flush()
+        if self.fsync == common.WRITER_FSYNC_ON_FLUSH:
+            os.fsync(self.f.fileno())
+
+    def close(self):
+        self.flush()
+        self.f.close()